@@ -0,0 +1,360 @@
+"""Reanalyze recorded signals offline, in parallel.
+
+A long recording (see recorders.TraceRecorder) is split into segments of
+'segment_ms', each analyzed by DataGenerator._analyze_drops in one of a pool
+of worker processes. Workers map the recording's chunk files themselves, so
+only segment boundaries go to them and only drop events come back.
+
+Each segment is analyzed with a halo of 'halo_ms' of signal on either side,
+so drops that straddle a segment boundary are measured whole. A drop belongs
+to the segment whose core (the segment minus its halos) holds its first
+sample at half height, the sample its timestamp comes from, so every drop
+is reported exactly once. Results are merged in timestamp order.
+
+Drop widths (and so the AUCs integrated over them) are measured from a
+baseline found within 'prominence_window' of each peak, so the halos only
+need to cover half that; a drop is then measured exactly as it would be if
+the whole recording were analyzed in one piece with the same window.
+
+Two things are per segment rather than per recording: each channel's
+baseline (a median of the segment's non-drop samples) and the density
+(a KDE of the segment's drops), just as they're per window when analyzing
+live.
+
+    python batch_analysis.py DIRECTORY [--workers N] [--output DIRECTORY]
+    python batch_analysis.py --benchmark  # Speedup vs. number of workers
+"""
+
+import multiprocessing as mp
+import os
+import queue
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import concurrency_tools as ct
+from data_generator import DataGenerator, event_dtype
+from recorders import EventRecorder, TraceLog, TraceRecorder
+from sorting import RectangleGate
+
+
+def plan_segments(log, segment_ms=1000, halo_ms=5 * DataGenerator.MAX_WIDTH):
+    """Split a TraceLog into segments for analyze_segment
+
+    Each segment is (start_ms, pieces, core_first, core_last): the time of
+    its first sample (halo included), (chunk, first, last) sample ranges
+    that make it up, and the range of its samples that are its core.
+    Segments never span a gap in the recording, and a run of signal is
+    never split into a segment shorter than half of 'segment_ms'.
+    """
+    dt = log.sampling_interval
+    segment = max(1, int(round(segment_ms / dt)))
+    halo = int(np.ceil(halo_ms / dt))
+
+    # Runs of chunks with no gap between them
+    runs, run_end_ms = [], None
+    for chunk, start_ms in enumerate(log.chunk_start_ms):
+        num_samples = int(log.chunk_samples[chunk])
+        if num_samples == 0:
+            continue
+        if run_end_ms is None or abs(start_ms - run_end_ms) >= dt / 2:
+            runs.append([])
+        runs[-1].append(chunk)
+        run_end_ms = start_ms + num_samples * dt
+
+    segments = []
+    for run in runs:
+        offsets = np.cumsum([0] + [int(log.chunk_samples[c]) for c in run])
+        cores = list(range(0, offsets[-1], segment)) + [offsets[-1]]
+        if len(cores) > 2 and cores[-1] - cores[-2] < segment / 2:
+            del cores[-2]  # Fold a short last segment into the one before
+        for core_start, core_stop in zip(cores[:-1], cores[1:]):
+            first = max(0, core_start - halo)
+            last = min(offsets[-1], core_stop + halo)
+            pieces = []
+            for i, chunk in enumerate(run):
+                a, b = max(first, offsets[i]), min(last, offsets[i + 1])
+                if a < b:
+                    pieces.append((chunk, a - offsets[i], b - offsets[i]))
+            start_ms = log.chunk_start_ms[run[0]] + first * dt
+            segments.append(
+                (float(start_ms), pieces, core_start - first, core_stop - first)
+            )
+    return segments
+
+
+class SegmentAnalyzer:
+    """Analyze segments of one recording; one of these per worker process"""
+
+    def __init__(
+        self,
+        directory,
+        thresh=None,
+        gate=None,
+        prominence_window=2 * DataGenerator.MAX_WIDTH,
+    ):
+        self.prominence_window = prominence_window
+        self.log = TraceLog(directory)
+        self.dg = DataGenerator(num_channels=self.log.num_channels)
+        if thresh is not None:
+            self.dg.set_thresh(thresh)
+        if gate is not None:
+            self.dg.sort_engine.set_gate(gate)
+        self._no_events = np.zeros(0, dtype=event_dtype(self.log.num_channels))
+
+    def analyze_segment(self, segment):
+        """Drop events whose timestamps fall in a plan_segments segment's core"""
+        start_ms, pieces, core_first, core_last = segment
+        dt = self.log.sampling_interval
+        signals = [self.log.chunk(chunk)[:, a:b] for chunk, a, b in pieces]
+        dg = self.dg
+        dg.signal = signals[0] if len(signals) == 1 else np.concatenate(signals, 1)
+        dg.window_start = start_ms
+        if len(dg.t) != dg.signal.shape[1]:
+            dg.t = np.arange(dg.signal.shape[1]) * dt
+        dg.events = self._no_events
+        dg._analyze_drops(
+            sampling_interval=dt, prominence_window=self.prominence_window
+        )
+        events = dg.events
+        left = np.rint((events["timestamp"] - start_ms) / dt)
+        return events[(left >= core_first) & (left < core_last)]
+
+
+def analyze_recording(
+    directory,
+    num_workers=None,
+    thresh=None,
+    gate=None,
+    segment_ms=1000,
+    halo_ms=5 * DataGenerator.MAX_WIDTH,
+    prominence_window=2 * DataGenerator.MAX_WIDTH,
+    output=None,
+):
+    """Drop events for a whole recording, analyzed by 'num_workers' processes
+
+    'thresh' and 'gate' are as for DataGenerator.set_thresh and
+    set_gate_values (DataGenerator's defaults if None). Returns the events
+    in timestamp order, with ids numbering them from 1 across the whole
+    recording; with 'output', they're also written there as an event log
+    (see recorders.EventLog).
+
+    'halo_ms' must be at least half of 'prominence_window' (in ms, see
+    DataGenerator._analyze_drops, but not None), and cover the widest drop
+    you expect. The worker processes are closed before this returns.
+    """
+    if prominence_window is None:
+        raise ValueError(
+            "'prominence_window' can't be None here: without one, drop widths "
+            "depend on where each segment starts and ends"
+        )
+    if halo_ms < prominence_window / 2:
+        raise ValueError("'halo_ms' must be at least 'prominence_window' / 2")
+    log = TraceLog(directory)
+    segments = plan_segments(log, segment_ms, halo_ms)
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    num_workers = max(1, min(num_workers, len(segments)))
+    # Start the workers at once; each takes a while to import scipy
+    starting = [
+        ct.ResultThread(
+            target=ct.ObjectInSubprocess,
+            args=(SegmentAnalyzer, directory, thresh, gate, prominence_window),
+        ).start()
+        for _ in range(num_workers)
+    ]
+    workers = []
+    try:
+        for th in starting:
+            workers.append(th.get_result())
+        # One thread per worker, each taking the next segment as it's free
+        todo = queue.SimpleQueue()
+        for i in range(len(segments)):
+            todo.put(i)
+        results = [None] * len(segments)
+
+        def work(worker):
+            while True:
+                try:
+                    i = todo.get_nowait()
+                except queue.Empty:
+                    return
+                results[i] = worker.analyze_segment(segments[i])
+
+        threads = [ct.ResultThread(target=work, args=(w,)).start() for w in workers]
+        for th in threads:
+            th.get_result()
+    finally:
+        for worker in workers:
+            ct._close(worker._)  # Now, rather than whenever they're collected
+
+    dtype = event_dtype(log.num_channels)
+    events = np.concatenate([np.zeros(0, dtype=dtype)] + results)
+    events = events[np.argsort(events["timestamp"], kind="stable")]
+    events["id"] = np.arange(1, len(events) + 1)
+    if output is not None:
+        metadata = {
+            "num_channels": log.num_channels,
+            "sampling_interval_ms": log.sampling_interval,
+            "source": os.path.abspath(directory),
+        }
+        recorder = EventRecorder(output, dtype, metadata)
+        recorder.append(events)
+        recorder.close()
+    return events
+
+
+def benchmark_batch_analysis(
+    worker_counts=None, signal_s=60, num_channels=2, directory=None
+):
+    """Speedup of analyze_recording vs. number of workers
+
+    Records 'signal_s' seconds of generated signal, then analyzes all of it
+    with each number of workers (by default 1, 2, 4, ... up to the number of
+    CPUs). "elapsed_s" includes starting the worker processes; "speedup" is
+    relative to analyzing the same segments one after another in this
+    process. Every worker count must find exactly the same drops.
+    """
+    if worker_counts is None:
+        cpus = os.cpu_count() or 1
+        worker_counts = sorted({2**i for i in range(cpus.bit_length())} | {cpus})
+    temporary = directory is None
+    if temporary:
+        directory = tempfile.mkdtemp(prefix="batch_analysis_")
+    try:
+        _record_generated_signal(directory, signal_s, num_channels)
+        log = TraceLog(directory)
+        analyzer = SegmentAnalyzer(directory)
+        t0 = time.perf_counter()
+        reference = np.concatenate(
+            [analyzer.analyze_segment(s) for s in plan_segments(log)]
+        )
+        single_process_s = time.perf_counter() - t0
+        reference["id"] = np.arange(1, len(reference) + 1)
+
+        results = {}
+        for num_workers in worker_counts:
+            t0 = time.perf_counter()
+            events = analyze_recording(directory, num_workers)
+            elapsed = time.perf_counter() - t0
+            assert np.array_equal(events, reference)
+            results[num_workers] = {
+                "elapsed_s": elapsed,
+                "samples_per_s": log.num_samples / elapsed,
+                "drops": len(events),
+                "speedup": single_process_s / elapsed,
+            }
+    finally:
+        if temporary:
+            shutil.rmtree(directory)
+    return {
+        "cpus": os.cpu_count(),
+        "signal_s": signal_s,
+        "samples": log.num_samples,
+        "single_process_s": single_process_s,
+        "workers": results,
+    }
+
+
+def _record_generated_signal(directory, signal_s, num_channels=2, **options):
+    """Record 'signal_s' seconds of DataGenerator signal (same every time)"""
+    dg = DataGenerator(num_channels=num_channels)
+    dg.start_trace_recording(directory, **options)
+    np.random.seed(0)
+    for _ in range(int(1000 * signal_s / dg.SIGNAL_DURATION)):
+        dg._generate_signal()
+        dg._trace_recorder.append(dg.window_start, dg.signal)
+    dg.stop_trace_recording()
+
+
+class TestBatchAnalysis(ct.MyTestClass):
+    """Run with: python batch_analysis.py --test"""
+
+    def test_sparse_segments_keep_their_events(self):
+        # One drop per 200 ms segment, and none at all in the last one
+        dt = DataGenerator.SAMPLING_INTERVAL
+        t = np.arange(0, 700, dt)
+        signal = np.random.default_rng(0).normal(0.005, 0.005, (2, len(t)))
+        centers = (100, 300, 450)
+        for center in centers:
+            signal += 0.5 * np.exp(-((t - center) ** 2) / (2 * (0.2 / 2.355) ** 2))
+        directory = tempfile.mkdtemp(prefix="batch_analysis_test_")
+        try:
+            recorder = TraceRecorder(directory, 2, dt)
+            recorder.append(0.0, signal)
+            recorder.close()
+            segments = plan_segments(TraceLog(directory), segment_ms=200)
+            assert len(segments) == 4
+            events = analyze_recording(directory, num_workers=2, segment_ms=200)
+            assert len(mp.active_children()) == 0  # The workers are closed
+            for options in ({"prominence_window": None}, {"halo_ms": 0.1}):
+                try:
+                    analyze_recording(directory, **options)
+                except ValueError as e:
+                    assert list(options)[0] in str(e), e
+                else:
+                    raise AssertionError("We didn't get the exception we expected")
+        finally:
+            shutil.rmtree(directory)
+        assert len(events) == len(centers), events
+        assert np.allclose(events["timestamp"], centers, atol=0.2)
+        assert np.all(events["density"] == 0)  # Too few drops for a KDE
+
+    def test_workers_match_one_process(self):
+        gate = RectangleGate("auc_1", "auc_2", (0, 1e5), (0, 1e5))
+        directory = tempfile.mkdtemp(prefix="batch_analysis_test_")
+        try:
+            # Chunks of 1.2 s, so segments straddle chunk boundaries too
+            _record_generated_signal(directory, 3, chunk_samples=60000)
+            log = TraceLog(directory)
+            whole = plan_segments(log, segment_ms=log.num_samples * 1e3, halo_ms=0)
+            assert len(whole) == 1
+            expected = SegmentAnalyzer(directory, gate=gate).analyze_segment(whole[0])
+            events = analyze_recording(
+                directory, num_workers=3, gate=gate, segment_ms=300
+            )
+        finally:
+            shutil.rmtree(directory)
+        assert len(events) == len(expected) > 2000
+        assert np.all(np.diff(events["timestamp"]) > 0)  # None twice
+        assert np.allclose(events["timestamp"], expected["timestamp"], rtol=0)
+        assert 0 < np.count_nonzero(events["sorted"]) < len(events)
+        # Baselines and densities are per segment; everything else matches
+        for name in ("width", "auc", "max_signal", "sorted"):
+            assert np.array_equal(events[name], expected[name]), name
+
+
+if __name__ == "__main__":
+    if "--test" in sys.argv:
+        TestBatchAnalysis().run()
+        sys.exit()
+    if "--benchmark" in sys.argv:
+        result = benchmark_batch_analysis()
+        print(
+            f"{result['signal_s']} s of signal ({result['samples']:,} samples) "
+            f"on {result['cpus']} CPUs; one process, no workers: "
+            f"{result['single_process_s']:.2f} s"
+        )
+        for num_workers, r in result["workers"].items():
+            print(
+                f"{num_workers:>3} workers: {r['elapsed_s']:.2f} s, "
+                f"{r['samples_per_s']:,.0f} samples/s, "
+                f"{r['speedup']:.2f}x ({r['drops']} drops)"
+            )
+    else:
+        # python batch_analysis.py DIRECTORY [--workers N] [--output DIRECTORY]
+        directory = sys.argv[1]
+        options = {}
+        if "--workers" in sys.argv:
+            options["num_workers"] = int(sys.argv[sys.argv.index("--workers") + 1])
+        if "--output" in sys.argv:
+            options["output"] = sys.argv[sys.argv.index("--output") + 1]
+        t0 = time.perf_counter()
+        events = analyze_recording(directory, **options)
+        print(
+            f"{len(events)} drops ({np.count_nonzero(events['sorted'])} sorted) "
+            f"in {time.perf_counter() - t0:.2f} s"
+        )
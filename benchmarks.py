@@ -0,0 +1,188 @@
+"""Throughput benchmarks for the data generator and drop analyzer.
+
+Sweeps drop rate, window length, channel count and threshold, one at a time
+around DataGenerator's defaults, and times each configuration three ways:
+generating a window (_generate_signal), analyzing it (_analyze_drops, split
+into its peak finding, baseline, features, sort and density steps), and the
+whole acquisition loop (_process_window). Writes a JSON report, and with
+--compare, prints how each number changed from an earlier report, e.g.:
+
+    python benchmarks.py --output before.json
+    ... change something ...
+    python benchmarks.py --output after.json --compare before.json
+
+Samples are per channel, so a window of 100 ms at 0.02 ms is 5000 samples
+however many channels there are.
+"""
+
+import argparse
+import functools
+import json
+import os
+import platform
+import sys
+import time
+
+import numpy as np
+import scipy
+
+from data_generator import DataGenerator
+
+DEFAULTS = {
+    "drop_interval_ms": DataGenerator.DROP_INTERVAL,
+    "window_ms": DataGenerator.SIGNAL_DURATION,
+    "num_channels": DataGenerator.NUM_CHANNELS,
+    "thresh": DataGenerator().thresh,
+}
+
+SWEEPS = {
+    "drop_interval_ms": (4, 2, 1, 0.5),
+    "window_ms": (25, 100, 400),
+    "num_channels": (2, 4, 8),
+    "thresh": (0.015, 0.03, 0.1),
+}
+
+
+def benchmark_config(
+    drop_interval_ms=DEFAULTS["drop_interval_ms"],
+    window_ms=DEFAULTS["window_ms"],
+    num_channels=DEFAULTS["num_channels"],
+    thresh=DEFAULTS["thresh"],
+    duration=1.0,
+    min_windows=3,
+):
+    """Time generating, analyzing, and the whole loop for one configuration
+
+    Each is repeated for at least 'duration' seconds and 'min_windows'
+    windows, after one window to warm up. Returns ms per window, samples/s
+    and drops/s for each, and ms per window for each step of the analysis.
+    """
+    dg = DataGenerator(num_channels=num_channels)
+    dg.set_thresh(thresh)
+    generate = functools.partial(
+        dg._generate_signal,
+        signal_duration=window_ms,
+        drop_interval=drop_interval_ms,
+    )
+    # _process_window generates with _generate_signal's defaults otherwise
+    dg._generate_signal = generate
+    np.random.seed(0)
+
+    def repeat(step):
+        step()  # Warm up (e.g. the cached drop shapes)
+        windows, drops, phases = 0, 0, {}
+        t0 = time.perf_counter()
+        while windows < min_windows or time.perf_counter() - t0 < duration:
+            previous_events = dg.events
+            step()
+            windows += 1
+            if dg.events is not previous_events:
+                drops += len(dg.events)
+            for phase, seconds in dg.analysis_timing.items():
+                phases[phase] = phases.get(phase, 0.0) + seconds
+        elapsed = time.perf_counter() - t0
+        samples = windows * dg.signal.shape[1]
+        return {
+            "windows": windows,
+            "ms_per_window": 1e3 * elapsed / windows,
+            "samples_per_s": samples / elapsed,
+            "drops_per_s": drops / elapsed,
+            "drops_per_window": drops / windows,
+        }, {phase: 1e3 * seconds / windows for phase, seconds in phases.items()}
+
+    generated, _ = repeat(generate)
+    generated.pop("drops_per_s")  # Nothing's analyzed
+    generated.pop("drops_per_window")
+    analyzed, phases_ms = repeat(dg._analyze_drops)
+    analyzed["phases_ms"] = phases_ms
+    end_to_end, _ = repeat(dg._process_window)
+    return {
+        "generate": generated,
+        "analyze": analyzed,
+        "end_to_end": end_to_end,
+    }
+
+
+def run(sweeps=SWEEPS, duration=1.0):
+    """benchmark_config for every value of every sweep; returns a report"""
+    results = []
+    for parameter, values in sweeps.items():
+        for value in values:
+            config = {**DEFAULTS, parameter: value}
+            results.append(
+                {
+                    "sweep": parameter,
+                    "config": config,
+                    **benchmark_config(**config, duration=duration),
+                }
+            )
+    return {
+        "created": time.time(),
+        "machine": {
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "cpus": os.cpu_count(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "scipy": scipy.__version__,
+        },
+        "results": results,
+    }
+
+
+def _key(result):
+    return result["sweep"], tuple(sorted(result["config"].items()))
+
+
+def _format_summary(report, baseline=None):
+    previous = {} if baseline is None else {_key(r): r for r in baseline["results"]}
+    lines = []
+    for r in report["results"]:
+        value = r["config"][r["sweep"]]
+        line = (
+            f"{r['sweep']:>16} = {value:<6} "
+            f"generate {r['generate']['ms_per_window']:7.2f} ms, "
+            f"analyze {r['analyze']['ms_per_window']:7.2f} ms "
+            f"({r['analyze']['drops_per_s']:9,.0f} drops/s), "
+            f"end to end {r['end_to_end']['samples_per_s']:11,.0f} samples/s"
+        )
+        before = previous.get(_key(r))
+        if before is not None:
+            speedups = []  # Above 1x is faster than before
+            for step in ("generate", "analyze", "end_to_end"):
+                speedup = before[step]["ms_per_window"] / r[step]["ms_per_window"]
+                speedups.append(f"{step} {speedup:.2f}x")
+            line += f" [{', '.join(speedups)}]"
+        lines.append(line)
+        phases = r["analyze"]["phases_ms"]
+        lines.append(
+            " " * 26
+            + ", ".join(f"{phase} {ms:.2f}" for phase, ms in phases.items())
+            + " ms"
+        )
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--output", default="benchmark_report.json")
+    parser.add_argument("--compare", help="an earlier report, to compare with")
+    parser.add_argument(
+        "--duration", type=float, default=1.0, help="seconds per measurement"
+    )
+    parser.add_argument(
+        "--sweep", choices=list(SWEEPS), action="append", help="only these sweeps"
+    )
+    args = parser.parse_args()
+
+    sweeps = SWEEPS if args.sweep is None else {s: SWEEPS[s] for s in args.sweep}
+    report = run(sweeps, duration=args.duration)
+    report["argv"] = sys.argv[1:]
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print(_format_summary(report, baseline))
+    print(f"Report written to {args.output}")
@@ -1,6 +1,8 @@
 # Multiprocessing to spread CPU load, threading for concurrency:
 import multiprocessing as mp
 import threading
+import queue
+from concurrent.futures import Future
 # Printing from a child process is tricky:
 import io
 from contextlib import redirect_stdout
@@ -325,6 +327,102 @@ class SharedNDArray(np.ndarray):
                 self.offset, self.strides, None)
         return (SharedNDArray, args)
 
+class MappedNDArray(np.ndarray):
+    """A numpy array that lives in a memory-mapped file on disk
+
+    Like SharedNDArray, but backed by a file instead of anonymous shared
+    memory, so it can be bigger than RAM (or /dev/shm) and it outlives
+    the process that made it. Pickling a MappedNDArray only sends the
+    file name, offset, shape, dtype and strides; the receiving process
+    maps the same file, so passing one to an ObjectInSubprocess is
+    zero-copy:
+
+        recording = MappedNDArray('trace.dat', shape=(2, 10**9),
+                                  dtype='float32', mode='w+')
+        camera.record(out=recording) # Writes go straight to the file
+        ...
+        recording = MappedNDArray('trace.dat', shape=(2, 10**9),
+                                  dtype='float32', mode='r')
+        analyzer.analyze(recording[:, :10**7]) # Also zero-copy
+
+    'mode' follows np.memmap: 'r' (read-only), 'r+' (read/write an
+    existing file) or 'w+' (create or overwrite). 'offset' is where the
+    array starts in the file, in bytes. If 'shape' is omitted when
+    reading, the rest of the file is viewed as a 1D array.
+
+    Unlike SharedNDArray, nothing is deleted when the array is garbage
+    collected; call 'flush' if you need the data on disk right away.
+    """
+    def __new__(cls, filename, shape=None, dtype=float, mode='r+',
+                offset=0, strides=None, order=None):
+        import os
+        import mmap
+        dtype = np.dtype(dtype)
+        if mode not in ('r', 'r+', 'w+'):
+            raise ValueError("mode must be one of 'r', 'r+', or 'w+'")
+        filename = os.path.abspath(os.fspath(filename))
+        if mode == 'w+':
+            if shape is None:
+                raise ValueError("shape must be given in 'w+' mode")
+            requested_bytes = np.prod(shape, dtype='uint64') * dtype.itemsize
+            with open(filename, 'w+b') as f:
+                f.truncate(offset + int(requested_bytes)) # Sparse if possible
+        with open(filename, 'rb' if mode == 'r' else 'r+b') as f:
+            file_bytes = os.fstat(f.fileno()).st_size
+            if shape is None:
+                shape = ((file_bytes - offset) // dtype.itemsize,)
+            if file_bytes == 0:
+                raise ValueError(f"Can't map the empty file {filename}")
+            access = mmap.ACCESS_READ if mode == 'r' else mmap.ACCESS_WRITE
+            mm = mmap.mmap(f.fileno(), 0, access=access)
+        obj = super(MappedNDArray, cls).__new__(
+            cls, shape, dtype, mm, offset, strides, order)
+        obj.mmap = mm
+        obj.filename = filename
+        obj.mode = mode
+        obj.offset = offset
+        return obj
+
+    def __array_finalize__(self, obj):
+        if obj is None:
+            return
+        if not isinstance(obj, MappedNDArray):
+            raise ValueError(
+                "You can't view non-mapped memory as mapped memory.")
+        if hasattr(obj, "mmap") and np.may_share_memory(self, obj):
+            self.mmap = obj.mmap
+            self.filename = obj.filename
+            self.mode = obj.mode
+            self.offset = obj.offset
+            self.offset += (self.__array_interface__["data"][0] -
+                             obj.__array_interface__["data"][0])
+
+    def __array_wrap__(self, arr, context=None):
+        arr = super().__array_wrap__(arr, context)
+        # Same logic as SharedNDArray.__array_wrap__
+        if self is arr or type(self) is not MappedNDArray:
+            return arr
+        if arr.shape == ():
+            return arr[()]
+        return arr.view(np.ndarray)
+
+    def __getitem__(self, index):
+        res = super().__getitem__(index)
+        if type(res) is MappedNDArray and not hasattr(res, "mmap"):
+            return res.view(type=np.ndarray)
+        return res
+
+    def __reduce__(self):
+        mode = 'r+' if self.mode == 'w+' else self.mode # Don't overwrite!
+        args = (self.filename, self.shape, self.dtype, mode,
+                self.offset, self.strides, None)
+        return (MappedNDArray, args)
+
+    def flush(self):
+        """Write any changes in the array to the file on disk."""
+        if self.mode != 'r':
+            self.mmap.flush()
+
 class ResultThread(threading.Thread):
     """threading.Thread with all the simple features we wish it had.
 
@@ -445,6 +543,320 @@ class CustodyThread(ResultThread):
         super().__init__(group, target, name, args, kwargs)
         self.custody = custody
 
+class CustodyExecutor:
+    """A fixed pool of threads that run 'custody' targets in submission order.
+
+    Launching one CustodyThread per data buffer is simple, but at high
+    buffer rates it means thousands of short-lived OS threads (and
+    eventually "can't start new thread"). A CustodyExecutor keeps
+    'max_workers' threads alive and reuses them:
+
+        with CustodyExecutor(max_workers=8) as executor:
+            futures = [executor.submit(timelapse, db, first_resource=camera)
+                       for db in data_buffers]
+            for f in futures:
+                f.result()
+
+    'submit' gets in line for 'first_resource' immediately, in the
+    submitting thread, exactly like CustodyThread(first_resource=...)
+    does. Items are handed to workers in the same order, so resources
+    are still used in launch order. If an item raises (or forgets to
+    release custody), its custody is released so the next-in-line
+    doesn't wait forever.
+
+    'max_workers' limits how many items can be in flight at once; make
+    it at least as large as the number of items you want to overlap
+    (e.g. the number of stages in your pipeline).
+    """
+    def __init__(self, max_workers=None, thread_name_prefix="CustodyExecutor"):
+        if max_workers is None:
+            import os
+            max_workers = min(32, (os.cpu_count() or 1) + 4)
+        if max_workers <= 0:
+            raise ValueError("max_workers must be greater than 0")
+        self._work_queue = queue.SimpleQueue()
+        self._submit_lock = threading.Lock()
+        self._shutdown = False
+        self._threads = []
+        for i in range(max_workers):
+            th = ResultThread(target=self._worker_loop,
+                              name=f"{thread_name_prefix}_{i}")
+            th.daemon = True # Don't let a forgotten executor block exit
+            self._threads.append(th.start())
+
+    def submit(self, target, *args, first_resource=None, **kwargs):
+        """Schedule target(*args, custody=..., **kwargs), return a Future.
+
+        The returned Future also has a 'custody' attribute, like
+        CustodyThread does.
+        """
+        if "custody" not in inspect.signature(target).parameters:
+            raise ValueError("The function 'target' passed to a CustodyExecutor"
+            " must accept an argument named 'custody'")
+        if "custody" in kwargs:
+            raise ValueError(
+                "CustodyExecutor will create and pass a keyword argument to"
+                " 'target' named 'custody', so keyword arguments to a"
+                " CustodyExecutor can't be named 'custody'")
+        custody = _Custody()
+        future = Future()
+        future.custody = custody
+        kwargs["custody"] = custody
+        # Getting in line and queueing the work must happen atomically, or
+        # two submitting threads could disagree about launch order:
+        with self._submit_lock:
+            if self._shutdown:
+                raise RuntimeError("Can't submit after shutdown")
+            if first_resource is not None:
+                custody.switch_from(None, first_resource, wait=False)
+            self._work_queue.put((future, target, args, kwargs))
+        return future
+
+    def shutdown(self, wait=True):
+        """Stop accepting work; workers exit once the queue is drained."""
+        with self._submit_lock:
+            if not self._shutdown:
+                self._shutdown = True
+                for th in self._threads:
+                    self._work_queue.put(None)
+        if wait:
+            for th in self._threads:
+                th.get_result()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown(wait=True)
+
+    def _worker_loop(self):
+        while True:
+            work_item = self._work_queue.get()
+            if work_item is None:
+                return
+            future, target, args, kwargs = work_item
+            custody = kwargs["custody"]
+            if not future.set_running_or_notify_cancel():
+                self._release(custody) # Step out of line for the next item
+                continue
+            try:
+                result = target(*args, **kwargs)
+            except BaseException as e:
+                self._release(custody) # Don't leave the next-in-line waiting
+                future.set_exception(e)
+            else:
+                self._release(custody)
+                future.set_result(result)
+
+    @staticmethod
+    def _release(custody):
+        # A failed release mustn't kill the worker, or skip resolving the
+        # future; every later submit() would wait forever.
+        try:
+            custody.release()
+        except Exception:
+            traceback.print_exc()
+
+class PipelineStage:
+    """One step of a Pipeline: a method of an ObjectInSubprocess, or a
+    local callable.
+
+    Each stage is called like func(buffer, *args, **kwargs).
+
+    resource -- an ObjectInSubprocess, or None for a local callable
+    func -- method name (string) if 'resource' is given, otherwise a callable
+    max_concurrency -- how many items can be in this stage at once. Stages
+        with a 'resource' can only do one at a time. Local stages default to
+        one at a time too (in launch order, like a resource); use an int > 1
+        or None (unlimited) for IO-bound local stages like saving to disk.
+    """
+    def __init__(self, func, resource=None, args=(), kwargs=None, name=None,
+                 max_concurrency=1):
+        if resource is not None:
+            if max_concurrency != 1:
+                raise ValueError("An ObjectInSubprocess can only run one "
+                                 "method at a time; use max_concurrency=1")
+            name = func if name is None else name
+            func = getattr(resource, func) # Look up the method only once
+        elif not callable(func):
+            raise ValueError("'func' must be callable if 'resource' is None")
+        if name is None:
+            name = getattr(func, "__name__", repr(func))
+        if max_concurrency is not None and max_concurrency < 1:
+            raise ValueError("max_concurrency must be None or >= 1")
+        if resource is None and max_concurrency == 1:
+            resource = _WaitingList() # Take turns, in launch order
+        self.func = func
+        self.resource = resource
+        self.args = args
+        self.kwargs = {} if kwargs is None else kwargs
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.semaphore = (
+            None if resource is not None or max_concurrency is None
+            else threading.BoundedSemaphore(max_concurrency))
+        self.stats_lock = threading.Lock()
+        self.num_items = 0
+        self.time_busy = 0
+        self.time_stalled = 0
+
+class Pipeline:
+    """Run data buffers through an ordered list of stages, concurrently.
+
+    This packages up the custody.switch_from() pattern from the example at
+    the top of this module:
+
+        pipeline = Pipeline(
+            [PipelineStage('record', camera, args=(fps,)),
+             PipelineStage('deconvolve', preprocessor),
+             PipelineStage('show', display),
+             PipelineStage('detect_motion', postprocessor),
+             PipelineStage(storage.save, max_concurrency=None)],
+            buffer_shape=shape, buffer_dtype='uint16', num_buffers=4)
+        futures = [pipeline.submit() for i in range(N)]
+        for f in futures:
+            f.result()
+        print(pipeline.stats())
+        pipeline.close()
+
+    Stages can also be given as (ObjectInSubprocess, 'method_name') tuples
+    or as plain local callables. Don't pass 'obj.method' of an
+    ObjectInSubprocess as a plain callable; the pipeline can't tell which
+    object it belongs to, so it can't take turns using it.
+
+    The pipeline owns 'num_buffers' SharedNDArrays; each item gets one
+    buffer for its whole trip through the stages. 'submit' blocks until a
+    buffer is free, so a fast producer can't outrun a slow stage
+    (backpressure). Items visit every one-at-a-time stage in submission
+    order, even if they pass through unlimited-concurrency stages on the
+    way. The future returned by 'submit' holds the last stage's return
+    value; don't return the buffer itself, since it gets reused.
+
+    'stats' reports how busy each stage is and how long items stalled
+    waiting for it; the stage with utilization closest to its concurrency
+    limit is your bottleneck.
+    """
+    def __init__(self, stages, buffer_shape, buffer_dtype=float,
+                 num_buffers=2):
+        if len(stages) == 0:
+            raise ValueError("A Pipeline needs at least one stage")
+        if num_buffers < 1:
+            raise ValueError("num_buffers must be at least 1")
+        self.stages = []
+        for stage in stages:
+            if isinstance(stage, tuple):
+                resource, method_name = stage
+                stage = PipelineStage(method_name, resource)
+            elif not isinstance(stage, PipelineStage):
+                stage = PipelineStage(stage)
+            self.stages.append(stage)
+        self._first_resource = next(
+            (st.resource for st in self.stages if st.resource is not None),
+            None)
+        self._free_buffers = queue.SimpleQueue()
+        for i in range(num_buffers):
+            self._free_buffers.put(SharedNDArray(buffer_shape, buffer_dtype))
+        self._executor = CustodyExecutor(
+            max_workers=num_buffers, thread_name_prefix="Pipeline")
+        self._start_time = None
+        self.time_waiting_for_buffers = 0
+
+    def submit(self, *args, **kwargs):
+        """Send one item through the pipeline; returns a Future.
+
+        Blocks until a buffer is free. 'args' and 'kwargs' are passed to
+        the first stage, after that stage's own args.
+        """
+        import time
+        t0 = time.perf_counter()
+        if self._start_time is None:
+            self._start_time = t0
+        data_buffer = self._free_buffers.get()
+        self.time_waiting_for_buffers += time.perf_counter() - t0
+        try:
+            return self._executor.submit(
+                self._run_item, data_buffer, args, kwargs,
+                first_resource=self._first_resource)
+        except BaseException:
+            self._free_buffers.put(data_buffer)
+            raise
+
+    def stats(self):
+        """Per-stage counters, in stage order.
+
+        'utilization' is the average number of items in the stage since
+        the first submit: 1.0 means a one-at-a-time stage never rested.
+        'time_stalled' is the total time items spent waiting to enter.
+        """
+        import time
+        elapsed = (0 if self._start_time is None
+                   else time.perf_counter() - self._start_time)
+        stats = []
+        for stage in self.stages:
+            with stage.stats_lock:
+                stats.append({
+                    "name": stage.name,
+                    "num_items": stage.num_items,
+                    "time_busy": stage.time_busy,
+                    "time_stalled": stage.time_stalled,
+                    "utilization": (
+                        stage.time_busy / elapsed if elapsed > 0 else 0),
+                    })
+        return stats
+
+    def close(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _run_item(self, data_buffer, first_args, first_kwargs, custody):
+        import time
+        try:
+            held = None # The resource we currently have custody of
+            result = None
+            for i, stage in enumerate(self.stages):
+                t0 = time.perf_counter()
+                if stage.resource is held:
+                    pass # Consecutive stages on the same resource
+                elif stage.resource is not None:
+                    custody.switch_from(held, to=stage.resource)
+                    held = stage.resource
+                else:
+                    # Keep our place in line for the next one-at-a-time
+                    # stage while we're in an unlimited stage:
+                    next_resource = next(
+                        (st.resource for st in self.stages[i+1:]
+                         if st.resource is not None), None)
+                    if held is not None or next_resource is not None:
+                        custody.switch_from(held, to=next_resource, wait=False)
+                    held = None
+                    if stage.semaphore is not None:
+                        stage.semaphore.acquire()
+                t1 = time.perf_counter()
+                args, kwargs = stage.args, stage.kwargs
+                if i == 0:
+                    args = (*args, *first_args)
+                    kwargs = {**kwargs, **first_kwargs}
+                try:
+                    result = stage.func(data_buffer, *args, **kwargs)
+                finally:
+                    if stage.semaphore is not None:
+                        stage.semaphore.release()
+                    t2 = time.perf_counter()
+                    with stage.stats_lock:
+                        stage.num_items += 1
+                        stage.time_busy += t2 - t1
+                        stage.time_stalled += t1 - t0
+            if held is not None:
+                custody.switch_from(held, to=None)
+            return result
+        finally:
+            self._free_buffers.put(data_buffer)
+
 _original_threading_excepthook = threading.excepthook
 
 def _my_threading_excepthook(args):
@@ -466,7 +878,7 @@ PoliteThread = CustodyThread
 class ObjectInSubprocess:
     def __init__(self, initializer, *initargs, custom_loop=None,
                  close_method_name=None, closeargs=None, closekwargs=None,
-                 **initkwargs):
+                 cpu_affinity=None, nice=None, **initkwargs):
         """Make an object in a child process, that acts like it isn't.
 
         As much as possible, we try to make instances of ObjectInSubprocess
@@ -482,16 +894,35 @@ class ObjectInSubprocess:
         close_method_name -- string, optional, name of our object's method to
             be called automatically when the child process exits
         closeargs, closekwargs -- arguments to 'close_method'
+        cpu_affinity -- optional set of CPU numbers the child process may run
+            on (Linux only; see 'disjoint_cpu_sets')
+        nice -- optional niceness of the child process (Unix only; higher
+            is politer, lower than the parent's usually needs privileges)
+
+        'cpu_affinity' and 'nice' are applied in the child before
+        'initializer' runs, so any threads the object starts inherit them.
         """
         # Put an instance of the Python object returned by 'initializer'
         # in a child process:
         parent_pipe, child_pipe = mp.Pipe()
         child_loop = _child_loop if custom_loop is None else custom_loop
+        child_args = (child_pipe, initializer, initargs, initkwargs,
+                      close_method_name, closeargs, closekwargs)
+        if cpu_affinity is not None or nice is not None:
+            import os
+            if cpu_affinity is not None and not hasattr(
+                    os, "sched_setaffinity"):
+                raise NotImplementedError(
+                    "'cpu_affinity' needs os.sched_setaffinity (Linux only)")
+            if nice is not None and not hasattr(os, "setpriority"):
+                raise NotImplementedError(
+                    "'nice' needs os.setpriority (Unix only)")
+            child_args = (cpu_affinity, nice, child_loop, child_args)
+            child_loop = _child_loop_with_scheduling
         child_process = mp.Process(
             target=child_loop,
             name=initializer.__name__,
-            args=(child_pipe, initializer, initargs, initkwargs,
-                  close_method_name, closeargs, closekwargs))
+            args=child_args)
         # Attribute-setting looks weird here because we override __setattr__,
         # and because we use a dummy object's namespace to hold our attributes
         # so we shadow as little of the object's namespace as possible:
@@ -559,6 +990,52 @@ def _close(dummy_namespace):
         dummy_namespace.child_process.join()
         dummy_namespace.parent_pipe.close()
 
+def _child_loop_with_scheduling(cpu_affinity, nice, child_loop, child_args):
+    """Set the child's CPU affinity and niceness, then run its event loop.
+
+    Wrapping the loop (instead of adding arguments to it) keeps
+    'custom_loop' functions working unchanged.
+    """
+    import os
+    try:
+        if cpu_affinity is not None:
+            os.sched_setaffinity(0, cpu_affinity)
+        if nice is not None:
+            os.setpriority(os.PRIO_PROCESS, 0, nice)
+    except Exception as e: # Report it like a failed initialization
+        e.child_traceback_string = traceback.format_exc()
+        child_pipe = child_args[0]
+        child_pipe.send((e, ''))
+        return None
+    return child_loop(*child_args)
+
+def disjoint_cpu_sets(num_sets, cpus_per_set=1, exclude=()):
+    """Split the CPUs we're allowed to use into non-overlapping sets.
+
+    Useful for pinning the stages of a pipeline to their own cores, so
+    timing-sensitive children (like a Camera) don't get bumped around by
+    their siblings or by the parent:
+
+        cpus = disjoint_cpu_sets(3, exclude={0}) # Leave CPU 0 for the parent
+        camera = ObjectInSubprocess(Camera, cpu_affinity=cpus[0])
+        preprocessor = ObjectInSubprocess(Preprocessor, cpu_affinity=cpus[1])
+        display = ObjectInSubprocess(Display, cpu_affinity=cpus[2])
+
+    Raises a ValueError if there aren't enough CPUs to go around.
+    """
+    import os
+    if hasattr(os, "sched_getaffinity"):
+        available = sorted(os.sched_getaffinity(0))
+    else:
+        available = list(range(os.cpu_count() or 1))
+    available = [c for c in available if c not in set(exclude)]
+    if num_sets * cpus_per_set > len(available):
+        raise ValueError(
+            f"Can't make {num_sets} sets of {cpus_per_set} CPUs from the "
+            f"{len(available)} available CPUs: {available}")
+    return [set(available[i*cpus_per_set:(i+1)*cpus_per_set])
+            for i in range(num_sets)]
+
 def _child_loop(child_pipe, initializer, initargs, initkwargs,
                 close_method_name, closeargs, closekwargs):
     """The event loop of a ObjectInSubprocess's child process"""
@@ -615,11 +1092,13 @@ class _WaitingList:
     _WaitingList-like objects that can interact with
     _Custody.switch_from() and _Custody._wait_in_line(), make sure they have
     a waiting_list = [] attribute, and a waiting_list_lock =
-    threading.Lock() attribute.
+    threading.Lock() attribute. A 'deadline_misses' attribute is optional;
+    if it's there, _Custody counts late arrivals in it.
     """
     def __init__(self):
         self.waiting_list = [] # Switch to a queue/deque if speed really matters
         self.waiting_list_lock = threading.Lock()
+        self.deadline_misses = 0
 
     def __enter__(self):
         self.waiting_list_lock.acquire()
@@ -678,19 +1157,46 @@ class _Custody:
         self.permission_slip.acquire()
         self.has_custody = False
         self.target_resource = None
+        self.priority = 0
+        self.deadline = None
+        self.deadline_misses = 0
+        self.lateness = 0
 
-    def switch_from(self, resource, to=None, wait=True):
+    def switch_from(self, resource, to=None, wait=True,
+                    priority=None, deadline=None):
         """Get in line for a shared resource, then abandon your current resource
 
         If wait==True, also wait in that line until it's your turn to
         own the next shared resource.
+
+        By default the line is first-come, first-served. If you pass a
+        'priority' (a number, default 0), you cut ahead of everyone waiting
+        with a lower priority, but behind everyone with the same or higher
+        priority. Nobody cuts ahead of whoever currently has custody.
+        Passing 'priority' when you're already in line moves you.
+
+        'deadline' is a time.perf_counter() value. It doesn't change your
+        place in line, but if you get custody after it, we count a deadline
+        miss on this custody object and on the resource's _WaitingList, and
+        store how late you were in 'lateness'. A deadline set while getting
+        in line early (wait=False) is kept when you come back to wait.
         """
         assert resource is not None or to is not None
         if to is not None:
             to_waiting_list, to_waiting_list_lock = _get_list_and_lock(to)
             with to_waiting_list_lock: # Get in the line for the next lock...
                 if self not in to_waiting_list: # ...unless you're already in it
-                    to_waiting_list.append(self)
+                    self.priority = 0 if priority is None else priority
+                    self.deadline = deadline
+                    self._get_in_line(to_waiting_list)
+                else:
+                    if (priority is not None and priority != self.priority and
+                        to_waiting_list[0] is not self):
+                        to_waiting_list.remove(self)
+                        self.priority = priority
+                        self._get_in_line(to_waiting_list)
+                    if deadline is not None:
+                        self.deadline = deadline
         if resource is not None:
             assert self.has_custody
             waiting_list, waiting_list_lock = _get_list_and_lock(resource)
@@ -722,7 +1228,24 @@ class _Custody:
                 return
             waiting_list, waiting_list_lock = _get_list_and_lock(self.target_resource)
             with waiting_list_lock:
-                waiting_list.remove(self)
+                if self in waiting_list:
+                    was_first = waiting_list[0] is self
+                    waiting_list.remove(self)
+                    if was_first and len(waiting_list) > 0:
+                        # We were called but never showed up; call the next one
+                        waiting_list[0].permission_slip.release()
+            self.target_resource = None
+
+    def _get_in_line(self, waiting_list):
+        """Insert ourselves behind everyone with the same or higher priority.
+
+        The caller must hold the waiting list's lock.
+        """
+        position = len(waiting_list)
+        while (position > 1 and # Never cut ahead of the current custodian
+               waiting_list[position - 1].priority < self.priority):
+            position -= 1
+        waiting_list.insert(position, self)
 
     def _wait_in_line(self):
         """Wait in line until it's your turn."""
@@ -735,6 +1258,22 @@ class _Custody:
             self.permission_slip.release() # We arrived to an empty waiting list
         self.permission_slip.acquire() # Blocks if we're not first in line
         self.has_custody = True
+        if self.deadline is not None:
+            self._check_deadline()
+
+    def _check_deadline(self):
+        import time
+        lateness = time.perf_counter() - self.deadline
+        if lateness <= 0:
+            return
+        self.deadline_misses += 1
+        self.lateness = lateness
+        resource = self.target_resource
+        if isinstance(resource, ObjectInSubprocess):
+            resource = resource._.waiting_list
+        if hasattr(resource, "deadline_misses"):
+            with resource.waiting_list_lock:
+                resource.deadline_misses += 1
 
 # When an exception from a child process isn't handled by the parent
 # process, we'd like the parent to print the child traceback. Overriding
@@ -1085,6 +1624,163 @@ class TestResultThreadAndCustodyThread(MyTestClass):
         # th2.get_result() # Not going to bother with the exception
         th3.get_result() # Thread 3 can now get custody
 
+    def test_custody_executor_order(self):
+        """CustodyExecutor reuses a few threads but keeps launch order."""
+        import time
+        camera_lock = _WaitingList()
+        display_lock = _WaitingList()
+        num_snaps = 100
+        usage_record = {'camera': [], 'display': [], 'threads': set()}
+        def snap(i, custody):
+            custody.switch_from(None, camera_lock)
+            time.sleep(0.001)
+            usage_record['camera'].append(i)
+            custody.switch_from(camera_lock, display_lock)
+            time.sleep(0.002)
+            usage_record['display'].append(i)
+            custody.switch_from(display_lock, None)
+            usage_record['threads'].add(threading.get_ident())
+            return i
+        with CustodyExecutor(max_workers=4) as executor:
+            futures = [executor.submit(snap, i, first_resource=camera_lock)
+                       for i in range(num_snaps)]
+            results = [f.result() for f in futures]
+        assert results == list(range(num_snaps))
+        assert usage_record['camera'] == list(range(num_snaps))
+        assert usage_record['display'] == list(range(num_snaps))
+        assert len(usage_record['threads']) <= 4
+
+    def test_custody_executor_releases_custody(self):
+        resource = _WaitingList()
+        def f(custody, raise_exception=False):
+            custody.switch_from(None, resource)
+            if raise_exception:
+                raise ValueError("This exception was raised on purpose!")
+            return # Forgot to release custody, on purpose!
+        executor = CustodyExecutor(max_workers=2)
+        f1 = executor.submit(f, first_resource=resource)
+        f2 = executor.submit(f, raise_exception=True, first_resource=resource)
+        f3 = executor.submit(f, first_resource=resource)
+        assert hasattr(f3, 'custody'), 'Should have a custody attribute.'
+        f1.result(timeout=1)
+        try:
+            f2.result(timeout=1)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("We didn't get the exception we expected...")
+        f3.result(timeout=1) # Would time out if custody wasn't released
+        executor.shutdown()
+        assert len(resource.waiting_list) == 0
+        try:
+            executor.submit(f, first_resource=resource)
+        except RuntimeError:
+            pass # We expect this
+        else:
+            raise AssertionError("We didn't get the exception we expected...")
+        with CustodyExecutor(max_workers=1) as executor:
+            try:
+                executor.submit(lambda: 1)
+            except ValueError:
+                pass # We expect this
+            else:
+                raise AssertionError(
+                    "We didn't get the exception we expected...")
+
+    def test_custody_executor_target_releases_and_raises(self):
+        """A target that releases custody itself, then raises."""
+        resource = _WaitingList()
+        def f(custody, fail=True):
+            if not fail:
+                return 'ok'
+            try:
+                raise ValueError("This exception was raised on purpose!")
+            except ValueError:
+                custody.release() # Still in line; we never waited
+                raise
+        with CustodyExecutor(max_workers=1) as executor:
+            f1 = executor.submit(f, first_resource=resource)
+            try:
+                f1.result(timeout=1)
+            except ValueError:
+                pass
+            else:
+                raise AssertionError(
+                    "We didn't get the exception we expected...")
+            assert f1.custody.target_resource is None
+            f2 = executor.submit(f, fail=False, first_resource=resource)
+            assert f2.result(timeout=1) == 'ok' # The worker's still alive
+        assert len(resource.waiting_list) == 0
+        f1.custody.release() # Releasing again does nothing
+
+    def test_custody_priority(self):
+        """Higher priority waiters cut in line, equal priorities stay FIFO."""
+        resource = _WaitingList()
+        holder = _Custody()
+        holder.switch_from(None, resource)
+        order = []
+        def f(name, custody):
+            custody.switch_from(None, resource)
+            order.append(name)
+            custody.switch_from(resource, None)
+        waiters = [('batch 1', None), ('batch 2', None), ('ui 1', 5),
+                   ('batch 3', 0), ('ui 2', 5), ('urgent', 10)]
+        threads = []
+        for name, priority in waiters:
+            th = CustodyThread(target=f, args=(name,))
+            th.custody.switch_from(None, resource, wait=False,
+                                   priority=priority)
+            threads.append(th)
+        assert resource.waiting_list[0] is holder
+        for th in threads:
+            th.start()
+        holder.switch_from(resource, None)
+        for th in threads:
+            th.get_result()
+        assert order == [
+            'urgent', 'ui 1', 'ui 2', 'batch 1', 'batch 2', 'batch 3'], order
+        # Changing priority while in line moves you:
+        holder.switch_from(None, resource)
+        a, b = _Custody(), _Custody()
+        a.switch_from(None, resource, wait=False)
+        b.switch_from(None, resource, wait=False)
+        b.switch_from(None, resource, wait=False, priority=1)
+        assert resource.waiting_list == [holder, b, a]
+        holder.switch_from(resource, None)
+        b.switch_from(None, resource)
+        b.switch_from(resource, None)
+        a.release()
+
+    def test_custody_deadline_misses(self):
+        import time
+        resource = _WaitingList()
+        holder, on_time, late = _Custody(), _Custody(), _Custody()
+        holder.switch_from(None, resource)
+        now = time.perf_counter()
+        on_time.switch_from(None, resource, wait=False, deadline=now + 100)
+        late.switch_from(None, resource, wait=False, deadline=now + 0.01)
+        time.sleep(0.02)
+        holder.switch_from(resource, None)
+        on_time.switch_from(None, resource)
+        on_time.switch_from(resource, None)
+        late.switch_from(None, resource)
+        late.switch_from(resource, None)
+        assert on_time.deadline_misses == 0
+        assert late.deadline_misses == 1
+        assert late.lateness >= 0.01
+        assert resource.deadline_misses == 1
+
+    def test_custody_release_while_first_in_line(self):
+        resource = _WaitingList()
+        c1, c2 = _Custody(), _Custody()
+        c1.switch_from(None, resource, wait=False)
+        c2.switch_from(None, resource, wait=False)
+        c1.release() # c1 never showed up; c2 shouldn't wait forever
+        th = ResultThread(target=c2.switch_from, args=(None, resource)).start()
+        th.get_result(timeout=1)
+        assert c2.has_custody
+        c2.release()
+
 
 class TestSharedNDArray(MyTestClass):
     """Various tests of the SharedNDArray class"""
@@ -1258,6 +1954,77 @@ class TestSharedNDArray(MyTestClass):
         assert expected_total == reloaded_total, \
             f'Failed {dtype.name}/{original_dimensions}/{slicer}'
 
+class TestMappedNDArray(MyTestClass):
+    """Various tests of the MappedNDArray class"""
+    def run(self, *args, **kwargs):
+        from tempfile import TemporaryDirectory
+        with TemporaryDirectory() as self.tmpdir:
+            return super().run(*args, **kwargs)
+
+    def _filename(self, name='a.dat'):
+        import os
+        return os.path.join(self.tmpdir, name)
+
+    def test_subclassed_numpy_array_types(self):
+        a = MappedNDArray(self._filename(), shape=(1,), mode='w+')
+        assert isinstance(a, MappedNDArray)
+        assert isinstance(a, np.ndarray)
+        assert not isinstance(a, SharedNDArray)
+        assert type(a.sum()) is not MappedNDArray
+        assert type(a + 1) is np.ndarray
+        a = np.zeros(shape=(1,))
+        try:
+            a.view(MappedNDArray)
+        except ValueError:
+            pass # we expected this
+        else:
+            raise AssertionError("We didn't raise the correct exception!")
+
+    def test_data_persists_in_file(self):
+        import gc
+        filename = self._filename()
+        a = MappedNDArray(filename, shape=(3, 100), dtype='uint16', mode='w+',
+                          offset=16)
+        a[:] = np.arange(300, dtype='uint16').reshape(3, 100)
+        a.flush()
+        del a
+        gc.collect()
+        b = MappedNDArray(filename, shape=(3, 100), dtype='uint16', mode='r',
+                          offset=16)
+        assert np.array_equal(b, np.arange(300).reshape(3, 100))
+        c = MappedNDArray(filename, dtype='uint16', mode='r', offset=16)
+        assert c.shape == (300,)
+        try:
+            b[0, 0] = 1
+        except ValueError:
+            pass # Read-only
+        else:
+            raise AssertionError("We didn't raise the correct exception!")
+
+    def test_serialization(self):
+        import pickle
+        a = MappedNDArray(self._filename(), shape=(3, 3, 256, 256),
+                          dtype='uint8', mode='w+')
+        a[:] = np.random.randint(0, 255, a.shape, dtype='uint8')
+        view_by_slice = a[:1, 2:3, :10, 100:-100]
+        view_of_a_view = view_by_slice[..., 1:, 10:-10:3]
+        for x in (a, view_by_slice, view_of_a_view):
+            _x = pickle.loads(pickle.dumps(x))
+            assert type(_x) is MappedNDArray
+            assert _x.filename == x.filename and _x.offset == x.offset
+            assert np.array_equal(x, _x)
+            assert len(pickle.dumps(x)) < 1000, 'Should not copy data'
+
+    def test_passing_to_subprocess(self):
+        p = ObjectInSubprocess(TestObjectInSubprocess.TestClass)
+        a = MappedNDArray(self._filename(), shape=(10, 10), dtype=int,
+                          mode='w+')
+        a.fill(0)
+        _a = p.fill_and_return_array(a[2:5], 3)
+        assert isinstance(_a, MappedNDArray)
+        assert a[2:5].sum() == 3 * 30 == a.sum(), 'Child should write to file'
+        assert p.sum(a) == a.sum()
+
 class TestObjectInSubprocess(MyTestClass):
     class TestClass:
         """Toy class that can be put in a subprocess for testing."""
@@ -1299,6 +2066,10 @@ class TestObjectInSubprocess(MyTestClass):
         def store_array(self, a):
             self.a = a
 
+        def get_scheduling(self):
+            import os
+            return os.sched_getaffinity(0), os.getpriority(os.PRIO_PROCESS, 0)
+
         def nested_method(self, crash=False):
             self._nested_method(crash)
 
@@ -1326,6 +2097,41 @@ class TestObjectInSubprocess(MyTestClass):
         child_process.join(timeout=1)
         assert not child_process.is_alive()
 
+    def test_cpu_affinity_and_nice(self):
+        import os
+        if not hasattr(os, 'sched_setaffinity'):
+            return # Linux only
+        cpus = disjoint_cpu_sets(1)
+        niceness = max(os.getpriority(os.PRIO_PROCESS, 0), 5)
+        p = ObjectInSubprocess(TestObjectInSubprocess.TestClass,
+                               cpu_affinity=cpus[0], nice=niceness, x=4)
+        assert p.x == 4
+        assert p.get_scheduling() == (cpus[0], niceness)
+        try:
+            ObjectInSubprocess(TestObjectInSubprocess.TestClass,
+                               cpu_affinity={4000}) # Too big!
+        except OSError:
+            pass # The child couldn't set its affinity, and told us so
+        else:
+            raise AssertionError('Did not get the error we expected')
+
+    def test_disjoint_cpu_sets(self):
+        import os
+        num_cpus = (len(os.sched_getaffinity(0))
+                    if hasattr(os, 'sched_getaffinity') else os.cpu_count())
+        sets = disjoint_cpu_sets(num_cpus)
+        assert len(sets) == num_cpus
+        assert len(set.union(*sets)) == num_cpus, 'Sets should not overlap'
+        first_cpu = min(sets[0])
+        assert all(first_cpu not in s
+                   for s in disjoint_cpu_sets(num_cpus - 1, exclude={first_cpu}))
+        try:
+            disjoint_cpu_sets(num_cpus + 1)
+        except ValueError:
+            pass # We expect this
+        else:
+            raise AssertionError('Did not get the error we expected')
+
     def test_passing_normal_numpy_array(self):
         a = np.zeros((3, 3), dtype=int)
         p = ObjectInSubprocess(TestObjectInSubprocess.TestClass)
@@ -1430,6 +2236,91 @@ class TestObjectInSubprocess(MyTestClass):
                                   name=name)
         print(f' {t_per_loop:.2f} \u03BCs per {name}')
 
+    def test_pipeline(self):
+        """Run buffers through subprocess and local stages."""
+        import time
+        filler = ObjectInSubprocess(TestObjectInSubprocess.TestClass)
+        summer = ObjectInSubprocess(TestObjectInSubprocess.TestClass)
+        def slow_local_stage(a):
+            time.sleep(0.01)
+        pipeline = Pipeline(
+            [PipelineStage('fill_and_return_array', filler, args=(1,)),
+             PipelineStage(slow_local_stage, max_concurrency=None),
+             (summer, 'black_hole'),
+             (summer, 'sum')],
+            buffer_shape=(100, 100), buffer_dtype='uint8', num_buffers=3)
+        with pipeline:
+            futures = [pipeline.submit() for i in range(20)]
+            assert [f.result() for f in futures] == [100 * 100] * 20
+        stats = pipeline.stats()
+        assert [s['name'] for s in stats] == [
+            'fill_and_return_array', 'slow_local_stage', 'black_hole', 'sum']
+        assert all(s['num_items'] == 20 for s in stats)
+        assert all(s['utilization'] > 0 for s in stats)
+
+    def test_pipeline_backpressure(self):
+        """A slow last stage should make submit() wait for free buffers."""
+        import time
+        num_items, num_buffers, stage_s = 10, 2, 0.02
+        submitted, finished = [], {}
+        def label(a, i):
+            a[0] = i
+        def slow_last_stage(a):
+            time.sleep(stage_s)
+            finished[int(a[0])] = time.perf_counter() # Just before release
+        with Pipeline([label, slow_last_stage], buffer_shape=(1,),
+                      num_buffers=num_buffers) as pipeline:
+            futures = []
+            for i in range(num_items):
+                futures.append(pipeline.submit(i))
+                submitted.append(time.perf_counter())
+            [f.result() for f in futures]
+        # Item i can only get a buffer once item i - num_buffers is done:
+        for i in range(num_buffers, num_items):
+            assert submitted[i] > finished[i - num_buffers], i
+        # ...so submit() waits about one slow stage per extra item:
+        expected_s = (num_items - num_buffers) * stage_s
+        assert pipeline.time_waiting_for_buffers > 0.8 * expected_s, (
+            pipeline.time_waiting_for_buffers, expected_s)
+
+    def test_pipeline_keeps_launch_order(self):
+        """Items should leave an unordered stage and queue up in order."""
+        import random
+        import time
+        resource_order = []
+        def label(a, i):
+            a[0] = i
+        def jittery(a):
+            time.sleep(random.random() * 0.01)
+        def record(a):
+            resource_order.append(int(a[0]))
+        with Pipeline([label,
+                       PipelineStage(jittery, max_concurrency=None),
+                       record],
+                      buffer_shape=(1,), num_buffers=8) as pipeline:
+            futures = [pipeline.submit(i) for i in range(50)]
+            [f.result() for f in futures]
+        assert resource_order == list(range(50))
+
+    def test_pipeline_exception(self):
+        """A failing item shouldn't stall the items behind it."""
+        def maybe_fail(a, fail):
+            if fail:
+                raise ValueError("This exception was raised on purpose!")
+            return 'ok'
+        with Pipeline([maybe_fail, lambda a: 'done'],
+                      buffer_shape=(1,), num_buffers=2) as pipeline:
+            futures = [pipeline.submit(i == 1) for i in range(5)]
+            try:
+                futures[1].result(timeout=1)
+            except ValueError:
+                pass
+            else:
+                raise AssertionError(
+                    "We didn't get the exception we expected...")
+            for i in (0, 2, 3, 4):
+                assert futures[i].result(timeout=1) == 'done'
+
     def test_lock_with_waitlist(self):
         """Test that CustodyThreads stay in order while using resources.
         ObjectsInSubprocess are just mocked as _WaitingList objects.
@@ -1534,6 +2425,7 @@ class TestObjectInSubprocess(MyTestClass):
 if __name__ == "__main__":
     TestResultThreadAndCustodyThread().run()
     TestSharedNDArray().run()
+    TestMappedNDArray().run()
     TestObjectInSubprocess().run()
     # Test the childprocess is stopped when the script completed
     # with a reference to the object:
@@ -1,14 +1,67 @@
 import numpy as np
 import threading
+import collections
+import sys
+import time
 import concurrency_tools as ct
+from recorders import EventRecorder, TraceLog, TraceRecorder, TraceReplay
+from sorting import SortEngine
 
 from scipy.signal import find_peaks, peak_widths
 from scipy.integrate import simps
 from scipy.stats import gaussian_kde
 
 
+def event_dtype(num_channels=2):
+    """One record per drop (45 bytes, for 2 channels)
+
+    Per-channel features have a channel axis, e.g. events["auc"][:, 0] is
+    channel 1's AUC for every drop (a view, not a copy). A batch of events is
+    one contiguous array, so it pickles (or goes into shared memory) as a
+    single buffer.
+    """
+    return np.dtype(
+        [
+            ("id", np.int32),  # Within its window, from 1
+            ("timestamp", np.float64),  # ms since acquisition started
+            ("width", np.float32),  # ms, FWHM in the detection channel
+            ("auc", np.float32, (num_channels,)),
+            ("max_signal", np.float32, (num_channels,)),
+            ("baseline", np.float32, (num_channels,)),
+            ("density", np.float32),  # Of log(AUC), for the density scatter plot
+            ("sorted", np.bool_),  # The sort engine's decision
+        ]
+    )
+
+
+def event_features(events):
+    """Named feature columns of drop events, as used by sorting gates
+
+    Per-channel features are named by channel, from 1: "auc_1", "auc_2", ...
+    """
+    features = {"width": events["width"]}
+    for name in ("auc", "max_signal"):
+        for channel in range(events.dtype[name].shape[0]):
+            features[f"{name}_{channel + 1}"] = events[name][:, channel]
+    return features
+
+
+class _Stopwatch:
+    """Time spent in named phases, each lap adding to its phase's total (s)"""
+
+    def __init__(self):
+        self.phases = {}
+        self._last = time.perf_counter()
+
+    def lap(self, phase):
+        now = time.perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0.0) + now - self._last
+        self._last = now
+
+
 class DataGenerator:
     NUM_CHANNELS = 2
+    SCATTER_CHANNELS = (1, 2)  # The channels whose AUCs the density is of
     SAMPLING_INTERVAL = 0.02  # time units in ms
     SIGNAL_DURATION = 100
     BASELINE = 0.01
@@ -18,16 +71,36 @@ class DataGenerator:
     BASELINE_CV = 0.01
     MIN_WIDTH = 0.1
     MAX_WIDTH = 1
+    SNAPSHOT_HISTORY = 100  # windows of drop events kept for get_snapshot
 
     """ Initialization """
 
-    def __init__(self):
-        self.data = {"pmt1": {"x": [0], "y": [0]}, "pmt2": {"x": [0], "y": [0]}}
-        self.data2d = {"x": [0], "y": [0], "density": [0]}
+    def __init__(self, num_channels=NUM_CHANNELS):
+        # Signals are channel-major: one row per channel, one column per sample
+        self.num_channels = num_channels
+        self.t = np.zeros(1)  # ms, from the start of the window
+        self.window_start = 0.0  # ms since acquisition started
+        self._next_window_start = 0.0
+        self.signal = np.zeros((num_channels, 1))
+        self.events = np.zeros(0, dtype=event_dtype(num_channels))
+        self.analysis_timing = {}  # The last _analyze_drops' steps, in s
         self._generate = False
-        self.gain = [0.5, 0.5]
+        self.gain = [0.5] * num_channels
         self.thresh = 0.03
         self.gate_val = {"x0": [0], "y0": [0], "x1": [0], "y1": [0]}
+        self.sort_engine = SortEngine()
+        self.sort_engine.set_gate(self.gate_val)
+
+        # Finished windows, published for get_snapshot
+        self._snapshot_lock = threading.Lock()
+        self.window_seq = 0
+        self._traces = {"t": self.t, "signal": self.signal}
+        self._recent_events = collections.deque(maxlen=self.SNAPSHOT_HISTORY)
+        self._event_recorder = None
+        self._trace_recorder = None
+        # Held while a recorder is used, so stopping it can't close it mid-use
+        self._recorder_lock = threading.Lock()
+        self._replay = None  # Signals come from here instead, if it's set
 
     """ Start, Stop, Continue Methods to Run in the Background """
 
@@ -45,14 +118,85 @@ class DataGenerator:
         while True:
             if not self._generate:
                 return
-            self._generate_signal()
-            self._analyze_drops()
+            if not self._process_window():
+                self._generate = False  # The replay is over
+                return
+
+    def _process_window(self):
+        """Get, record, analyze and publish one window; False if there's none"""
+        if not self._next_window():
+            return False
+        with self._recorder_lock:
+            recorder = self._trace_recorder
+            if recorder is not None:
+                recorder.append(self.window_start, self.signal)
+        previous_events = self.events
+        t0 = time.perf_counter()
+        self._analyze_drops()
+        if self._replay is not None:
+            self._replay_analysis_s += time.perf_counter() - t0
+        new_events = self.events if self.events is not previous_events else None
+        self._publish_window(new_events)
+        with self._recorder_lock:
+            recorder = self._event_recorder
+            if recorder is not None and new_events is not None:
+                recorder.append(new_events)
+        return True
+
+    def _publish_window(self, new_events=None):
+        """Make the latest window available to get_snapshot"""
+        with self._snapshot_lock:
+            self.window_seq += 1
+            # _generate_signal replaces (never mutates) the signal array, so
+            # this is a consistent snapshot of this window:
+            self._traces = {"t": self.t, "signal": self.signal}
+            if new_events is not None:
+                self._recent_events.append((self.window_seq, new_events))
+
+    def get_snapshot(self, since_seq=None):
+        """Everything the UI needs since window 'since_seq', in one message
+
+        Returns a dict with the latest window sequence number "seq", the
+        latest "traces" (sample times "t" and the channels x samples
+        "signal") and the drop "events" (one array of event_dtype
+        records) from windows newer than 'since_seq'. Both are None
+        if nothing has changed since 'since_seq'. Pass since_seq=None to
+        get the current state.
+        """
+        with self._snapshot_lock:
+            seq = self.window_seq
+            if since_seq is not None and since_seq >= seq:
+                return {"seq": seq, "traces": None, "events": None}
+            traces = self._traces
+            windows = [
+                events
+                for window_seq, events in self._recent_events
+                if since_seq is None or window_seq > since_seq
+            ]
+        events = np.concatenate(windows) if len(windows) > 0 else None
+        return {"seq": seq, "traces": traces, "events": events}
 
     """ Generate Test PMT Signals """
 
+    def _next_window(self):
+        """The next window of signals: generated, or replayed if replaying
+
+        Returns False once there's nothing left to replay.
+        """
+        if self._replay is None:
+            self._generate_signal()
+            return True
+        try:
+            start_ms, signal = next(self._replay)
+        except StopIteration:
+            return False
+        if len(self.t) != signal.shape[1]:
+            self.t = np.arange(signal.shape[1]) * self._replay.sampling_interval
+        self.window_start, self.signal = start_ms, signal
+        return True
+
     def _generate_signal(
         self,
-        num_channels=NUM_CHANNELS,
         sampling_interval=SAMPLING_INTERVAL,
         signal_duration=SIGNAL_DURATION,
         baseline=BASELINE,
@@ -62,46 +206,73 @@ class DataGenerator:
         baseline_cv=BASELINE_CV,
     ):
         t = np.arange(0, signal_duration, sampling_interval)
-
-        for channel_idx in range(1, num_channels + 1):
-            # Generate baseline noise
-            baseline_noise = np.random.normal(
-                loc=baseline, scale=baseline_cv, size=len(t)
+        num_channels = self.num_channels
+        self.window_start = self._next_window_start
+        self._next_window_start += signal_duration
+
+        # Generate baseline noise
+        baseline_noise = np.random.normal(
+            loc=baseline, scale=baseline_cv, size=(num_channels, len(t))
+        )
+
+        # Generate drops: every channel sees the same drop shapes, each with
+        # its own random amplitude, so that's (channels x drops) @ (drops x t)
+        shapes = self._drop_shapes(t, signal_duration, drop_interval, drop_width)
+        amplitudes = np.random.normal(1, drop_cv, size=(num_channels, len(shapes)))
+        drops = amplitudes @ shapes
+
+        # Combine signals for all channels
+        signal = baseline_noise + drops
+        signal *= np.asarray(self.gain)[:, np.newaxis]
+        self.t, self.signal = t, signal
+
+    def _drop_shapes(self, t, signal_duration, drop_interval, drop_width):
+        """One gaussian per drop, sampled at 't'; the same for every window"""
+        key = (len(t), t[-1], signal_duration, drop_interval, drop_width)
+        if getattr(self, "_drop_shapes_key", None) != key:
+            starts = np.arange(0, signal_duration, drop_interval)[:, np.newaxis]
+            self._drop_shapes_cache = np.exp(
+                -((t - starts) ** 2) / (2 * (drop_width / 2.355) ** 2)
             )
-
-            # Generate drops
-            drops = np.zeros_like(t)
-            for start in np.arange(0, signal_duration, drop_interval):
-                drop = np.exp(-((t - start) ** 2) / (2 * (drop_width / 2.355) ** 2))
-                drop *= np.random.normal(1, drop_cv)
-                drops += drop
-
-            # Combine signals for this channel
-            signal = baseline_noise + drops
-            signal = signal * self.gain[channel_idx - 1]
-            self.data[f"pmt{channel_idx}"] = {"x": t, "y": signal}
+            self._drop_shapes_key = key
+        return self._drop_shapes_cache
 
     """ Analyze Drop Parameters from PMT Signals """
 
     def _analyze_drops(
         self,
-        num_channels=NUM_CHANNELS,
         detection_channel=1,
         sampling_interval=SAMPLING_INTERVAL,
         min_width=MIN_WIDTH,
         max_width=MAX_WIDTH,
+        prominence_window=None,
     ):
+        # With a 'prominence_window' (ms), each drop's half height is measured
+        # from the lowest signal within prominence_window / 2 of its peak,
+        # rather than anywhere up to a higher peak, so it doesn't depend on
+        # distant signal
+        wlen = None
+        if prominence_window is not None:
+            wlen = max(3, int(round(prominence_window / sampling_interval)) | 1)
+
+        # Seconds spent in each step, for benchmarks.py
+        stopwatch = _Stopwatch()
+        self.analysis_timing = stopwatch.phases
+
         # Find drops based on the signal and threshold of the specified channel
-        detection_signal = self.data[f"pmt{detection_channel}"]["y"]
+        signal = self.signal
+        detection_signal = signal[detection_channel - 1]
         drops, _ = find_peaks(detection_signal, height=self.thresh)
+        detected_at = time.perf_counter()
+        stopwatch.lap("peaks")
 
-        if np.any(drops) == False:
+        if len(drops) == 0:
             print('No peaks detected in reference channel')
 
         else:
             # Calculate widths (fwhm) of the peaks to define the time range for each drop
             widths, _, left_ips, right_ips = peak_widths(
-                detection_signal, drops, rel_height=0.5
+                detection_signal, drops, rel_height=0.5, wlen=wlen
             )
             drop_widths = widths * sampling_interval  # Convert widths to time units
 
@@ -112,90 +283,58 @@ class DataGenerator:
             valid_left_ips = left_ips[valid_drop_indices]
             valid_right_ips = right_ips[valid_drop_indices]
             valid_drop_widths = drop_widths[valid_drop_indices]
+            stopwatch.lap("peaks")
 
-            # Prepare to exclude signal within drop time ranges from baseline calculation
-            excluded_indices = np.array([], dtype=int)
-            for left, right in zip(left_ips, right_ips):
-                excluded_indices = np.concatenate(
-                    (excluded_indices, np.arange(int(left), int(right)))
-                )
+            # Exclude signal within drop time ranges from baseline calculation:
+            # +1 where each range starts and -1 where it ends, summed up
+            in_drops = np.zeros(signal.shape[1] + 1, dtype=int)
+            np.add.at(in_drops, left_ips.astype(int), 1)
+            np.add.at(in_drops, right_ips.astype(int), -1)
+            baseline_samples = np.cumsum(in_drops[:-1]) == 0
+            stopwatch.lap("baseline")
 
-            if np.any(valid_drop_indices) == False:
+            if len(valid_drop_indices) == 0:
                 print('Drops failed validity tests')
             
             else:
-                # Initialize a dictionary to store the results
-                results = {
-                    "channel": [],
-                    "id": [],
-                    "timestamp": [],
-                    "width": [],
-                    "max signal": [],
-                    "auc": [],
-                    "fwhm": [],
-                    "baseline": [],
-                }
-
-                # Initialize dictionary for baseline signals
-                baseline_signals = {}
-
-                # For each valid drop, calculate parameters
-                for i, (left, right, width) in enumerate(
-                    zip(valid_left_ips, valid_right_ips, valid_drop_widths), start=1
-                ):
-                    for channel in range(1, num_channels + 1):
-                        # Specify the signal from a given channel
-                        channel_signal = self.data[f"pmt{channel}"]["y"]
-
-                        # Isolate baseline signal by excluding drop indices - technically don't need to calculate this for every drop
-                        baseline_indices = np.setdiff1d(
-                            np.arange(len(channel_signal)), excluded_indices
-                        )
-                        baseline_signals[channel] = np.median(
-                            channel_signal[baseline_indices]
-                        )
-                        baseline = np.mean(baseline_signals[channel])
-
-                        # Isolate drop signal
-                        drop_signal = channel_signal[int(left) : int(right)]
-
-                        # Calculate drop parameters
-                        max_signal = drop_signal.max()
-                        drop_time = self.data[f"pmt{channel}"]["x"][int(left)]
-                        auc = simps(drop_signal, dx=sampling_interval)
-                        fwhm = width
-                        drop_width = (right - left) * sampling_interval
-
-                        # Append drop parameter dictionary
-                        results["channel"].append(channel)
-                        results["id"].append(i)
-                        results["timestamp"].append(drop_time)
-                        results["width"].append(drop_width)
-                        results["max signal"].append(max_signal)
-                        results["auc"].append(auc * 1e6)
-                        results["fwhm"].append(fwhm)
-                        results["baseline"].append(baseline)
-
-                # Calculate density measurement for the density scatter plot
-                auc_1 = [
-                    results["auc"][i]
-                    for i, channel_value in enumerate(results["channel"])
-                    if channel_value == 1
-                ]
-                auc_2 = [
-                    results["auc"][i]
-                    for i, channel_value in enumerate(results["channel"])
-                    if channel_value == 2
-                ]
+                # One record per valid drop
+                events = np.zeros(
+                    len(valid_drop_indices), dtype=event_dtype(len(signal))
+                )
+                events["id"] = np.arange(1, len(events) + 1)
+                events["width"] = valid_drop_widths
+                events["timestamp"] = (
+                    self.window_start + self.t[valid_left_ips.astype(int)]
+                )
+                stopwatch.lap("features")
+                events["baseline"] = np.median(signal[:, baseline_samples], axis=1)
+                stopwatch.lap("baseline")
+
+                # For each valid drop, calculate parameters in every channel at once
+                for i, (left, right) in enumerate(zip(valid_left_ips, valid_right_ips)):
+                    # Isolate drop signal
+                    drop_signal = signal[:, int(left) : int(right)]
+                    events["max_signal"][i] = drop_signal.max(axis=1)
+                    events["auc"][i] = simps(drop_signal, dx=sampling_interval) * 1e6
 
                 # Locate auc values that are zero and give them a negligible, non-zero value
-                auc_1 = [x if x > 0 else 0.001 for x in auc_1]
-                auc_2 = [x if x > 0 else 0.001 for x in auc_2]
+                events["auc"][events["auc"] <= 0] = 0.001
+                stopwatch.lap("features")
 
-                if np.size(auc_1) > 2:
-                    xy = np.vstack([np.log(auc_1), np.log(auc_2)])
-                    density = gaussian_kde(xy)(xy)
-                    self.data2d = {"x": auc_1, "y": auc_2, "density": density}
+                # Decide which drops to sort, as soon as we have their features
+                events["sorted"] = self.sort_engine.decide(
+                    event_features(events), detected_at
+                )
+                stopwatch.lap("sort")
+
+                # Calculate density measurement for the density scatter plot;
+                # a KDE needs more drops than dimensions, so fewer stay at 0
+                if len(events) > 2:
+                    scatter_channels = np.subtract(self.SCATTER_CHANNELS, 1)
+                    xy = np.log(events["auc"][:, scatter_channels].T)
+                    events["density"] = gaussian_kde(xy)(xy)
+                stopwatch.lap("density")
+                self.events = events
 
     """ Set hardware values based on UI callbacks """
 
@@ -206,12 +345,309 @@ class DataGenerator:
         self.thresh = value
 
     def set_gate_values(self, values):
+        """Sort drops in a box select's values, or any sorting.Gate"""
         self.gate_val = values
+        self.sort_engine.set_gate(values)
         print(f"Gate values set {self.gate_val}")
 
+    """ Record Drop Events and Raw Signals to Disk """
+
+    def start_recording(self, directory, **recorder_options):
+        """Append every analyzed window's events to a log in 'directory'
+
+        See recorders.EventRecorder for the format and options; read the log
+        with recorders.EventLog.
+        """
+        self.stop_recording()
+        metadata = {
+            "num_channels": self.num_channels,
+            "sampling_interval_ms": self.SAMPLING_INTERVAL,
+            "window_ms": self.SIGNAL_DURATION,
+        }
+        self._event_recorder = EventRecorder(
+            directory, self.events.dtype, metadata, **recorder_options
+        )
+
+    def stop_recording(self):
+        """Finish writing the event log; returns the recorder's stats"""
+        with self._recorder_lock:
+            recorder, self._event_recorder = self._event_recorder, None
+        if recorder is None:
+            return None
+        recorder.close()
+        return recorder.stats()
+
+    def start_trace_recording(self, directory, **recorder_options):
+        """Record every window's raw signals to 'directory'
+
+        See recorders.TraceRecorder for the format and options; read the
+        signals back with recorders.TraceLog.
+        """
+        self.stop_trace_recording()
+        self._trace_recorder = TraceRecorder(
+            directory,
+            self.num_channels,
+            self.SAMPLING_INTERVAL,
+            dtype=self.signal.dtype,
+            metadata={"window_ms": self.SIGNAL_DURATION},
+            **recorder_options,
+        )
+
+    def stop_trace_recording(self):
+        """Finish writing the raw signals; returns the recorder's stats"""
+        with self._recorder_lock:
+            recorder, self._trace_recorder = self._trace_recorder, None
+        if recorder is None:
+            return None
+        recorder.close()
+        return recorder.stats()
+
+    def get_recording_stats(self):
+        """Stats of the event and trace recorders (None if not recording)"""
+        return {
+            name: None if recorder is None else recorder.stats()
+            for name, recorder in (
+                ("events", self._event_recorder),
+                ("traces", self._trace_recorder),
+            )
+        }
+
+    """ Replay Recorded Signals """
+
+    def start_replay(self, directory, paced=True, speed=1.0):
+        """Analyze signals recorded with start_trace_recording instead
+
+        Windows replace _generate_signal's, in the background like
+        start_generating, paced at the rate they were acquired (times 'speed')
+        or, with paced=False, as fast as they can be analyzed. Replay stops
+        by itself at the end of the recording; see get_replay_stats for
+        throughput, and stop_replay to go back to generating signals.
+        """
+        self.stop_generating()
+        replay = TraceReplay(directory, paced, speed)
+        if replay.num_channels != self.num_channels:
+            raise ValueError(
+                f"The recording has {replay.num_channels} channels, not "
+                f"{self.num_channels}"
+            )
+        if replay.sampling_interval != self.SAMPLING_INTERVAL:
+            raise ValueError(
+                f"The recording's sampling interval is {replay.sampling_interval}"
+                f" ms, not {self.SAMPLING_INTERVAL} ms"
+            )
+        self._replay = replay
+        self._replay_analysis_s = 0.0
+        self._replay_sorted = self.sort_engine.num_sorted
+        self._replay_rejected = self.sort_engine.num_rejected
+        self.start_generating()
+
+    def stop_replay(self):
+        """Stop replaying; start_generating generates signals again"""
+        self.stop_generating()
+        self._replay = None
+
+    def replay(self, directory, paced=False, speed=1.0):
+        """Replay a whole recording (see start_replay); returns get_replay_stats"""
+        self.start_replay(directory, paced, speed)
+        self._thread.join()
+        return self.get_replay_stats()
+
+    def get_replay_stats(self):
+        """Windows and samples replayed, and throughput in samples/s
+
+        "samples_per_s" is over the whole replay so far, including reading
+        the recording and any pacing; "analysis_samples_per_s" only counts
+        time spent in _analyze_drops, so it's the number to watch when
+        benchmarking analyzer changes on real data.
+        """
+        replay = self._replay
+        if replay is None or replay.started is None:
+            return None
+        elapsed = time.perf_counter() - replay.started
+        num_drops = (
+            self.sort_engine.num_sorted
+            - self._replay_sorted
+            + self.sort_engine.num_rejected
+            - self._replay_rejected
+        )
+        return {
+            "windows": replay.windows,
+            "samples": replay.samples,
+            "drops": num_drops,
+            "elapsed_s": elapsed,
+            "samples_per_s": replay.samples / elapsed,
+            "analysis_s": self._replay_analysis_s,
+            "analysis_samples_per_s": (
+                replay.samples / self._replay_analysis_s
+                if self._replay_analysis_s > 0
+                else None
+            ),
+            "running": self._generate,
+        }
+
+    def get_sort_stats(self):
+        """Sorted/rejected counts and decision latency; see SortEngine.stats"""
+        return self.sort_engine.stats()
+
+
+def benchmark_channels(channel_counts=(2, 4, 6, 8), num_windows=20):
+    """Time per window to generate and analyze signals, by number of channels
+
+    Also fits the cost of each added channel (ms per window), the slope of
+    total time per window vs. number of channels.
+    """
+    results = {}
+    for num_channels in channel_counts:
+        dg = DataGenerator(num_channels=num_channels)
+        np.random.seed(0)
+        dg._generate_signal()  # Warm up (and build the cached drop shapes)
+        generate_s = analyze_s = 0.0
+        for _ in range(num_windows):
+            t0 = time.perf_counter()
+            dg._generate_signal()
+            t1 = time.perf_counter()
+            dg._analyze_drops()
+            analyze_s += time.perf_counter() - t1
+            generate_s += t1 - t0
+        results[num_channels] = {
+            "generate_ms": 1e3 * generate_s / num_windows,
+            "analyze_ms": 1e3 * analyze_s / num_windows,
+            "drops_per_window": len(dg.events),
+        }
+    total_ms = [r["generate_ms"] + r["analyze_ms"] for r in results.values()]
+    per_channel_ms, fixed_ms = np.polyfit(list(results), total_ms, 1)
+    return {
+        "windows": results,
+        "ms_per_added_channel": float(per_channel_ms),
+        "fixed_ms": float(fixed_ms),
+    }
+
+
+def _replay_summary(directory, result):
+    """One line about a DataGenerator.replay result, for --replay"""
+    if result is None:
+        return f"Nothing was replayed from {directory}: n/a"
+    analysis = result["analysis_samples_per_s"]
+    analysis = "n/a" if analysis is None else f"{analysis:,.0f}"
+    return (
+        f"Replayed {result['samples']:,} samples ({result['windows']} windows, "
+        f"{result['drops']} drops) in {result['elapsed_s']:.2f} s: "
+        f"{result['samples_per_s']:,.0f} samples/s overall, "
+        f"{analysis} samples/s analysis"
+    )
+
+class TestDataGenerator(ct.MyTestClass):
+    """Run with: python data_generator.py --test"""
+
+    class _ShortHistory(DataGenerator):
+        SNAPSHOT_HISTORY = 5
+
+    def test_snapshot_since_seq(self):
+        np.random.seed(0)
+        dg = self._ShortHistory()
+        windows = {}  # seq -> that window's events
+        for _ in range(3):
+            dg._process_window()
+            windows[dg.window_seq] = dg.events
+        full = dg.get_snapshot()
+        assert full["seq"] == 3
+        assert np.array_equal(full["events"], np.concatenate(list(windows.values())))
+        assert full["traces"]["signal"] is dg.signal
+        newer = dg.get_snapshot(since_seq=1)  # Only windows 2 and 3
+        assert newer["seq"] == 3
+        assert np.array_equal(newer["events"], np.concatenate([windows[2], windows[3]]))
+        latest = dg.get_snapshot(since_seq=2)
+        assert np.array_equal(latest["events"], windows[3])
+        nothing_new = dg.get_snapshot(since_seq=3)
+        assert nothing_new == {"seq": 3, "traces": None, "events": None}
+        dg._process_window()
+        assert np.array_equal(dg.get_snapshot(since_seq=3)["events"], dg.events)
+
+    def test_snapshot_stale_since_seq(self):
+        """A since_seq whose windows were evicted gets everything that's left"""
+        np.random.seed(1)
+        dg = self._ShortHistory()
+        windows = []
+        for _ in range(dg.SNAPSHOT_HISTORY + 3):
+            dg._process_window()
+            windows.append(dg.events)
+        kept = np.concatenate(windows[-dg.SNAPSHOT_HISTORY :])
+        for since_seq in (0, 1, 3):  # Window 4 was the oldest one kept
+            stale = dg.get_snapshot(since_seq=since_seq)
+            assert stale["seq"] == dg.SNAPSHOT_HISTORY + 3
+            assert np.array_equal(stale["events"], kept), since_seq
+            assert stale["traces"]["signal"] is dg.signal
+        assert np.array_equal(dg.get_snapshot()["events"], kept)
+        assert np.array_equal(dg.get_snapshot(4)["events"], kept[len(windows[3]) :])
+
+
+    def test_replay_stats(self):
+        import glob
+        import os
+        import shutil
+        import tempfile
+        from recorders import HEADER_SIZE
+
+        directory = tempfile.mkdtemp(prefix="replay_test_")
+        try:
+            np.random.seed(2)
+            dg = DataGenerator()
+            dg.start_trace_recording(directory)
+            num_drops = 0
+            for _ in range(4):
+                dg._process_window()
+                num_drops += len(dg.events)
+            dg.stop_trace_recording()
+
+            replayer = DataGenerator()
+            stats = replayer.replay(directory)  # As fast as it can
+            assert stats["windows"] == 4
+            assert stats["samples"] == 4 * dg.signal.shape[1]
+            assert stats["drops"] == num_drops  # The same signals, the same drops
+            assert stats["drops"] == replayer.sort_engine.stats()["rejected"]
+            assert not stats["running"]
+            assert 0 < stats["analysis_s"] <= stats["elapsed_s"]
+            assert np.isclose(
+                stats["analysis_samples_per_s"], stats["samples"] / stats["analysis_s"]
+            )
+            assert stats["analysis_samples_per_s"] >= stats["samples_per_s"]
+            assert "n/a" not in _replay_summary(directory, stats)
+            no_analysis = {**stats, "analysis_s": 0.0, "analysis_samples_per_s": None}
+            assert _replay_summary(directory, no_analysis).endswith(
+                "n/a samples/s analysis"
+            )
+
+            # A recording whose index was never flushed has nothing to replay:
+            for path in glob.glob(os.path.join(directory, "traces_index_*.bin")):
+                os.truncate(path, HEADER_SIZE)
+            assert DataGenerator().replay(directory) is None
+            assert _replay_summary(directory, None).endswith("n/a")
+        finally:
+            shutil.rmtree(directory)
 
 if __name__ == "__main__":
-    dg = DataGenerator()
-    dg.start_generating()
-    input()
-    dg.stop_generating()
+    if "--test" in sys.argv:
+        TestDataGenerator().run()
+    elif "--benchmark" in sys.argv:
+        result = benchmark_channels()
+        for num_channels, r in result["windows"].items():
+            print(
+                f"{num_channels} channels: generate {r['generate_ms']:.2f} ms, "
+                f"analyze {r['analyze_ms']:.2f} ms per window "
+                f"({r['drops_per_window']} drops)"
+            )
+        print(
+            f"{result['ms_per_added_channel']:.2f} ms per added channel, "
+            f"on top of {result['fixed_ms']:.2f} ms per window"
+        )
+    elif "--replay" in sys.argv:
+        # python data_generator.py --replay DIRECTORY [--paced]
+        directory = sys.argv[sys.argv.index("--replay") + 1]
+        dg = DataGenerator(num_channels=TraceLog(directory).num_channels)
+        result = dg.replay(directory, paced="--paced" in sys.argv)
+        print(_replay_summary(directory, result))
+    else:
+        dg = DataGenerator()
+        dg.start_generating()
+        input()
+        dg.stop_generating()
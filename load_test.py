@@ -0,0 +1,325 @@
+"""Headless load test for the Bokeh UI.
+
+Serves ui_layout.py from an in-process Bokeh server, opens simulated browser
+sessions from a separate client process, and drives the controls the way
+users would: the hardware owner moves the sliders, every session box-selects.
+Writes a JSON report with per-session update latency (fetch + render),
+bytes sent over the websocket, and the server's CPU use, e.g.:
+
+    python load_test.py --sessions 4 --duration 20 --output report.json
+"""
+
+import argparse
+import json
+import multiprocessing as mp
+import os
+import sys
+import time
+from functools import partial
+
+import numpy as np
+from bokeh.application import Application
+from bokeh.application.handlers import FunctionHandler, ScriptHandler
+from bokeh.client import pull_session
+from bokeh.server.server import Server
+from tornado.ioloop import PeriodicCallback
+
+from ui_tools import PatchSizeMeter, timing_summary
+
+UI_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ui_layout.py")
+
+
+class LoadTest:
+    """Serve the UI, connect 'num_sessions' clients, and measure for 'duration' s
+
+    Latency, bytes and interactions are only counted during the measurement,
+    which starts 'warmup' seconds after the last session connects and
+    acquisition starts. Byte counting serializes each patch a second time, so
+    the server CPU numbers include that overhead.
+    """
+
+    def __init__(
+        self,
+        num_sessions=4,
+        duration=20,
+        warmup=2,
+        interaction_interval=0.5,
+        port=5006,
+        seed=0,
+    ):
+        self.num_sessions = num_sessions
+        self.duration = duration
+        self.warmup = warmup
+        self.interaction_interval = interaction_interval
+        self.port = port
+        self.rng = np.random.default_rng(seed)
+        self.probes = []
+        self.measuring = False
+        self.errors = []
+
+    def run(self):
+        """Run the load test and return the report as a dict"""
+        app = Application(
+            ScriptHandler(filename=UI_SCRIPT), FunctionHandler(self._attach_probe)
+        )
+        self.server = Server({"/ui": app}, port=self.port, num_procs=1)
+        self.server.start()
+        url = f"http://localhost:{self.port}/ui"
+        # Starting a process fixes the default start method, and the UI's
+        # concurrency_tools needs it to be 'spawn'
+        if mp.get_start_method(allow_none=True) != "spawn":
+            mp.set_start_method("spawn")
+        clients = mp.Process(
+            target=_run_clients, args=(url, self.num_sessions), daemon=True
+        )
+        clients.start()
+        io_loop = self.server.io_loop
+        self._wait_for_sessions_started = time.perf_counter()
+        self._session_check = PeriodicCallback(self._wait_for_sessions, 100)
+        self._session_check.start()
+        io_loop.start()  # Until _finish stops it
+        clients.join(timeout=10)
+        if clients.is_alive():
+            clients.terminate()
+        self.server.stop()
+        return self.report
+
+    """ Session Setup """
+
+    def _attach_probe(self, doc):
+        """Runs right after ui_layout.py builds each new session's document"""
+        ui = _find_ui(doc)
+        probe = {
+            "ui": ui,
+            "bytes_meter": PatchSizeMeter(doc),
+            "fetch_s": 0.0,  # Of the snapshot about to be rendered
+            "update_s": [],
+            "render_s": [],
+            "interactions": 0,
+        }
+        fetch_snapshot, render_snapshot = ui._fetch_snapshot, ui._render_snapshot
+
+        def timed_fetch():
+            t0 = time.perf_counter()
+            snapshot = fetch_snapshot()
+            probe["fetch_s"] = time.perf_counter() - t0
+            return snapshot
+
+        def timed_render(snapshot):
+            t0 = time.perf_counter()
+            render_snapshot(snapshot)
+            render_s = time.perf_counter() - t0
+            if self.measuring:
+                probe["render_s"].append(render_s)
+                probe["update_s"].append(probe["fetch_s"] + render_s)
+
+        ui._fetch_snapshot, ui._render_snapshot = timed_fetch, timed_render
+        self.probes.append(probe)
+
+    def _wait_for_sessions(self):
+        if len(self.probes) < self.num_sessions:
+            if time.perf_counter() - self._wait_for_sessions_started > 120:
+                self.errors.append("Timed out waiting for sessions to connect")
+                self._session_check.stop()
+                self._finish()
+            return
+        self._session_check.stop()
+        self._owner_probe = next(
+            p for p in self.probes if p["ui"].acquisition.is_owner(p["ui"].subscription)
+        )
+        self._in_session(self._owner_probe, self._set_generating, True)
+        self.server.io_loop.call_later(self.warmup, self._start_measuring)
+
+    """ Measurement """
+
+    def _start_measuring(self):
+        for probe in self.probes:
+            probe["bytes_meter"].pop()
+        self.acquisition = self._owner_probe["ui"].acquisition
+        self._child_pid = self.acquisition.dg._.child_process.pid
+        self._start = (
+            time.perf_counter(),
+            time.process_time(),
+            _cpu_seconds(self._child_pid),
+        )
+        self.measuring = True
+        self._interactions = PeriodicCallback(
+            self._interact, 1000 * self.interaction_interval
+        )
+        self._interactions.start()
+        self.server.io_loop.call_later(self.duration, self._finish)
+
+    def _interact(self):
+        """Move a random hardware slider (owner only), and box-select everywhere"""
+        slider = self.rng.integers(3)
+        value = float(np.round(self.rng.uniform(0.05, 1), 2))
+        self._in_session(self._owner_probe, self._move_slider, slider, value)
+        for probe in self.probes:
+            x0, y0 = 10 ** self.rng.uniform(3, 5, size=2)
+            x1, y1 = (x0, y0) * 10 ** self.rng.uniform(0.2, 1, size=2)
+            box = {"x0": [x0], "y0": [y0], "x1": [x1], "y1": [y1]}
+            self._in_session(probe, self._box_select, box)
+
+    def _finish(self):
+        end = (
+            time.perf_counter(),
+            time.process_time(),
+            _cpu_seconds(self._child_pid) if hasattr(self, "_child_pid") else None,
+        )
+        self.measuring = False
+        if hasattr(self, "_interactions"):
+            self._interactions.stop()
+        self.report = self._make_report(end)
+        if hasattr(self, "_owner_probe"):
+            self._in_session(self._owner_probe, self._set_generating, False)
+        # Let the stop go through before stopping the server
+        self.server.io_loop.call_later(0.5, self.server.io_loop.stop)
+
+    """ Session Actions (run on each session's document thread) """
+
+    def _in_session(self, probe, action, *args):
+        probe["ui"].doc.add_next_tick_callback(partial(action, probe, *args))
+
+    def _set_generating(self, probe, generating):
+        probe["ui"].toggle.active = generating
+
+    def _move_slider(self, probe, index, value):
+        probe["ui"].sliders[index].value = value
+        probe["interactions"] += self.measuring
+
+    def _box_select(self, probe, box):
+        # What the box select tool's JS callback sends from the browser
+        probe["ui"].source_bx.data = box
+        probe["interactions"] += self.measuring
+
+    """ Report """
+
+    def _make_report(self, end):
+        sessions = []
+        for i, probe in enumerate(self.probes):
+            ticks = len(probe["update_s"])
+            num_bytes = probe["bytes_meter"].bytes
+            sessions.append(
+                {
+                    "session": i,
+                    "owner": probe is getattr(self, "_owner_probe", None),
+                    "ticks": ticks,
+                    "tick_rate_hz": ticks / self.duration,
+                    "update_ms": timing_summary(probe["update_s"]),
+                    "render_ms": timing_summary(probe["render_s"]),
+                    "bytes": num_bytes,
+                    "bytes_per_tick": num_bytes / ticks if ticks > 0 else None,
+                    "kB_per_s": num_bytes / 1e3 / self.duration,
+                    "interactions": probe["interactions"],
+                    # Recent frames (not just the measurement) from the UI itself
+                    "stages_ms": probe["ui"].frame_timer.stats(),
+                }
+            )
+        report = {
+            "config": {
+                "sessions": self.num_sessions,
+                "duration_s": self.duration,
+                "warmup_s": self.warmup,
+                "interaction_interval_s": self.interaction_interval,
+                "cpu_count": os.cpu_count(),
+                "python": sys.version.split()[0],
+            },
+            "errors": self.errors,
+            "sessions": sessions,
+        }
+        if not hasattr(self, "_start"):
+            return report
+        wall = end[0] - self._start[0]
+        all_update_s = [s for probe in self.probes for s in probe["update_s"]]
+        report["summary"] = {
+            "ticks": len(all_update_s),
+            "update_ms": timing_summary(all_update_s),
+            "kB_per_s": sum(s["kB_per_s"] for s in sessions),
+            "server_cpu_percent": 100 * (end[1] - self._start[1]) / wall,
+            "generator_cpu_percent": (
+                None if end[2] is None else 100 * (end[2] - self._start[2]) / wall
+            ),
+        }
+        return report
+
+
+def _find_ui(doc):
+    """The UI that ui_layout.py made for 'doc', via its session-destroyed hook"""
+    for callback in doc.session_destroyed_callbacks:
+        owner = getattr(callback, "__self__", None)
+        if type(owner).__name__ == "UI":
+            return owner
+    raise LookupError("ui_layout.py didn't create a UI for this document")
+
+
+def _cpu_seconds(pid):
+    """User + system CPU time of a process so far, or None if we can't tell"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:  # Linux only
+            fields = f.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def _run_clients(url, num_sessions):
+    """Client process: hold sessions open and apply what the server sends
+
+    Runs until the server goes away, like a browser tab would.
+    """
+    sessions = []
+    for _ in range(num_sessions):
+        sessions.append(pull_session(url=url))
+    while all(session.connected for session in sessions):
+        for session in sessions:
+            try:
+                # A round trip also applies any PATCH-DOCs that arrived meanwhile
+                session.request_server_info()
+            except Exception:
+                return
+        time.sleep(0.05)
+
+
+def _format_summary(report):
+    lines = [f"{report['config']['sessions']} sessions:"]
+    for s in report["sessions"]:
+        update = s["update_ms"] or {"p50": float("nan"), "p99": float("nan")}
+        lines.append(
+            f"  session {s['session']}{' (owner)' if s['owner'] else ''}: "
+            f"{s['tick_rate_hz']:.1f} Hz, update p50 {update['p50']:.1f} ms, "
+            f"p99 {update['p99']:.1f} ms, {s['kB_per_s']:.1f} kB/s"
+        )
+    if "summary" in report:
+        summary = report["summary"]
+        lines.append(
+            f"  server CPU {summary['server_cpu_percent']:.0f}%, generator CPU "
+            f"{summary['generator_cpu_percent'] or float('nan'):.0f}%, "
+            f"{summary['kB_per_s']:.1f} kB/s total"
+        )
+    for error in report["errors"]:
+        lines.append(f"  error: {error}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sessions", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=20, help="seconds")
+    parser.add_argument("--warmup", type=float, default=2, help="seconds")
+    parser.add_argument("--interaction-interval", type=float, default=0.5)
+    parser.add_argument("--port", type=int, default=5006)
+    parser.add_argument("--output", default="load_test_report.json")
+    args = parser.parse_args()
+
+    load_test = LoadTest(
+        num_sessions=args.sessions,
+        duration=args.duration,
+        warmup=args.warmup,
+        interaction_interval=args.interaction_interval,
+        port=args.port,
+    )
+    report = load_test.run()
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(_format_summary(report))
+    print(f"Report written to {args.output}")
@@ -0,0 +1,1201 @@
+"""Record acquisition output to disk, and read it back.
+
+EventRecorder appends drop event records (data_generator.event_dtype) to an
+append-only, chunked binary log from a background thread, and EventLog reads
+the log back as NumPy memmaps. A log is a directory of chunk files:
+
+    events_000000.bin, events_000001.bin, ...
+
+Each chunk is a fixed-size header (a magic line, then JSON with the record
+dtype and any metadata, padded with spaces to HEADER_SIZE bytes) followed by
+raw, fixed-width records. Nothing after the header is ever rewritten, so a
+chunk can be read (and memory-mapped) while it's being written, and a crash
+loses at most the records that hadn't been flushed yet.
+
+    python recorders.py  # Benchmark sustained write throughput
+    python recorders.py --test
+"""
+
+import atexit
+import errno
+import glob
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+import concurrency_tools as ct
+
+MAGIC = b"PICCOLO CHUNK\n"
+HEADER_SIZE = 4096
+FORMAT_VERSION = 1
+
+
+def _write_header(f, header):
+    text = MAGIC + json.dumps(header).encode()
+    if len(text) > HEADER_SIZE - 1:
+        raise ValueError(f"Chunk header is over {HEADER_SIZE} bytes; less metadata?")
+    f.write(text.ljust(HEADER_SIZE - 1) + b"\n")
+
+
+def read_header(path):
+    """The JSON header of a chunk file, with its record "dtype" as a np.dtype"""
+    with open(path, "rb") as f:
+        text = f.read(HEADER_SIZE)
+    if not text.startswith(MAGIC) or len(text) < HEADER_SIZE:
+        raise ValueError(f"{path} isn't a chunk file")
+    header = json.loads(text[len(MAGIC) :])
+    if header["version"] > FORMAT_VERSION:
+        raise ValueError(f"{path} has a newer format (version {header['version']})")
+    header["dtype"] = np.lib.format.descr_to_dtype(_as_descr(header["dtype"]))
+    return header
+
+
+def _as_descr(descr):
+    """JSON turns a dtype descr's tuples into lists; turn them back"""
+    if isinstance(descr, str):
+        return descr
+    fields = []
+    for name, kind, *shape in descr:
+        fields.append((name, _as_descr(kind), *(tuple(s) for s in shape)))
+    return fields
+
+
+class _BackgroundWriter:
+    """Queue items in the caller's thread, and write them from another one.
+
+    'append' only queues an item (e.g. an array), so it costs the caller
+    next to nothing; a writer thread wakes up every 'flush_interval' seconds
+    (or as soon as 'batch_size' units, e.g. records, are waiting) and passes
+    everything queued to '_write_batch' in one go.
+
+    If the writer falls more than 'max_pending' units behind, new items are
+    dropped (and counted in 'stats') rather than slowing acquisition or
+    growing without bound. Subclasses implement '_write_batch' and
+    '_finish', and count what they've written in 'units_written' and
+    'bytes_written'.
+
+    If writing fails (e.g. the disk is full), the writer thread stops and
+    '_finish' still runs; the next 'append' and 'close' raise the error.
+    """
+
+    UNITS = "records"  # What 'batch_size' and 'max_pending' count, for 'stats'
+
+    def __init__(self, flush_interval, batch_size, max_pending):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.units_written = 0
+        self.bytes_written = 0
+        self.units_dropped = 0
+        self.flushes = 0
+        self.writer_cpu_s = 0.0  # CPU time of the writer thread
+        self._pending = []
+        self._pending_size = 0
+        self._closing = False
+        self._error = None  # What stopped the writer thread, if anything
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._write_loop, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _queue(self, item, size):
+        with self._condition:
+            if self._error is not None:
+                raise self._error
+            if self._closing:
+                raise RuntimeError("This recorder is closed")
+            if self._pending_size + size > self.max_pending:
+                self.units_dropped += size
+                return
+            self._pending.append(item)
+            self._pending_size += size
+            if self._pending_size >= self.batch_size:
+                self._condition.notify()
+
+    def close(self):
+        """Write everything queued so far, and stop"""
+        with self._condition:
+            self._closing = True
+            self._condition.notify()
+        self._thread.join()
+        atexit.unregister(self.close)
+        if self._error is not None:
+            raise self._error
+
+    def stats(self):
+        with self._condition:
+            return {
+                f"{self.UNITS}_written": self.units_written,
+                "bytes_written": self.bytes_written,
+                f"{self.UNITS}_pending": self._pending_size,
+                f"{self.UNITS}_dropped": self.units_dropped,
+                "flushes": self.flushes,
+                "writer_cpu_s": self.writer_cpu_s,
+            }
+
+    def _write_loop(self):
+        try:
+            closing = False
+            while not closing:
+                with self._condition:
+                    self._condition.wait_for(
+                        lambda: self._closing or self._pending_size >= self.batch_size,
+                        timeout=self.flush_interval,
+                    )
+                    pending, self._pending = self._pending, []
+                    size, closing = self._pending_size, self._closing
+                if len(pending) > 0:
+                    cpu_start = time.thread_time()
+                    self._write_batch(pending)
+                    with self._condition:
+                        self._pending_size -= size
+                        self.flushes += 1
+                        self.writer_cpu_s += time.thread_time() - cpu_start
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            try:
+                self._finish()
+            except BaseException as e:
+                self._fail(e)
+
+    def _fail(self, error):
+        with self._condition:
+            if self._error is None:
+                self._error = error
+            self.units_dropped += self._pending_size  # Never to be written
+            self._pending, self._pending_size = [], 0
+
+    def _write_batch(self, items):
+        raise NotImplementedError
+
+    def _finish(self):
+        pass
+
+
+class EventRecorder(_BackgroundWriter):
+    """Append drop event records to a chunked on-disk log, in the background.
+
+    Each batch of queued records (see _BackgroundWriter) is written in one
+    go and flushed to the OS; with fsync=True, each flush also waits for the
+    disk. Chunks hold up to 'chunk_records' records.
+
+    Recording into a directory that already has a log continues it, in a
+    new chunk; the record dtype has to match.
+    """
+
+    def __init__(
+        self,
+        directory,
+        dtype,
+        metadata=None,
+        chunk_records=1 << 20,
+        flush_interval=0.5,
+        batch_records=1 << 16,
+        max_pending_records=1 << 24,
+        fsync=False,
+        prefix="events",
+    ):
+        self.directory = directory
+        self.dtype = np.dtype(dtype)
+        self.metadata = {} if metadata is None else dict(metadata)
+        self.chunk_records = int(chunk_records)
+        self.fsync = fsync
+        self.prefix = prefix
+
+        os.makedirs(directory, exist_ok=True)
+        existing = _chunk_paths(directory, prefix)
+        if len(existing) > 0 and read_header(existing[-1])["dtype"] != self.dtype:
+            raise ValueError(f"{directory} has a log of different records")
+        self._next_chunk = len(existing)
+        self._file = None
+        self._chunk_count = 0  # Records in the current chunk
+        super().__init__(flush_interval, batch_records, max_pending_records)
+
+    def append(self, records):
+        """Queue an array of records for writing; don't modify it afterwards"""
+        records = np.asarray(records)
+        if records.dtype != self.dtype:
+            raise TypeError(f"Expected {self.dtype} records, not {records.dtype}")
+        if len(records) > 0:
+            self._queue(records, len(records))
+
+    def stats(self):
+        return {**super().stats(), "chunks": self._next_chunk}
+
+    def _write_batch(self, batches):
+        records = np.concatenate(batches)
+        while len(records) > 0:
+            if self._file is None or self._chunk_count == self.chunk_records:
+                self._open_chunk()
+            n = min(len(records), self.chunk_records - self._chunk_count)
+            self._file.write(records[:n].tobytes())
+            self._chunk_count += n
+            with self._condition:
+                self.units_written += n
+                self.bytes_written += n * self.dtype.itemsize
+            records = records[n:]
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+    def _finish(self):
+        if self._file is not None:
+            self._file.close()
+
+    def _open_chunk(self):
+        if self._file is not None:
+            self._file.close()
+        path = _chunk_path(self.directory, self.prefix, self._next_chunk)
+        self._file = open(path, "xb", buffering=1 << 20)
+        _write_header(
+            self._file,
+            {
+                "version": FORMAT_VERSION,
+                "dtype": np.lib.format.dtype_to_descr(self.dtype),
+                "chunk": self._next_chunk,
+                "created": time.time(),
+                "metadata": self.metadata,
+            },
+        )
+        self._next_chunk += 1
+        self._chunk_count = 0
+
+
+class EventLog:
+    """Read an EventRecorder's log, chunk by chunk, as read-only memmaps.
+
+    Works while the log is still being written; call 'refresh' to see
+    records (and chunks) added since it was opened.
+    """
+
+    def __init__(self, directory, prefix="events"):
+        self.directory = directory
+        self.prefix = prefix
+        self.refresh()
+
+    def refresh(self):
+        self.paths = _chunk_paths(self.directory, self.prefix)
+        if len(self.paths) == 0:
+            raise FileNotFoundError(f"No {self.prefix} log in {self.directory}")
+        self.header = read_header(self.paths[0])
+        self.dtype = self.header["dtype"]
+        self.metadata = self.header["metadata"]
+        self.chunk_lengths = [self._chunk_length(path) for path in self.paths]
+
+    def __len__(self):
+        return sum(self.chunk_lengths)
+
+    def _chunk_length(self, path):
+        # A record that's only partly flushed doesn't count yet
+        return (os.path.getsize(path) - HEADER_SIZE) // self.dtype.itemsize
+
+    def chunk(self, index):
+        """One chunk's records as a read-only memmap (no copy)"""
+        length = self.chunk_lengths[index]
+        if length == 0:
+            return np.zeros(0, dtype=self.dtype)
+        return np.memmap(
+            self.paths[index],
+            dtype=self.dtype,
+            mode="r",
+            offset=HEADER_SIZE,
+            shape=(length,),
+        )
+
+    def chunks(self):
+        for index in range(len(self.paths)):
+            yield self.chunk(index)
+
+    def read(self, start=0, stop=None):
+        """Records start:stop of the whole log, copied into one array"""
+        stop = len(self) if stop is None else min(stop, len(self))
+        parts = []
+        offset = 0
+        for index, length in enumerate(self.chunk_lengths):
+            lo, hi = max(start - offset, 0), min(stop - offset, length)
+            if lo < hi:
+                parts.append(self.chunk(index)[lo:hi])
+            offset += length
+        if len(parts) == 0:
+            return np.zeros(0, dtype=self.dtype)
+        return np.concatenate(parts)
+
+
+class EventIndex:
+    """Range and threshold queries on an EventLog that only read what they need.
+
+    The log is indexed in blocks of 'block_records' records. Each block's
+    zone map, the min and max of every column, is kept in memory, and a
+    query only reads the blocks whose zone maps overlap it. Columns are the
+    records' fields, with one per channel for per-channel fields, named
+    like data_generator.event_features: "timestamp", "width", "auc_1",
+    "auc_2", ..., "baseline_1", "density" and so on.
+
+    Recorders write events in time order, so the blocks' timestamp ranges
+    are sorted, and a time range is found by binary search instead of by
+    checking every block. Logs that aren't in time order still work, just
+    less quickly.
+
+    Zone maps are computed once per chunk and, with cache=True, saved next
+    to it (events_000000.zonemap.npz, ...); 'refresh' indexes records
+    written since, so it works while the log is still being written.
+    """
+
+    def __init__(self, directory, prefix="events", block_records=1 << 12, cache=True):
+        self.directory = directory
+        self.prefix = prefix
+        self.block_records = int(block_records)
+        self.cache = cache
+        self.log = None
+        self._zone_maps = []
+        self.last_query = None  # What the last query read; see 'query'
+        self.refresh()
+
+    def refresh(self):
+        if self.log is None:
+            self.log = EventLog(self.directory, self.prefix)
+        else:
+            self.log.refresh()
+        self.dtype = self.log.dtype
+        self.columns = list(_columns(np.zeros(0, dtype=self.dtype)))
+        for index in range(len(self.log.paths)):
+            if index == len(self._zone_maps):
+                self._zone_maps.append(self._load_zone_map(index))
+            zone_map = self._zone_maps[index]
+            if zone_map["records"] != self.log.chunk_lengths[index]:
+                self._zone_maps[index] = zone_map = self._update_zone_map(
+                    index, zone_map
+                )
+                if self.cache:
+                    self._save_zone_map(index, zone_map)
+
+        # Every block of every chunk, in log order
+        zone_maps = self._zone_maps
+        self.block_chunk = np.concatenate(
+            [np.full(len(z["mins"]), i) for i, z in enumerate(zone_maps)]
+        ).astype(np.int64)
+        self.block_start = np.concatenate(
+            [np.arange(len(z["mins"])) * self.block_records for z in zone_maps]
+        ).astype(np.int64)
+        self.mins = np.concatenate([z["mins"] for z in zone_maps])
+        self.maxs = np.concatenate([z["maxs"] for z in zone_maps])
+        if "timestamp" in self.columns:
+            t = self.columns.index("timestamp")
+            self.time_sorted = bool(
+                all(z["time_sorted"].all() for z in zone_maps)
+                and np.all(self.maxs[:-1, t] <= self.mins[1:, t])
+            )
+        else:
+            self.time_sorted = False
+
+    def __len__(self):
+        return len(self.log)
+
+    def query(self, start_ms=None, stop_ms=None, gate=None, **bounds):
+        """Records with start_ms <= timestamp < stop_ms, within 'bounds'
+
+        'bounds' are columns' (low, high) limits, inclusive, with None for
+        no limit, e.g. auc_1=(1e5, None). With a 'gate' (see sorting.Gate),
+        only records in it are returned, and blocks outside its bounding box
+        aren't read. Returns a copy of the matching records, in log order;
+        'last_query' then says how many blocks and records were read.
+        """
+        limits = {}
+        if start_ms is not None or stop_ms is not None:
+            limits["timestamp"] = (
+                -np.inf if start_ms is None else start_ms,
+                np.inf if stop_ms is None else stop_ms,
+            )
+        for name, (low, high) in bounds.items():
+            limits[name] = (
+                -np.inf if low is None else float(low),
+                np.inf if high is None else float(high),
+            )
+        prune = dict(limits)
+        if gate is not None:
+            for name, (low, high) in gate.bounds().items():
+                if name in prune:
+                    low = max(low, prune[name][0])
+                    high = min(high, prune[name][1])
+                prune[name] = (low, high)
+        for name in prune:
+            if name not in self.columns:
+                raise ValueError(f"No column {name!r}; columns are {self.columns}")
+
+        # Blocks whose zone maps overlap every limit
+        first, last = 0, len(self.mins)
+        if "timestamp" in prune and self.time_sorted:
+            t = self.columns.index("timestamp")
+            low, high = prune.pop("timestamp")
+            first = np.searchsorted(self.maxs[:, t], low, side="left")
+            last = np.searchsorted(self.mins[:, t], high, side="right")
+        blocks = np.arange(first, max(first, last))
+        for name, (low, high) in prune.items():
+            i = self.columns.index(name)
+            overlap = (self.maxs[blocks, i] >= low) & (self.mins[blocks, i] <= high)
+            blocks = blocks[overlap]
+
+        # Read runs of consecutive blocks, then keep the records that match
+        evaluate = None if gate is None else gate.compile()
+        parts, records_read = [], 0
+        runs = np.flatnonzero(
+            (np.diff(blocks, prepend=-2) != 1)
+            | (np.diff(self.block_chunk[blocks], prepend=-1) != 0)
+        )
+        for run_first, run_last in zip(runs, np.append(runs[1:], len(blocks))):
+            chunk = self.block_chunk[blocks[run_first]]
+            start = self.block_start[blocks[run_first]]
+            stop = self.block_start[blocks[run_last - 1]] + self.block_records
+            records = np.array(self.log.chunk(chunk)[start:stop])
+            records_read += len(records)
+            columns = _columns(records)
+            keep = np.ones(len(records), dtype=bool)
+            for name, (low, high) in limits.items():
+                values = np.asarray(columns[name], dtype=float)
+                if name == "timestamp":
+                    keep &= (values >= low) & (values < high)
+                else:
+                    keep &= (values >= low) & (values <= high)
+            if evaluate is not None:
+                keep &= evaluate(columns)
+            parts.append(records[keep])
+        result = np.concatenate([np.zeros(0, dtype=self.dtype)] + parts)
+        self.last_query = {
+            "blocks": len(self.mins),
+            "blocks_read": len(blocks),
+            "records_read": records_read,
+            "records": len(result),
+        }
+        return result
+
+    def _zone_map_path(self, index):
+        return self.log.paths[index][: -len(".bin")] + ".zonemap.npz"
+
+    def _load_zone_map(self, index):
+        empty = {
+            "records": 0,
+            "mins": np.zeros((0, len(self.columns))),
+            "maxs": np.zeros((0, len(self.columns))),
+            "time_sorted": np.zeros(0, dtype=bool),
+        }
+        path = self._zone_map_path(index)
+        if not (self.cache and os.path.exists(path)):
+            return empty
+        with np.load(path) as saved:
+            if (
+                int(saved["block_records"]) != self.block_records
+                or list(saved["columns"]) != self.columns
+                or int(saved["records"]) > self.log.chunk_lengths[index]
+            ):
+                return empty  # Stale, or indexed differently
+            return {name: saved[name] for name in empty}
+
+    def _update_zone_map(self, index, zone_map):
+        """Add the blocks of records written since 'zone_map' was made"""
+        full_blocks = zone_map["records"] // self.block_records
+        start = full_blocks * self.block_records  # Redo a partial last block
+        records = self.log.chunk(index)[start:]
+        offsets = np.arange(0, len(records), self.block_records)
+        columns = _columns(records)
+        mins = np.empty((len(offsets), len(self.columns)))
+        maxs = np.empty((len(offsets), len(self.columns)))
+        for i, values in enumerate(columns.values()):
+            values = np.asarray(values, dtype=float)
+            mins[:, i] = np.fmin.reduceat(values, offsets)  # NaNs never match
+            maxs[:, i] = np.fmax.reduceat(values, offsets)
+        time_sorted = np.ones(len(offsets), dtype=bool)
+        if "timestamp" in columns:
+            in_order = np.diff(columns["timestamp"], prepend=-np.inf) >= 0
+            time_sorted = np.logical_and.reduceat(in_order, offsets)
+        return {
+            "records": start + len(records),
+            "mins": np.concatenate([zone_map["mins"][:full_blocks], mins]),
+            "maxs": np.concatenate([zone_map["maxs"][:full_blocks], maxs]),
+            "time_sorted": np.concatenate(
+                [zone_map["time_sorted"][:full_blocks], time_sorted]
+            ),
+        }
+
+    def _save_zone_map(self, index, zone_map):
+        path = self._zone_map_path(index)
+        try:
+            with open(path + ".tmp", "wb") as f:
+                np.savez(
+                    f,
+                    block_records=self.block_records,
+                    columns=np.array(self.columns),
+                    **zone_map,
+                )
+            os.replace(path + ".tmp", path)  # Readers never see half a file
+        except OSError:
+            pass  # E.g. a read-only log; the index is just rebuilt next time
+
+
+def _columns(records):
+    """Records' fields as named columns; per-channel fields get one per channel"""
+    columns = {}
+    for name in records.dtype.names:
+        values = records[name]
+        if values.ndim == 1:
+            columns[name] = values
+        else:
+            values = values.reshape(len(records), int(np.prod(values.shape[1:])))
+            for channel in range(values.shape[1]):
+                columns[f"{name}_{channel + 1}"] = values[:, channel]
+    return columns
+
+
+# One record per block of samples written by a TraceRecorder
+TRACE_INDEX_DTYPE = np.dtype(
+    [
+        ("chunk", np.int32),
+        ("offset", np.int64),  # Of the block's first sample, in the chunk
+        ("samples", np.int64),
+        ("start_ms", np.float64),  # Time of the block's first sample
+    ]
+)
+
+
+class TraceRecorder(_BackgroundWriter):
+    """Record raw signals, channels x samples, to preallocated memmapped chunks.
+
+    'append' queues one block of samples (e.g. a window from
+    DataGenerator._generate_signal) and the time of its first sample; the
+    writer thread (see _BackgroundWriter) copies each block straight into a
+    chunk file mapped into memory, one row per channel, so samples are only
+    ever copied array to array. Each chunk is allocated on disk up front,
+    with room for 'chunk_samples' samples per channel after the header.
+
+    A chunk only holds contiguous samples: after a gap in time (e.g. when
+    acquisition was stopped and started again) the next block starts a new
+    chunk. So does a block that doesn't fit in what's left of the current
+    chunk, unless it's bigger than a whole chunk. Every block also gets a
+    record in an index (an event log with prefix "traces_index", see
+    TRACE_INDEX_DTYPE), written after its samples, so a reader never sees
+    samples that aren't there yet. TraceLog reads both back.
+    """
+
+    UNITS = "samples"
+
+    def __init__(
+        self,
+        directory,
+        num_channels,
+        sampling_interval,
+        dtype=np.float64,
+        metadata=None,
+        chunk_samples=1 << 22,
+        flush_interval=0.5,
+        batch_samples=1 << 16,
+        max_pending_samples=1 << 25,
+        fsync=False,
+    ):
+        self.directory = directory
+        self.num_channels = num_channels
+        self.sampling_interval = sampling_interval
+        self.dtype = np.dtype(dtype)
+        self.metadata = {} if metadata is None else dict(metadata)
+        self.chunk_samples = int(chunk_samples)
+        self.fsync = fsync
+
+        os.makedirs(directory, exist_ok=True)
+        self._next_chunk = len(_chunk_paths(directory, "traces"))
+        self._chunk = None  # The current chunk's memmap
+        self._chunk_count = 0  # Samples (per channel) in it
+        self._next_start_ms = None  # Where the next block continues this chunk
+        self._index = EventRecorder(
+            directory,
+            TRACE_INDEX_DTYPE,
+            flush_interval=flush_interval,
+            fsync=fsync,  # Or a crash could lose the index of durable samples
+            prefix="traces_index",
+        )
+        super().__init__(flush_interval, batch_samples, max_pending_samples)
+
+    def append(self, start_ms, block):
+        """Queue a (channels x samples) array; don't modify it afterwards"""
+        block = np.asarray(block)
+        if block.ndim != 2 or len(block) != self.num_channels:
+            raise ValueError(
+                f"Expected {self.num_channels} x samples, not {block.shape}"
+            )
+        if block.shape[1] > 0:
+            self._queue((float(start_ms), block), block.shape[1])
+
+    def stats(self):
+        return {**super().stats(), "chunks": self._next_chunk}
+
+    def _write_batch(self, blocks):
+        index = []
+        for start_ms, block in blocks:
+            contiguous = self._next_start_ms is not None and abs(
+                start_ms - self._next_start_ms
+            ) < (self.sampling_interval / 2)
+            space = self.chunk_samples - self._chunk_count
+            # Keep blocks whole where we can, so they replay as they came
+            fits_new_chunk = space < block.shape[1] <= self.chunk_samples
+            if not contiguous or fits_new_chunk:
+                self._open_chunk()
+            written = 0
+            while written < block.shape[1]:
+                if self._chunk_count == self.chunk_samples:
+                    self._open_chunk()
+                n = min(
+                    block.shape[1] - written, self.chunk_samples - self._chunk_count
+                )
+                offset = self._chunk_count
+                self._chunk[:, offset : offset + n] = block[:, written : written + n]
+                index.append(
+                    (
+                        self._next_chunk - 1,
+                        offset,
+                        n,
+                        start_ms + written * self.sampling_interval,
+                    )
+                )
+                self._chunk_count += n
+                written += n
+            self._next_start_ms = start_ms + written * self.sampling_interval
+            with self._condition:
+                self.units_written += written
+                self.bytes_written += block[:, :written].size * self.dtype.itemsize
+        if self.fsync:
+            self._chunk.flush()
+        self._index.append(np.array(index, dtype=TRACE_INDEX_DTYPE))
+
+    def _finish(self):
+        try:
+            if self._chunk is not None:
+                self._chunk.flush()
+                self._chunk = None
+        finally:
+            self._index.close()
+
+    def _open_chunk(self):
+        if self._chunk is not None:
+            self._chunk.flush()
+        path = _chunk_path(self.directory, "traces", self._next_chunk)
+        with open(path, "xb") as f:
+            _write_header(
+                f,
+                {
+                    "version": FORMAT_VERSION,
+                    "dtype": np.lib.format.dtype_to_descr(self.dtype),
+                    "shape": [self.num_channels, self.chunk_samples],
+                    "chunk": self._next_chunk,
+                    "created": time.time(),
+                    "sampling_interval_ms": self.sampling_interval,
+                    "metadata": self.metadata,
+                },
+            )
+            size = (
+                HEADER_SIZE
+                + self.num_channels * self.chunk_samples * self.dtype.itemsize
+            )
+            if hasattr(os, "posix_fallocate"):  # Reserve the disk space now
+                os.posix_fallocate(f.fileno(), 0, size)
+            else:
+                f.truncate(size)
+        self._chunk = np.memmap(
+            path,
+            dtype=self.dtype,
+            mode="r+",
+            offset=HEADER_SIZE,
+            shape=(self.num_channels, self.chunk_samples),
+        )
+        self._next_chunk += 1
+        self._chunk_count = 0
+
+
+class TraceLog:
+    """Read a TraceRecorder's signals back, without copying them off disk.
+
+    'index' has a TRACE_INDEX_DTYPE record per block written, and
+    'chunk_start_ms' the time of each chunk's first sample. Call 'refresh'
+    to see blocks written since the log was opened.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.refresh()
+
+    def refresh(self):
+        self.paths = _chunk_paths(self.directory, "traces")
+        if len(self.paths) == 0:
+            raise FileNotFoundError(f"No traces in {self.directory}")
+        self.header = read_header(self.paths[0])
+        self.dtype = self.header["dtype"]
+        self.num_channels = self.header["shape"][0]
+        self.sampling_interval = self.header["sampling_interval_ms"]
+        self.metadata = self.header["metadata"]
+        self.index = EventLog(self.directory, prefix="traces_index").read()
+        self.chunk_samples = np.bincount(
+            self.index["chunk"], self.index["samples"], minlength=len(self.paths)
+        ).astype(np.int64)
+        first_blocks = np.flatnonzero(np.diff(self.index["chunk"], prepend=-1) != 0)
+        self.chunk_start_ms = np.full(len(self.paths), np.nan)
+        self.chunk_start_ms[self.index["chunk"][first_blocks]] = self.index["start_ms"][
+            first_blocks
+        ]
+
+    @property
+    def num_samples(self):
+        """Per channel"""
+        return int(self.chunk_samples.sum())
+
+    def chunk(self, index):
+        """A chunk's recorded (channels x samples) as a read-only memmap"""
+        length = self.chunk_samples[index]
+        if length == 0:
+            return np.zeros((self.num_channels, 0), dtype=self.dtype)
+        shape = self.header["shape"]
+        chunk = np.memmap(
+            self.paths[index],
+            dtype=self.dtype,
+            mode="r",
+            offset=HEADER_SIZE,
+            shape=(shape[0], read_header(self.paths[index])["shape"][1]),
+        )
+        return chunk[:, :length]
+
+    def blocks(self):
+        """(start_ms, channels x samples memmap) for each block, in order"""
+        chunks = {}
+        for chunk, offset, samples, start_ms in self.index:
+            if chunk not in chunks:
+                chunks = {chunk: self.chunk(chunk)}  # One chunk mapped at a time
+            yield start_ms, chunks[chunk][:, offset : offset + samples]
+
+    def read(self, start_ms, stop_ms):
+        """Sample times and (channels x samples) copies for start_ms <= t < stop_ms"""
+        times, signals = [], []
+        for chunk, start in enumerate(self.chunk_start_ms):
+            if self.chunk_samples[chunk] == 0:
+                continue
+            first = max(0, int(np.ceil((start_ms - start) / self.sampling_interval)))
+            last = min(
+                self.chunk_samples[chunk],
+                int(np.ceil((stop_ms - start) / self.sampling_interval)),
+            )
+            if first < last:
+                times.append(start + np.arange(first, last) * self.sampling_interval)
+                signals.append(np.array(self.chunk(chunk)[:, first:last]))
+        if len(times) == 0:
+            return np.zeros(0), np.zeros((self.num_channels, 0), dtype=self.dtype)
+        return np.concatenate(times), np.concatenate(signals, axis=1)
+
+
+class TraceReplay:
+    """Play recorded signals back, block by block, straight from the memmaps.
+
+    Iterate to get (start_ms, channels x samples) blocks, as they were
+    recorded (e.g. DataGenerator windows); the signals are read-only views of
+    the mapped files, not copies. With paced=True, blocks come out at the
+    rate they were acquired, times 'speed' (gaps in the recording are
+    skipped); otherwise as fast as they're asked for.
+    """
+
+    def __init__(self, directory, paced=True, speed=1.0):
+        self.log = TraceLog(directory)
+        self.paced = paced
+        self.speed = speed
+        self.num_channels = self.log.num_channels
+        self.sampling_interval = self.log.sampling_interval
+        self.windows = 0
+        self.samples = 0  # Per channel, so far
+        self.started = None  # time.perf_counter() of the first block
+        self._blocks = self.log.blocks()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start_ms, block = next(self._blocks)
+        if self.started is None:
+            self.started = time.perf_counter()
+        elif self.paced:
+            played_s = self.samples * self.sampling_interval / 1e3 / self.speed
+            delay = self.started + played_s - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        self.windows += 1
+        self.samples += block.shape[1]
+        return start_ms, block
+
+
+def _chunk_path(directory, prefix, index):
+    return os.path.join(directory, f"{prefix}_{index:06d}.bin")
+
+
+def _chunk_paths(directory, prefix):
+    return sorted(glob.glob(os.path.join(directory, f"{prefix}_[0-9]*.bin")))
+
+
+def benchmark_event_recorder(
+    duration=5, batch_size=100, chunk_records=1 << 20, directory=None
+):
+    """Sustained write throughput of an EventRecorder
+
+    Appends batches of 'batch_size' drop events (like one window's worth)
+    as fast as possible for 'duration' seconds, then closes the recorder.
+    Appending pauses whenever the writer falls far behind, so this measures
+    the writer's sustained throughput, up to the last record reaching the
+    OS, and the time 'append' takes (what acquisition pays).
+    """
+    from data_generator import event_dtype
+
+    dtype = event_dtype()
+    rng = np.random.default_rng(0)
+    batch = np.zeros(batch_size, dtype=dtype)
+    batch["auc"] = 10 ** rng.uniform(3, 6, batch["auc"].shape)
+    batch["timestamp"] = np.arange(batch_size)
+    temporary = directory is None
+    if temporary:
+        directory = tempfile.mkdtemp(prefix="event_log_")
+    try:
+        recorder = EventRecorder(directory, dtype, chunk_records=chunk_records)
+        append_s = []
+        t0 = time.perf_counter()
+        while time.perf_counter() - t0 < duration:
+            records = batch.copy()  # Each window's events are a new array
+            t = time.perf_counter()
+            recorder.append(records)
+            append_s.append(time.perf_counter() - t)
+            # Stay under the recorder's limit, to measure what it can sustain
+            while recorder.stats()["records_pending"] > recorder.max_pending // 2:
+                time.sleep(0.001)
+        recorder.close()
+        elapsed = time.perf_counter() - t0
+        stats = recorder.stats()
+        log = EventLog(directory)
+        assert len(log) == stats["records_written"]
+    finally:
+        if temporary:
+            shutil.rmtree(directory)
+    return {
+        "records_per_s": stats["records_written"] / elapsed,
+        "MB_per_s": stats["bytes_written"] / elapsed / 1e6,
+        "append_us": {
+            "p50": 1e6 * float(np.percentile(append_s, 50)),
+            "p99": 1e6 * float(np.percentile(append_s, 99)),
+        },
+        **stats,
+    }
+
+
+def benchmark_event_index(num_records=1 << 23, block_records=1 << 12, directory=None):
+    """Query times with an EventIndex vs. scanning the whole EventLog
+
+    Records 'num_records' drop events, one every millisecond, then runs
+    range, threshold and gate queries both ways and checks they agree.
+    The log stays in the OS's page cache, so scans run at memory speed;
+    from disk, skipping blocks saves much more. Also times building the
+    index, and reopening it from its cached zone maps.
+    """
+    from data_generator import event_dtype, event_features
+    from sorting import RectangleGate
+
+    dtype = event_dtype()
+    rng = np.random.default_rng(0)
+    temporary = directory is None
+    if temporary:
+        directory = tempfile.mkdtemp(prefix="event_index_")
+    try:
+        recorder = EventRecorder(directory, dtype)
+        batch_records = 1 << 16
+        for start in range(0, num_records, batch_records):
+            events = np.zeros(min(batch_records, num_records - start), dtype=dtype)
+            events["timestamp"] = start + np.arange(len(events))
+            events["width"] = rng.uniform(0.1, 1, len(events))
+            events["auc"] = 10 ** rng.normal(4.5, 0.5, events["auc"].shape)
+            recorder.append(events)
+            while recorder.stats()["records_pending"] > recorder.max_pending // 2:
+                time.sleep(0.001)
+        recorder.close()
+
+        t0 = time.perf_counter()
+        index = EventIndex(directory, block_records=block_records)
+        build_s = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        index = EventIndex(directory, block_records=block_records)
+        reopen_s = time.perf_counter() - t0
+
+        middle = num_records / 2
+        high_auc = 10 ** (4.5 + 4.5 * 0.5)  # 4.5 sigma: a few per million
+        gate = RectangleGate("auc_1", "auc_2", (1e5, 2e5), (1e5, 2e5))
+        queries = {
+            "1 s": ({"start_ms": middle, "stop_ms": middle + 1e3}, None),
+            "1 min, auc_1 > 1e5": (
+                {"start_ms": middle, "stop_ms": middle + 6e4, "auc_1": (1e5, None)},
+                None,
+            ),
+            f"auc_1 > {high_auc:.3g}": ({"auc_1": (high_auc, None)}, None),
+            "10 min, in a gate": (
+                {"start_ms": middle, "stop_ms": middle + 6e5},
+                gate,
+            ),
+        }
+        results = {}
+        for name, (bounds, gate) in queries.items():
+            t0 = time.perf_counter()
+            found = index.query(gate=gate, **bounds)
+            query_s = time.perf_counter() - t0
+
+            t0 = time.perf_counter()
+            scanned = []
+            for chunk in index.log.chunks():
+                keep = np.ones(len(chunk), dtype=bool)
+                timestamps = chunk["timestamp"]
+                keep &= timestamps >= bounds.get("start_ms", -np.inf)
+                keep &= timestamps < bounds.get("stop_ms", np.inf)
+                if "auc_1" in bounds:
+                    keep &= chunk["auc"][:, 0] >= bounds["auc_1"][0]
+                if gate is not None:
+                    keep &= gate.evaluate(event_features(chunk))
+                scanned.append(chunk[keep])
+            scanned = np.concatenate(scanned)
+            scan_s = time.perf_counter() - t0
+
+            assert np.array_equal(found, scanned), name
+            results[name] = {
+                "records": len(found),
+                "query_ms": 1e3 * query_s,
+                "scan_ms": 1e3 * scan_s,
+                "blocks_read_percent": 100
+                * index.last_query["blocks_read"]
+                / index.last_query["blocks"],
+            }
+    finally:
+        if temporary:
+            shutil.rmtree(directory)
+    return {
+        "records": num_records,
+        "build_s": build_s,
+        "reopen_ms": 1e3 * reopen_s,
+        "queries": results,
+    }
+
+
+def benchmark_trace_recorder(
+    signal_s=300,
+    num_channels=2,
+    sampling_interval=0.02,
+    window_ms=100,
+    directory=None,
+):
+    """Write bandwidth and CPU cost of a TraceRecorder
+
+    Appends 'signal_s' seconds of signal, one DataGenerator-sized window at a
+    time, as fast as the recorder can sustain (like benchmark_event_recorder).
+    Besides throughput, reports the writer thread's CPU time per second of
+    signal recorded, i.e. the fraction of a CPU that recording takes during
+    real-time acquisition.
+    """
+    window_samples = int(round(window_ms / sampling_interval))
+    num_windows = int(1000 * signal_s / window_ms)
+    rng = np.random.default_rng(0)
+    window = rng.normal(0.01, 0.01, (num_channels, window_samples))
+    temporary = directory is None
+    if temporary:
+        directory = tempfile.mkdtemp(prefix="trace_log_")
+    try:
+        recorder = TraceRecorder(directory, num_channels, sampling_interval)
+        append_s = []
+        t0 = time.perf_counter()
+        for i in range(num_windows):
+            t = time.perf_counter()
+            recorder.append(i * window_ms, window)
+            append_s.append(time.perf_counter() - t)
+            while recorder.stats()["samples_pending"] > recorder.max_pending // 2:
+                time.sleep(0.001)
+        recorder.close()
+        elapsed = time.perf_counter() - t0
+        stats = recorder.stats()
+        log = TraceLog(directory)
+        assert (
+            log.num_samples == stats["samples_written"] == num_windows * window_samples
+        )
+        assert np.array_equal(log.read(0, window_ms)[1], window)
+    finally:
+        if temporary:
+            shutil.rmtree(directory)
+    return {
+        "MB_per_s": stats["bytes_written"] / elapsed / 1e6,
+        "realtime_factor": signal_s / elapsed,
+        "writer_cpu_percent_at_realtime": 100 * stats["writer_cpu_s"] / signal_s,
+        "append_us": {
+            "p50": 1e6 * float(np.percentile(append_s, 50)),
+            "p99": 1e6 * float(np.percentile(append_s, 99)),
+        },
+        **stats,
+    }
+
+
+class TestBackgroundWriter(ct.MyTestClass):
+    """Run with: python recorders.py --test"""
+
+    class _FailingEventRecorder(EventRecorder):
+        def _write_batch(self, batches):
+            if self.flushes > 0:  # Write the first batch, then fail
+                raise OSError(errno.ENOSPC, "No space left on device")
+            super()._write_batch(batches)
+
+    class _FailingTraceRecorder(TraceRecorder):
+        def _write_batch(self, blocks):
+            raise OSError(errno.ENOSPC, "No space left on device")
+
+    @staticmethod
+    def _expect_disk_full(func, *args):
+        try:
+            func(*args)
+        except OSError as e:
+            assert e.errno == errno.ENOSPC
+        else:
+            raise AssertionError("We didn't get the exception we expected...")
+
+    def test_a_failed_write_is_raised(self):
+        directory = tempfile.mkdtemp(prefix="recorder_test_")
+        try:
+            records = np.zeros(10, dtype=TRACE_INDEX_DTYPE)
+            recorder = self._FailingEventRecorder(
+                directory, TRACE_INDEX_DTYPE, batch_records=10
+            )
+            recorder.append(records)
+            while recorder.stats()["flushes"] == 0:
+                time.sleep(0.001)
+            recorder.append(records)  # The writer fails on this one
+            recorder._thread.join(timeout=5)
+            assert not recorder._thread.is_alive()
+            assert recorder._file.closed  # _finish still ran
+            self._expect_disk_full(recorder.append, records)
+            self._expect_disk_full(recorder.close)
+            assert recorder.stats()["records_written"] == 10
+            assert recorder.stats()["records_dropped"] == 10
+            assert len(EventLog(directory).read()) == 10
+        finally:
+            shutil.rmtree(directory)
+
+    def test_a_failed_trace_write_closes_the_index(self):
+        directory = tempfile.mkdtemp(prefix="recorder_test_")
+        try:
+            recorder = self._FailingTraceRecorder(directory, 2, 0.02)
+            recorder.append(0, np.zeros((2, 100)))
+            self._expect_disk_full(recorder.close)
+            assert not recorder._index._thread.is_alive()
+            assert recorder._index._file is None  # Nothing was ever indexed
+            self._expect_disk_full(recorder.append, 2, np.zeros((2, 100)))
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestEventIndex(ct.MyTestClass):
+    """Run with: python recorders.py --test"""
+
+    @staticmethod
+    def _events(num_events, start_ms, seed):
+        from data_generator import event_dtype
+
+        rng = np.random.default_rng(seed)
+        events = np.zeros(num_events, dtype=event_dtype())
+        events["timestamp"] = start_ms + np.arange(num_events)
+        events["width"] = rng.uniform(0.1, 1, num_events)
+        events["auc"] = 10 ** rng.normal(4.5, 0.5, events["auc"].shape)
+        return events
+
+    @staticmethod
+    def _scan(log, start_ms, stop_ms, min_auc_1):
+        records = log.read()
+        keep = (records["timestamp"] >= start_ms) & (records["timestamp"] < stop_ms)
+        return records[keep & (records["auc"][:, 0] >= min_auc_1)]
+
+    def test_query_matches_a_full_scan(self):
+        directory = tempfile.mkdtemp(prefix="event_index_test_")
+        try:
+            recorder = EventRecorder(
+                directory, self._events(0, 0, 0).dtype, chunk_records=20000
+            )
+            recorder.append(self._events(100000, 0, seed=0))
+            recorder.close()
+            index = EventIndex(directory, block_records=512)
+            log = EventLog(directory)
+            for start_ms, stop_ms, min_auc_1 in [
+                (30000, 45000, 1e5),  # Across a chunk boundary
+                (0, 100000, 3e6),  # A rare AUC, anywhere
+                (12345.5, 12400, 0),
+                (200000, 300000, 0),  # After the end
+            ]:
+                found = index.query(start_ms, stop_ms, auc_1=(min_auc_1, None))
+                expected = self._scan(log, start_ms, stop_ms, min_auc_1)
+                assert np.array_equal(found, expected), (start_ms, stop_ms)
+                assert index.last_query["records"] == len(expected)
+                read = index.last_query["blocks_read"]
+                assert read < index.last_query["blocks"] / 2, index.last_query
+            assert len(index.query(30000, 45000, auc_1=(1e5, None))) > 0
+            assert len(index.query(0, 100000, auc_1=(3e6, None))) > 0
+        finally:
+            shutil.rmtree(directory)
+
+    def test_refresh_and_cached_zone_maps(self):
+        directory = tempfile.mkdtemp(prefix="event_index_test_")
+        try:
+            dtype = self._events(0, 0, 0).dtype
+            recorder = EventRecorder(directory, dtype, chunk_records=20000)
+            recorder.append(self._events(30000, 0, seed=1))
+            recorder.close()
+            index = EventIndex(directory, block_records=512)
+            recorder = EventRecorder(directory, dtype, chunk_records=20000)
+            recorder.append(self._events(5000, 40000, seed=2))
+            recorder.close()
+            index.refresh()  # Indexes the new chunk
+            reopened = EventIndex(directory, block_records=512)  # From the cache
+            assert len(glob.glob(os.path.join(directory, "*.zonemap.npz"))) == 3
+            log = EventLog(directory)
+            expected = self._scan(log, 25000, 42000, 5e4)
+            assert 0 < len(expected)
+            for i in (index, reopened):
+                found = i.query(25000, 42000, auc_1=(5e4, None))
+                assert np.array_equal(found, expected)
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    if "--test" in sys.argv:
+        TestBackgroundWriter().run()
+        TestEventIndex().run()
+        sys.exit()
+    for batch_size in (100, 10000):
+        result = benchmark_event_recorder(batch_size=batch_size)
+        print(
+            f"Batches of {batch_size:>5}: {result['records_per_s']:>12,.0f} records/s "
+            f"({result['MB_per_s']:.0f} MB/s) in {result['chunks']} chunks, "
+            f"{result['records_dropped']} dropped; append "
+            f"p50 {result['append_us']['p50']:.1f} µs, "
+            f"p99 {result['append_us']['p99']:.1f} µs"
+        )
+    result = benchmark_event_index()
+    print(
+        f"Event index over {result['records']:,} records: built in "
+        f"{result['build_s']:.2f} s, reopened in {result['reopen_ms']:.1f} ms"
+    )
+    for name, r in result["queries"].items():
+        print(
+            f"  {name:>22}: {r['query_ms']:8.2f} ms indexed vs. {r['scan_ms']:8.2f} ms "
+            f"scanned ({r['records']} records, {r['blocks_read_percent']:.2f}% "
+            f"of blocks read)"
+        )
+    for num_channels in (2, 8):
+        result = benchmark_trace_recorder(num_channels=num_channels)
+        print(
+            f"Traces, {num_channels} channels: {result['MB_per_s']:.0f} MB/s "
+            f"({result['realtime_factor']:.0f}x real time) in {result['chunks']} "
+            f"chunks; writer CPU {result['writer_cpu_percent_at_realtime']:.2f}% "
+            f"at real time; append p50 {result['append_us']['p50']:.1f} µs"
+        )
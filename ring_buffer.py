@@ -0,0 +1,131 @@
+"""A fixed-capacity buffer of recent rows, shared by the UI and the sort engine.
+
+Kept apart from ui_tools so code that doesn't draw anything (e.g. sorting,
+in acquisition and analysis processes) can use it without importing Bokeh.
+
+    python ring_buffer.py  # Run the tests
+"""
+
+import numpy as np
+
+import concurrency_tools as ct
+
+
+class RingBuffer:
+    """A fixed-capacity buffer of the most recent rows of a few columns.
+
+    Rows live in preallocated NumPy arrays in 'data', and 'extend' writes new
+    rows over the oldest ones, so adding n rows costs O(n) no matter how big
+    the buffer is. Empty slots hold NaN. Once the buffer wraps around, rows
+    aren't in chronological order; that's fine for a scatter plot, and
+    'ordered' gives you chronological order when you need it.
+
+    After each 'extend', 'evicted' holds the rows that were overwritten (NaN
+    for slots that were still empty), so summaries of the buffer's contents
+    can be kept up to date incrementally.
+    """
+
+    def __init__(self, columns, capacity):
+        self.capacity = int(capacity)
+        self.data = {name: np.full(self.capacity, np.nan) for name in columns}
+        self.count = 0  # Total number of rows ever added
+        self.evicted = {name: np.empty(0) for name in columns}
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def extend(self, new):
+        """Add rows from a dict of columns; return the slices that changed"""
+        n = len(next(iter(new.values())))
+        if n == 0 or self.capacity == 0:
+            self.count += n
+            self.evicted = {name: np.empty(0) for name in self.data}
+            return []
+        skipped = max(0, n - self.capacity)  # Rows that wouldn't survive anyway
+        n -= skipped
+        self.count += skipped
+        start = self.count % self.capacity
+        first = min(n, self.capacity - start)  # Rows before we wrap around
+        slices = [slice(start, start + first)]
+        if first < n:
+            slices.append(slice(0, n - first))
+        self.evicted = {
+            name: np.concatenate([column[sl] for sl in slices])
+            for name, column in self.data.items()
+        }
+        for name, column in self.data.items():
+            values = np.asarray(new[name], dtype=column.dtype)[skipped:]
+            column[start : start + first] = values[:first]
+            column[: n - first] = values[first:]
+        self.count += n
+        return slices
+
+    def ordered(self, name):
+        """A chronological copy of one column, oldest row first"""
+        column = self.data[name]
+        if self.count <= self.capacity or self.capacity == 0:
+            return column[: len(self)].copy()
+        start = self.count % self.capacity
+        return np.concatenate((column[start:], column[:start]))
+
+    def resize(self, capacity):
+        """Change the capacity, keeping the most recent rows"""
+        capacity = int(capacity)
+        keep = min(len(self), capacity)
+        recent = {name: self.ordered(name)[len(self) - keep :] for name in self.data}
+        self.capacity = capacity
+        self.data = {name: np.full(capacity, np.nan) for name in self.data}
+        self.count = 0
+        self.extend(recent)
+
+
+class TestRingBuffer(ct.MyTestClass):
+    """Run with: python ring_buffer.py"""
+
+    @staticmethod
+    def _rows(first, stop):
+        x = np.arange(first, stop, dtype=float)
+        return {"x": x, "y": -x}
+
+    def test_wrap_around(self):
+        b = RingBuffer(["x", "y"], 5)
+        assert b.extend(self._rows(0, 3)) == [slice(0, 3)]
+        assert len(b) == 3 and np.isnan(b.data["x"][3:]).all()
+        assert b.extend(self._rows(3, 7)) == [slice(3, 5), slice(0, 2)]
+        assert len(b) == 5 and b.count == 7
+        assert np.array_equal(b.data["x"], [5, 6, 2, 3, 4])
+        assert np.array_equal(b.ordered("x"), [2, 3, 4, 5, 6])
+        assert np.array_equal(b.ordered("y"), [-2, -3, -4, -5, -6])
+        assert b.extend(self._rows(7, 7)) == []
+        assert b.count == 7
+
+    def test_overwritten_rows_are_evicted(self):
+        b = RingBuffer(["x", "y"], 4)
+        b.extend(self._rows(0, 3))
+        assert len(b.evicted["x"]) == 3 and np.isnan(b.evicted["x"]).all()
+        b.extend(self._rows(3, 6))  # Fills the last empty slot, then wraps
+        assert np.array_equal(b.evicted["x"], [np.nan, 0, 1], equal_nan=True)
+        assert np.array_equal(b.ordered("x"), [2, 3, 4, 5])
+        # More rows than fit: only the last 'capacity' are kept
+        b.extend(self._rows(6, 16))
+        assert np.array_equal(np.sort(b.evicted["y"]), [-5, -4, -3, -2])
+        assert np.array_equal(b.ordered("x"), [12, 13, 14, 15])
+        assert b.count == 16
+
+    def test_resize(self):
+        b = RingBuffer(["x", "y"], 5)
+        b.extend(self._rows(0, 8))
+        b.resize(3)  # Keeps the most recent rows
+        assert np.array_equal(b.ordered("x"), [5, 6, 7])
+        b.resize(6)  # Room to spare
+        assert len(b) == 3 and np.isnan(b.data["x"][3:]).all()
+        b.extend(self._rows(8, 12))
+        assert np.array_equal(b.ordered("x"), [6, 7, 8, 9, 10, 11])
+        assert np.array_equal(b.ordered("y"), -b.ordered("x"))
+        b.resize(0)
+        assert len(b) == 0 and len(b.ordered("x")) == 0
+        assert b.extend(self._rows(0, 2)) == []
+
+
+if __name__ == "__main__":
+    TestRingBuffer().run()
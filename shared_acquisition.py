@@ -0,0 +1,205 @@
+import atexit
+import collections
+import threading
+import time
+
+import numpy as np
+
+import concurrency_tools as ct
+from data_generator import DataGenerator
+
+
+class SharedAcquisition:
+    """One DataGenerator (and one analysis loop) for every Bokeh session.
+
+    Bokeh runs ui_layout.py once per browser session, but imported modules
+    are only imported once per server process, so 'get_shared_acquisition'
+    hands every session the same instance. A single poller thread fetches
+    snapshots from the generator and fans them out to each session's
+    Subscription, so CPU cost doesn't grow with the number of viewers.
+
+    Ownership rules for controls that change hardware state (start/stop,
+    gains, threshold, sorting gate):
+      - The session that has been connected the longest owns the hardware.
+        Only the owner can change it; other sessions are view-only, and
+        their controls mirror the owner's settings.
+      - When the owner disconnects, ownership passes to the next-oldest
+        session.
+      - When the last session disconnects, acquisition stops.
+    View state (buffer length, zoom, box-select gate statistics) belongs to
+    each session.
+    """
+
+    POLL_INTERVAL = 0.05  # s between snapshot fetches, shared by all sessions
+    HISTORY = 100  # snapshots of drop events a new session starts out with
+
+    def __init__(self):
+        self.dg = ct.ObjectInSubprocess(DataGenerator)
+        self.dg_lock = threading.Lock()
+        self._subscriptions_lock = threading.Lock()
+        self._subscriptions = []  # Oldest first; the first one is the owner
+        with self.dg_lock:
+            self.hardware_state = {
+                "generating": False,
+                "gain": list(self.dg.gain),
+                "thresh": self.dg.thresh,
+                "gate": self.dg.gate_val,
+            }
+            snapshot = self.dg.get_snapshot()
+        self.seq = snapshot["seq"]
+        self._traces = snapshot["traces"]
+        self._recent_events = collections.deque(maxlen=self.HISTORY)
+        if snapshot["events"] is not None:
+            self._recent_events.append(snapshot["events"])
+        self._closed = threading.Event()
+        self._poll_thread = threading.Thread(target=self._poll_loop, daemon=True)
+        self._poll_thread.start()
+        # atexit runs this before the generator's own (earlier registered)
+        # shutdown, so we don't use its pipe while it's closing
+        atexit.register(self.close)
+
+    def close(self):
+        """Stop polling the generator"""
+        self._closed.set()
+        self._poll_thread.join()
+
+    """ Subscriptions """
+
+    def subscribe(self, on_change=None):
+        """Start receiving snapshots; returns a Subscription
+
+        The first snapshot taken from it has the latest traces and recent
+        drop events, so a new viewer doesn't start with empty plots.
+        'on_change' is called (from whichever thread made the change) with no
+        arguments whenever the hardware state or its owner changes.
+        """
+        with self._subscriptions_lock:
+            subscription = Subscription(
+                self.seq, self._traces, self._recent_events, on_change
+            )
+            self._subscriptions.append(subscription)
+        self._notify()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._subscriptions_lock:
+            if subscription in self._subscriptions:
+                self._subscriptions.remove(subscription)
+            nobody_left = len(self._subscriptions) == 0
+        if nobody_left and self.hardware_state["generating"]:
+            with self.dg_lock:
+                self.dg.stop_generating()
+            self.hardware_state["generating"] = False
+        self._notify()
+
+    def is_owner(self, subscription):
+        with self._subscriptions_lock:
+            return (
+                len(self._subscriptions) > 0 and self._subscriptions[0] is subscription
+            )
+
+    def _notify(self):
+        with self._subscriptions_lock:
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            if subscription.on_change is not None:
+                subscription.on_change()
+
+    def _poll_loop(self):
+        delay = 0
+        while not self._closed.wait(timeout=delay):
+            t0 = time.perf_counter()
+            if len(self._subscriptions) > 0:
+                self._poll()
+            delay = max(0, self.POLL_INTERVAL - (time.perf_counter() - t0))
+
+    def _poll(self):
+        """Fetch what's new from the generator, and send it to every session"""
+        with self.dg_lock:
+            snapshot = self.dg.get_snapshot(self.seq)
+        with self._subscriptions_lock:
+            self.seq = snapshot["seq"]
+            if snapshot["traces"] is not None:
+                self._traces = snapshot["traces"]
+            if snapshot["events"] is not None:
+                self._recent_events.append(snapshot["events"])
+            for subscription in self._subscriptions:
+                subscription._publish(snapshot)
+
+    """ Hardware Controls (owner only) """
+
+    def start_generating(self, subscription):
+        self._control(subscription, "generating", True, "start_generating")
+
+    def stop_generating(self, subscription):
+        self._control(subscription, "generating", False, "stop_generating")
+
+    def set_gain(self, subscription, value, channel=1):
+        gain = list(self.hardware_state["gain"])
+        gain[channel - 1] = value
+        self._control(subscription, "gain", gain, "set_gain", value, channel)
+
+    def set_thresh(self, subscription, value):
+        self._control(subscription, "thresh", value, "set_thresh", value)
+
+    def set_gate_values(self, subscription, values):
+        self._control(subscription, "gate", values, "set_gate_values", values)
+
+    def _control(self, subscription, key, value, method_name, *args):
+        if not self.is_owner(subscription):
+            raise PermissionError(
+                "Only the session that owns the hardware can change it"
+            )
+        with self.dg_lock:
+            getattr(self.dg, method_name)(*args)
+            self.hardware_state[key] = value
+        self._notify()
+
+
+class Subscription:
+    """One session's view of a SharedAcquisition's snapshots.
+
+    Collects everything published since the last 'take', so a slow session
+    skips intermediate traces but never loses drop events (up to
+    MAX_PENDING_WINDOWS snapshots' worth, if it stops taking altogether).
+    """
+
+    MAX_PENDING_WINDOWS = 1000
+
+    def __init__(self, seq, traces, recent_events=(), on_change=None):
+        self.on_change = on_change
+        self._lock = threading.Lock()
+        self._seq = seq
+        self._traces = traces
+        self._events = collections.deque(recent_events, self.MAX_PENDING_WINDOWS)
+
+    def _publish(self, snapshot):
+        with self._lock:
+            self._seq = snapshot["seq"]
+            if snapshot["traces"] is not None:
+                self._traces = snapshot["traces"]
+            if snapshot["events"] is not None:
+                self._events.append(snapshot["events"])
+
+    def take(self):
+        """Everything new since the last take, like DataGenerator.get_snapshot"""
+        with self._lock:
+            traces, self._traces = self._traces, None
+            windows = list(self._events)
+            self._events.clear()
+            seq = self._seq
+        events = np.concatenate(windows) if len(windows) > 0 else None
+        return {"seq": seq, "traces": traces, "events": events}
+
+
+_shared_acquisition = None
+_shared_acquisition_lock = threading.Lock()
+
+
+def get_shared_acquisition():
+    """The SharedAcquisition for this server process, created on first use"""
+    global _shared_acquisition
+    with _shared_acquisition_lock:
+        if _shared_acquisition is None:
+            _shared_acquisition = SharedAcquisition()
+        return _shared_acquisition
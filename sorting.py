@@ -0,0 +1,660 @@
+import sys
+import threading
+import time
+
+import numpy as np
+
+import concurrency_tools as ct
+
+from ring_buffer import RingBuffer
+
+
+class Gate:
+    """Base class of sorting gates; combine them with &, | and ~.
+
+    A gate is a region of feature space. Features are named arrays with one
+    value per drop, e.g. "auc_1", "auc_2", "max_signal_1", "max_signal_2"
+    and "width". 'compile' turns a whole tree of gates into one vectorized
+    function of those arrays.
+    """
+
+    def __and__(self, other):
+        return And(self, other)
+
+    def __or__(self, other):
+        return Or(self, other)
+
+    def __invert__(self):
+        return Not(self)
+
+    def features(self):
+        """Names of the features this gate looks at"""
+        return set().union(*(child.features() for child in self._children()))
+
+    def _children(self):
+        return ()
+
+    def bounds(self):
+        """{feature: (low, high)}, a box every drop in the gate lies within
+
+        For skipping data that can't be in the gate (see
+        recorders.EventIndex); features the gate doesn't limit are left out.
+        """
+        return {}
+
+    def _key(self):
+        """Equal for gates that always give the same result"""
+        raise NotImplementedError
+
+    def __eq__(self, other):
+        return isinstance(other, Gate) and self._key() == other._key()
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def compile(self):
+        """A function of a dict of feature arrays, returning a bool array"""
+        return _compile(self)
+
+    def evaluate(self, features):
+        return self.compile()(features)
+
+
+class RectangleGate(Gate):
+    """Drops with 'x' and 'y' features within ranges (inclusive)"""
+
+    def __init__(self, x, y, x_range, y_range):
+        self.x, self.y = x, y
+        self.x_range = tuple(sorted(float(v) for v in x_range))
+        self.y_range = tuple(sorted(float(v) for v in y_range))
+
+    @classmethod
+    def from_box(cls, values, x="auc_1", y="auc_2"):
+        """From a box select's {"x0": [...], "y0": ..., "x1": ..., "y1": ...}"""
+        return cls(
+            x,
+            y,
+            (values["x0"][0], values["x1"][0]),
+            (values["y0"][0], values["y1"][0]),
+        )
+
+    def features(self):
+        return {self.x, self.y}
+
+    def bounds(self):
+        return _intersect_bounds({self.x: self.x_range}, {self.y: self.y_range})
+
+    def _key(self):
+        return ("rectangle", self.x, self.y, self.x_range, self.y_range)
+
+    def __repr__(self):
+        return f"RectangleGate({self.x!r}, {self.y!r}, {self.x_range}, {self.y_range})"
+
+
+class PolygonGate(Gate):
+    """Drops whose 'x' and 'y' features lie inside a polygon.
+
+    With log=True (the default) the polygon's edges are straight lines in
+    log10 space, like a polygon drawn on a log-log scatter plot.
+    """
+
+    def __init__(self, x, y, vertices, log=True):
+        self.x, self.y = x, y
+        self.vertices = tuple((float(vx), float(vy)) for vx, vy in vertices)
+        self.log = log
+        if len(self.vertices) < 3:
+            raise ValueError("A polygon gate needs at least 3 vertices")
+
+    def features(self):
+        return {self.x, self.y}
+
+    def bounds(self):
+        xs, ys = zip(*self.vertices)
+        return _intersect_bounds(
+            {self.x: (min(xs), max(xs))}, {self.y: (min(ys), max(ys))}
+        )
+
+    def _key(self):
+        return ("polygon", self.x, self.y, self.vertices, self.log)
+
+    def __repr__(self):
+        return f"PolygonGate({self.x!r}, {self.y!r}, <{len(self.vertices)} vertices>)"
+
+
+class ThresholdGate(Gate):
+    """Drops with a feature between 'low' and 'high' (inclusive; None: no limit)"""
+
+    def __init__(self, feature, low=None, high=None):
+        self.feature = feature
+        self.low = -np.inf if low is None else float(low)
+        self.high = np.inf if high is None else float(high)
+
+    def features(self):
+        return {self.feature}
+
+    def bounds(self):
+        return {self.feature: (self.low, self.high)}
+
+    def _key(self):
+        return ("threshold", self.feature, self.low, self.high)
+
+    def __repr__(self):
+        return f"ThresholdGate({self.feature!r}, {self.low}, {self.high})"
+
+
+class And(Gate):
+    def __init__(self, *gates):
+        self.gates = gates
+
+    def _children(self):
+        return self.gates
+
+    def bounds(self):
+        return _intersect_bounds(*(gate.bounds() for gate in self.gates))
+
+    def _key(self):
+        return ("and", frozenset(gate._key() for gate in self.gates))
+
+    def __repr__(self):
+        return f"And{self.gates!r}"
+
+
+class Or(Gate):
+    def __init__(self, *gates):
+        self.gates = gates
+
+    def _children(self):
+        return self.gates
+
+    def bounds(self):
+        # A feature is only limited if every alternative limits it
+        boxes = [gate.bounds() for gate in self.gates]
+        common = set(boxes[0]).intersection(*boxes[1:]) if boxes else set()
+        return {
+            feature: (
+                min(box[feature][0] for box in boxes),
+                max(box[feature][1] for box in boxes),
+            )
+            for feature in common
+        }
+
+    def _key(self):
+        return ("or", frozenset(gate._key() for gate in self.gates))
+
+    def __repr__(self):
+        return f"Or{self.gates!r}"
+
+
+class Not(Gate):
+    def __init__(self, gate):
+        self.gate = gate
+
+    def _children(self):
+        return (self.gate,)
+
+    def _key(self):
+        return ("not", self.gate._key())
+
+    def __repr__(self):
+        return f"Not({self.gate!r})"
+
+
+def _intersect_bounds(*boxes):
+    bounds = {}
+    for box in boxes:
+        for feature, (low, high) in box.items():
+            if feature in bounds:
+                low = max(low, bounds[feature][0])
+                high = min(high, bounds[feature][1])
+            bounds[feature] = (low, high)
+    return bounds
+
+
+def _compile(gate):
+    """Turn a gate tree into one vectorized function of feature arrays.
+
+    Each distinct primitive is evaluated once per call, however often it
+    appears in the tree, and each feature is converted to an array (and to
+    log10, for polygons) once per call, however many gates use it. Nested
+    Ands and Ors are flattened, so each combines its operands in one step.
+    """
+    primitives = {}  # key -> (index, evaluate function)
+
+    def build(node):
+        if isinstance(node, (And, Or)):
+            children = [build(child) for child in _flatten(node)]
+            reduce = (
+                np.logical_and.reduce if isinstance(node, And) else np.logical_or.reduce
+            )
+            return lambda results: reduce([child(results) for child in children])
+        if isinstance(node, Not):
+            child = build(node.gate)
+            return lambda results: ~child(results)
+        key = node._key()
+        if key not in primitives:
+            primitives[key] = (len(primitives), _compile_primitive(node))
+        index = primitives[key][0]
+        return lambda results: results[index]
+
+    combine = build(gate)
+    evaluators = [evaluate for _, evaluate in sorted(primitives.values())]
+
+    def evaluate(features):
+        columns = _Columns(features)
+        return combine([evaluate(columns) for evaluate in evaluators])
+
+    return evaluate
+
+
+def _flatten(node):
+    """Operands of nested Ands (or Ors), e.g. And(a, And(b, c)) -> a, b, c"""
+    for child in node.gates:
+        if type(child) is type(node):
+            yield from _flatten(child)
+        else:
+            yield child
+
+
+class _Columns:
+    """Feature arrays for one evaluation, converted once and cached"""
+
+    def __init__(self, features):
+        self._features = features
+        self._arrays = {}
+        self._logs = {}
+
+    def __getitem__(self, name):
+        if name not in self._arrays:
+            self._arrays[name] = np.asarray(self._features[name], dtype=float)
+        return self._arrays[name]
+
+    def log10(self, name):
+        if name not in self._logs:
+            with np.errstate(divide="ignore", invalid="ignore"):
+                self._logs[name] = np.log10(self[name])
+        return self._logs[name]
+
+
+def _compile_primitive(gate):
+    if isinstance(gate, RectangleGate):
+        (x0, x1), (y0, y1) = gate.x_range, gate.y_range
+
+        def evaluate(columns):
+            x, y = columns[gate.x], columns[gate.y]
+            return (x >= x0) & (x <= x1) & (y >= y0) & (y <= y1)
+
+        return evaluate
+    if isinstance(gate, ThresholdGate):
+
+        def evaluate(columns):
+            values = columns[gate.feature]
+            return (values >= gate.low) & (values <= gate.high)
+
+        return evaluate
+    if isinstance(gate, PolygonGate):
+        return _compile_polygon(gate)
+    raise TypeError(f"Don't know how to evaluate {gate!r}")
+
+
+def _compile_polygon(gate, max_bands=256, max_elements=1 << 20):
+    """Vectorized point-in-polygon (even-odd rule) for a PolygonGate
+
+    Points outside the polygon's bounding box are rejected first. The rest
+    count the edges crossed by a ray towards +x. To keep that cheap for
+    lassos with hundreds of vertices, the polygon's height is cut into up to
+    'max_bands' horizontal bands, and each point is only tested against the
+    edges that overlap its band (in chunks of up to 'max_elements'
+    point-edge pairs), so the cost hardly depends on the number of vertices.
+    """
+    vertices = np.array(gate.vertices)
+    if gate.log:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            vertices = np.log10(vertices)
+    x_min, y_min = vertices.min(axis=0)
+    x_max, y_max = vertices.max(axis=0)
+    x0, y0 = vertices.T
+    x1, y1 = np.roll(vertices, -1, axis=0).T
+    with np.errstate(divide="ignore", invalid="ignore"):
+        dx_dy = np.where(y1 != y0, (x1 - x0) / (y1 - y0), 0)
+
+    # Band boundaries at vertex heights (or their quantiles, if there are a
+    # lot of vertices), and the edges overlapping each band
+    bounds = np.unique(vertices[:, 1])
+    if len(bounds) > max_bands + 1:
+        bounds = np.unique(np.quantile(bounds, np.linspace(0, 1, max_bands + 1)))
+    low, high = np.minimum(y0, y1), np.maximum(y0, y1)
+    overlaps = (low < bounds[1:, np.newaxis]) & (high > bounds[:-1, np.newaxis])
+    num_edges = max(1, overlaps.sum(axis=1).max(initial=0))
+    # Pad each band's edges with a horizontal edge at infinity (never crossed)
+    band_edges = np.full((max(1, len(bounds) - 1), num_edges), len(vertices))
+    for band, edges in enumerate(overlaps):
+        band_edges[band, : np.count_nonzero(edges)] = np.flatnonzero(edges)
+    x0, y0, y1, dx_dy = (np.append(a, np.inf) for a in (x0, y0, y1, dx_dy))
+    chunk = max(1, max_elements // num_edges)
+
+    def evaluate(columns):
+        if gate.log:
+            x, y = columns.log10(gate.x), columns.log10(gate.y)
+        else:
+            x, y = columns[gate.x], columns[gate.y]
+        inside = (x >= x_min) & (x <= x_max) & (y >= y_min) & (y <= y_max)
+        candidates = np.flatnonzero(inside)
+        for start in range(0, len(candidates), chunk):
+            which = candidates[start : start + chunk]
+            px, py = x[which, np.newaxis], y[which, np.newaxis]
+            band = np.searchsorted(bounds, y[which], side="right") - 1
+            edges = band_edges[np.clip(band, 0, len(band_edges) - 1)]
+            straddles = (y0[edges] > py) != (y1[edges] > py)
+            with np.errstate(invalid="ignore"):  # inf * 0 on the padding
+                crossing_x = x0[edges] + (py - y0[edges]) * dx_dy[edges]
+            crosses = straddles & (px < crossing_x)
+            inside[which] = np.count_nonzero(crosses, axis=1) % 2 == 1
+        return inside
+
+    return evaluate
+
+
+def as_gate(values):
+    """A Gate from a Gate, a box select's dict of values, or None"""
+    if values is None or isinstance(values, Gate):
+        return values
+    return RectangleGate.from_box(values)
+
+
+class SortEngine:
+    """Decide, for every detected drop, whether to sort it.
+
+    The active gate can be any Gate; it's compiled once when it's set, and
+    each batch of drops is classified with a few vectorized operations. The
+    decision and the latency from detection to decision are recorded for
+    every drop. Counts cover every drop ever classified; the last 'history'
+    decisions and latencies are kept for statistics.
+    """
+
+    def __init__(self, history=100000):
+        self.history = history
+        self.num_sorted = 0
+        self.num_rejected = 0
+        self._lock = threading.Lock()
+        self._history = RingBuffer(["sorted", "latency"], history)
+        self.set_gate(None)
+
+    def set_gate(self, gate):
+        """Sort drops in 'gate' (see as_gate); with no gate, nothing is sorted"""
+        self.gate = as_gate(gate)
+        self._evaluate = None if self.gate is None else self.gate.compile()
+
+    def decide(self, features, detected_at):
+        """Classify a batch of drops; returns a bool array, True to sort.
+
+        'features' maps feature names (see Gate) to arrays, one value per
+        drop. 'detected_at' is the time.perf_counter() when the drops were
+        detected; one time for the whole batch, or one per drop.
+        """
+        if self._evaluate is None:
+            num_drops = len(next(iter(features.values())))
+            decisions = np.zeros(num_drops, dtype=bool)
+        else:
+            decisions = self._evaluate(features)
+        latencies = time.perf_counter() - np.asarray(detected_at, dtype=float)
+        self._record(decisions, np.broadcast_to(latencies, decisions.shape))
+        return decisions
+
+    def _record(self, decisions, latencies):
+        n = len(decisions)
+        num_sorted = int(np.count_nonzero(decisions))
+        with self._lock:
+            self.num_sorted += num_sorted
+            self.num_rejected += n - num_sorted
+            self._history.extend({"sorted": decisions, "latency": latencies})
+
+    def recent(self):
+        """The last 'history' decisions and latencies (s), oldest first"""
+        with self._lock:
+            decisions = self._history.ordered("sorted").astype(bool)
+            return decisions, self._history.ordered("latency")
+
+    def stats(self):
+        """Sorted and rejected counts, and recent latency percentiles in µs"""
+        with self._lock:
+            n = len(self._history)
+            latencies_us = 1e6 * self._history.data["latency"][:n]  # Any order
+            num_sorted, num_rejected = self.num_sorted, self.num_rejected
+        total = num_sorted + num_rejected
+        stats = {
+            "sorted": num_sorted,
+            "rejected": num_rejected,
+            "sorted_fraction": num_sorted / total if total > 0 else 0.0,
+            "latency_us": None,
+        }
+        if n > 0:
+            p50, p95, p99 = np.percentile(latencies_us, (50, 95, 99))
+            stats["latency_us"] = {
+                "p50": float(p50),
+                "p95": float(p95),
+                "p99": float(p99),
+                "max": float(latencies_us.max()),
+            }
+        return stats
+
+
+def _random_features(num_drops, seed=0):
+    rng = np.random.default_rng(seed)
+    return {
+        "auc_1": 10 ** rng.uniform(3, 6, num_drops),
+        "auc_2": 10 ** rng.uniform(3, 6, num_drops),
+        "max_signal_1": 10 ** rng.uniform(-2, 1, num_drops),
+        "max_signal_2": 10 ** rng.uniform(-2, 1, num_drops),
+        "width": rng.uniform(0.1, 1, num_drops),
+    }
+
+
+def _regular_polygon(center, radius, num_vertices):
+    """Vertices of a regular polygon in log10 space, as feature values"""
+    angles = np.linspace(0, 2 * np.pi, num_vertices, endpoint=False)
+    return 10 ** np.column_stack(
+        (center[0] + radius * np.cos(angles), center[1] + radius * np.sin(angles))
+    )
+
+
+BENCHMARK_GATES = {
+    "rectangle": RectangleGate("auc_1", "auc_2", (1e4, 1e5), (1e4, 1e5)),
+    "polygon (8 vertices)": PolygonGate(
+        "auc_1", "auc_2", _regular_polygon((4.5, 4.5), 0.7, 8)
+    ),
+    "lasso (200 vertices)": PolygonGate(
+        "auc_1", "auc_2", _regular_polygon((4.5, 4.5), 0.7, 200)
+    ),
+    "A and not B, 2 feature pairs": (
+        PolygonGate("auc_1", "auc_2", _regular_polygon((4.5, 4.5), 0.7, 8))
+        & ~RectangleGate("max_signal_1", "max_signal_2", (0.01, 0.1), (0.01, 0.1))
+        & ThresholdGate("width", 0.2, 0.8)
+    ),
+    "or of 10 polygons": Or(
+        *(
+            PolygonGate("auc_1", "auc_2", _regular_polygon((c, c), 0.2, 8))
+            for c in np.linspace(3.5, 5.5, 10)
+        )
+    ),
+}
+
+
+def benchmark_sort_engine(
+    num_drops=1000000, batch_sizes=(10, 100, 1000, 10000), gates=BENCHMARK_GATES
+):
+    """Drops classified per second, for a few gates and batch sizes
+
+    Each batch is decided as soon as it's "detected", so this measures the
+    engine itself: classification plus recording.
+    """
+    features = _random_features(num_drops)
+    results = {}
+    for name, gate in gates.items():
+        for batch_size in batch_sizes:
+            engine = SortEngine()
+            engine.set_gate(gate)
+            t0 = time.perf_counter()
+            for start in range(0, num_drops, batch_size):
+                batch = {
+                    key: values[start : start + batch_size]
+                    for key, values in features.items()
+                }
+                engine.decide(batch, time.perf_counter())
+            elapsed = time.perf_counter() - t0
+            results[name, batch_size] = {
+                "drops_per_s": num_drops / elapsed,
+                **engine.stats(),
+            }
+    return results
+
+
+def _brute_force_inside(vertices, x, y):
+    """Even-odd point-in-polygon, one point and one edge at a time"""
+    inside = np.zeros(len(x), dtype=bool)
+    for i, (px, py) in enumerate(zip(x, y)):
+        for (x0, y0), (x1, y1) in zip(vertices, np.roll(vertices, -1, axis=0)):
+            if (y0 > py) != (y1 > py):
+                if px < x0 + (py - y0) * (x1 - x0) / (y1 - y0):
+                    inside[i] = not inside[i]
+    return inside
+
+
+class TestGates(ct.MyTestClass):
+    """Run with: python sorting.py --test"""
+
+    def test_polygon_matches_brute_force(self):
+        rng = np.random.default_rng(0)
+        x, y = rng.uniform(-0.2, 1.2, (2, 2000))
+        features = {"a": x, "b": y}
+        star = [_regular_polygon((0.5, 0.5), 0.5, 5)[i] for i in (0, 2, 4, 1, 3)]
+        polygons = {
+            "triangle": [(0.1, 0.1), (0.9, 0.2), (0.4, 0.8)],
+            "bowtie": [(0, 0), (1, 1), (1, 0), (0, 1)],
+            "pentagram": star,
+            "lasso": _regular_polygon((0.5, 0.5), 0.4, 200),
+        }
+        for num_vertices in (4, 10, 50, 300):  # Random order: self-intersecting
+            polygons[f"random {num_vertices}"] = rng.random((num_vertices, 2))
+        for name, vertices in polygons.items():
+            expected = _brute_force_inside(np.array(vertices, dtype=float), x, y)
+            gate = PolygonGate("a", "b", vertices, log=False)
+            assert np.array_equal(gate.evaluate(features), expected), name
+            # Few bands and small chunks, so every code path gets a workout
+            evaluate = _compile_polygon(gate, max_bands=4, max_elements=100)
+            assert np.array_equal(evaluate(_Columns(features)), expected), name
+        # Even-odd: the middle of a pentagram is outside it
+        middle = {"a": np.array([0.5]), "b": np.array([0.5])}
+        assert not PolygonGate("a", "b", star, log=False).evaluate(middle)[0]
+
+    def test_polygon_in_log_space(self):
+        rng = np.random.default_rng(1)
+        auc_1, auc_2 = 10 ** rng.uniform(3, 6, (2, 2000))
+        vertices = 10 ** rng.uniform(3, 6, (12, 2))
+        gate = PolygonGate("auc_1", "auc_2", vertices)
+        expected = _brute_force_inside(
+            np.log10(vertices), np.log10(auc_1), np.log10(auc_2)
+        )
+        assert np.array_equal(gate.evaluate({"auc_1": auc_1, "auc_2": auc_2}), expected)
+
+    def test_rectangle_and_threshold_limits_are_inclusive(self):
+        features = {"a": np.array([1.0, 2.0, 3.0, 4.0]), "b": np.full(4, 5.0)}
+        box = RectangleGate("a", "b", (3, 2), (5, 5))  # Either order
+        assert box.evaluate(features).tolist() == [False, True, True, False]
+        low = ThresholdGate("a", low=3)
+        assert low.evaluate(features).tolist() == [False, False, True, True]
+        high = ThresholdGate("a", high=1)
+        assert high.evaluate(features).tolist() == [True, False, False, False]
+        box = RectangleGate.from_box({"x0": [1], "x1": [2], "y0": [4], "y1": [6]})
+        assert box == RectangleGate("auc_1", "auc_2", (1, 2), (4, 6))
+
+    def test_and_or_not_composition(self):
+        features = _random_features(5000, seed=2)
+        box = RectangleGate("auc_1", "auc_2", (1e3, 1e5), (1e4, 1e6))
+        polygon = PolygonGate("auc_1", "auc_2", [(2e3, 2e3), (8e5, 5e3), (3e4, 9e5)])
+        narrow = ThresholdGate("width", high=0.5)
+        bright = ThresholdGate("max_signal_1", low=1)
+        a, b, c, d = (g.evaluate(features) for g in (box, polygon, narrow, bright))
+        cases = [
+            (box & polygon, a & b),
+            (box | polygon, a | b),
+            (~box, ~a),
+            (box & ~polygon & narrow, a & ~b & c),
+            ((box | polygon) & ~(narrow | bright), (a | b) & ~(c | d)),
+            (And(box, And(polygon, narrow), Or(bright, ~box)), a & b & c & (d | ~a)),
+            (Or(Or(box, polygon), Or(box, narrow)), a | b | c),  # box twice
+            (Not(Not(polygon)), b),
+            ((box & polygon) | (box & ~polygon), a),
+        ]
+        for gate, expected in cases:
+            assert np.array_equal(gate.evaluate(features), expected), gate
+        assert 0 < np.count_nonzero(cases[4][1]) < len(cases[4][1])
+        assert (box & polygon) == And(polygon, box)  # Order doesn't matter
+        assert (box & polygon).features() == {"auc_1", "auc_2"}
+
+    def test_bounds_contain_every_drop_in_the_gate(self):
+        features = _random_features(20000, seed=3)
+        box = RectangleGate("auc_1", "auc_2", (1e3, 1e5), (1e4, 1e6))
+        polygon = PolygonGate("auc_1", "width", [(2e3, 0.2), (8e5, 0.3), (3e4, 0.9)])
+        gates = [
+            box,
+            polygon,
+            box & polygon,
+            box | polygon,
+            box & ThresholdGate("auc_1", low=3e4),
+            ~box,
+        ]
+        for gate in gates:
+            inside = gate.evaluate(features)
+            for feature, (low, high) in gate.bounds().items():
+                values = features[feature][inside]
+                assert np.all((values >= low) & (values <= high)), (gate, feature)
+        assert (box | polygon).bounds().keys() == {"auc_1"}
+        assert (~box).bounds() == {}
+        assert (box & ThresholdGate("auc_1", low=3e4)).bounds()["auc_1"] == (3e4, 1e5)
+
+
+class TestSortEngine(ct.MyTestClass):
+    """Run with: python sorting.py --test"""
+
+    def test_engine_and_ui_see_the_same_drops(self):
+        """The engine's history matches what the UI buffers from snapshots"""
+        from data_generator import DataGenerator
+
+        np.random.seed(0)
+        dg = DataGenerator()
+        history = 250  # A few windows' worth, so both buffers wrap around
+        dg.sort_engine = SortEngine(history)
+        dg.sort_engine.set_gate(RectangleGate("auc_1", "auc_2", (1e4, 8e4), (1e4, 8e4)))
+        ui_buffer = RingBuffer(["timestamp", "sorted"], history)  # As in the UI
+        seq, num_drops = None, 0
+        for _ in range(8):
+            dg._process_window()
+            snapshot = dg.get_snapshot(seq)
+            seq, events = snapshot["seq"], snapshot["events"]
+            ui_buffer.extend(
+                {"timestamp": events["timestamp"], "sorted": events["sorted"]}
+            )
+            num_drops += len(events)
+        assert num_drops > history
+        decisions, latencies = dg.sort_engine.recent()
+        assert len(decisions) == len(latencies) == len(ui_buffer) == history
+        assert np.array_equal(decisions, ui_buffer.ordered("sorted").astype(bool))
+        assert 0 < decisions.sum() < history
+        assert np.all(np.diff(ui_buffer.ordered("timestamp")) > 0)  # Oldest first
+        stats = dg.sort_engine.stats()
+        assert stats["sorted"] + stats["rejected"] == num_drops
+
+
+if __name__ == "__main__":
+    if "--test" in sys.argv:
+        TestGates().run()
+        TestSortEngine().run()
+        sys.exit()
+    for (name, batch_size), result in benchmark_sort_engine().items():
+        latency = result["latency_us"]
+        print(
+            f"{name:>30}, batches of {batch_size:>5}: "
+            f"{result['drops_per_s']:>12,.0f} drops/s, "
+            f"{100 * result['sorted_fraction']:4.1f}% sorted, decision latency "
+            f"p50 {latency['p50']:.1f} µs, p99 {latency['p99']:.1f} µs"
+        )
@@ -1,9 +1,20 @@
 import numpy as np
 import threading
-import concurrency_tools as ct
 import time
 import math
-from data_generator import DataGenerator
+import sys
+from functools import partial
+from data_generator import event_features
+from shared_acquisition import get_shared_acquisition
+from sorting import PolygonGate, RectangleGate
+from ui_tools import (
+    DensityHistogram,
+    FrameTimer,
+    LogHistogram,
+    PatchSizeMeter,
+    RingBuffer,
+    minmax_decimate,
+)
 
 from bokeh.layouts import column, row
 from bokeh.models import (
@@ -15,6 +26,9 @@ from bokeh.models import (
     LinearColorMapper,
     Spinner,
     Div,
+    BoxSelectTool,
+    LassoSelectTool,
+    PolySelectTool,
 )
 from bokeh.models.callbacks import CustomJS
 from bokeh.plotting import curdoc, figure
@@ -22,43 +36,112 @@ from bokeh.events import SelectionGeometry
 
 
 class UI:
+    # Refresh interval limits (s); in between, it adapts to how long updates take
+    MIN_UPDATE_INTERVAL = 0.05
+    MAX_UPDATE_INTERVAL = 1.0
+    UPDATE_LOAD_FACTOR = 3  # Spend at most ~1/3 of the time fetching + rendering
+    # Above this many points the scatter plot becomes a 2D histogram image
+    DENSITY_IMAGE_THRESHOLD = 10000
+    MAX_BUFFER_LENGTH = 1000000
+    DIAGNOSTICS_EVERY = 10  # Updates between diagnostics panel refreshes
+    # Features of each drop event; the scatter plot only needs the first three
+    EVENT_COLUMNS = ["x", "y", "density", "max_signal_1", "max_signal_2", "width"]
+    SCATTER_COLUMNS = ["x", "y", "density"]
+    # Histogram panels: title, value range, and (event column, legend, color)s
+    FEATURE_HISTOGRAMS = [
+        (
+            "AUC",
+            (1e3, 1e6),
+            [("x", "PMT1", "mediumseagreen"), ("y", "PMT2", "royalblue")],
+        ),
+        (
+            "Max Signal",
+            (1e-2, 1e1),
+            [
+                ("max_signal_1", "PMT1", "mediumseagreen"),
+                ("max_signal_2", "PMT2", "royalblue"),
+            ],
+        ),
+        ("Width (ms)", (5e-2, 2), [("width", "PMT1", "mediumseagreen")]),
+    ]
+
     """Initialization Methods"""
 
-    def __init__(self):
+    def __init__(self, measure_bytes=False, diagnostics=False):
         print("UI init")
+        self.measure_bytes = measure_bytes
+        self.diagnostics = diagnostics
         self._init_hardware()
         self._init_ui()
 
     def _init_hardware(self):
-        # Create an instance of the hardware class that will run in a separate process.
-        self.dg = ct.ObjectInSubprocess(DataGenerator)
-        self.dg_lock = threading.Lock()
+        # Bokeh runs this script once per session, but every session shares one
+        # instance of the hardware class, running in a separate process.
+        self.acquisition = get_shared_acquisition()
 
     def _init_ui(self):
         # Initialize UI components
-        with self.dg_lock:
-            self.doc = curdoc()
-            self.timers = np.zeros(100)
-            self._setup_data_sources()
-            self._setup_ui_components()
-            self.doc.add_periodic_callback(self.update_ui, 150)  # update ui every 150ms
+        self.doc = curdoc()
+        self.in_server = self.doc.session_context is not None
+        self.subscription = self.acquisition.subscribe(
+            on_change=self._hardware_state_changed
+        )
+        # Time spent in each stage of an update: "fetch", "buffer" (our own
+        # arrays), "datasource" (handing data to Bokeh, which serializes it)
+        # and "render" (everything after the fetch)
+        self.frame_timer = FrameTimer()
+        self.bytes_meter = PatchSizeMeter(self.doc) if self.measure_bytes else None
+        self._setup_data_sources()
+        self._setup_ui_components()
+        self._sync_hardware_controls()
+        self._start_fetching()
 
     """ Datasource Setup Methods """
 
     def _setup_data_sources(self):
         # Initialize data sources for the generated data
-        self.source_PMT1 = ColumnDataSource(
-            data=self.dg.data["pmt1"]
-        )  # convert from s to ms
-        self.source_PMT2 = ColumnDataSource(data=self.dg.data["pmt2"])
-        self.source_2d = ColumnDataSource(data=self.dg.data2d)
-        self.rolling_source_2d = self.dg.data2d.copy()
+        snapshot = self.subscription.take()
+        # Full traces stay here; the sources get them decimated to the plot
+        self.traces = snapshot["traces"]
+        self.source_PMT1 = ColumnDataSource(data={"x": [], "y": []})
+        self.source_PMT2 = ColumnDataSource(data={"x": [], "y": []})
+        self.source_2d = ColumnDataSource()
 
         # Initialize data sources for the interactive callbacks
         self.thresh = 0.05
         self.buffer_length = 5000
         self.boxselect = {"x0": [0], "y0": [0], "x1": [0], "y1": [0]}
         self.source_bx = ColumnDataSource(data=self.boxselect)
+        self.source_poly = ColumnDataSource(data={"x": [], "y": []})
+
+        # The scatter source mirrors a fixed-size ring buffer, so each update
+        # only patches the slots that new points landed in
+        self.scatter_buffer = RingBuffer(self.EVENT_COLUMNS, self.buffer_length)
+        if snapshot["events"] is not None:  # Recent events, if we joined late
+            self.scatter_buffer.extend(self._event_columns(snapshot["events"]))
+        # The sorting gate drawn on the scatter plot, and its buffered points
+        self.gate = RectangleGate.from_box(self.boxselect)
+        self._count_gate()
+        # Too many points to draw one by one? Send a 2D histogram image instead
+        self.density_histogram = DensityHistogram(
+            x_range=(1e3, 1e6), y_range=(1e3, 1e6)
+        )
+        self.source_image = ColumnDataSource(
+            data={key: [] for key in ("image", "x", "y", "dw", "dh")}
+        )
+        self.image_mode = self.buffer_length > self.DENSITY_IMAGE_THRESHOLD
+        self._reset_scatter_source()
+
+        # Histograms of each feature of the buffered events, kept up to date
+        # by adding new events and removing evicted ones
+        # (all in one source, with "left_x", "right_x", "top_x", etc. columns,
+        # so an update is one small patch)
+        self.feature_histograms = {}
+        for title, value_range, channels in self.FEATURE_HISTOGRAMS:
+            for key, label, color in channels:
+                self.feature_histograms[key] = LogHistogram(value_range)
+        self.source_features = ColumnDataSource()
+        self._reset_feature_histograms()
 
     """ UI Setup Methods """
 
@@ -72,16 +155,22 @@ class UI:
             text_color="black",
         )
         self.toggle = self._create_toggle()
+        self.control_div = Div(text="", margin=(5, 0, 0, 20))
         self.sliders = self._create_sliders()
         self.bufferspinner = self._create_bufferspinner()
         self.custom_div = self._create_custom_div()
+        self.gate_stats_div = Div(text="", width=400, margin=(0, 0, 20, 50))
+        self.diagnostics_div = Div(
+            text="", visible=self.diagnostics, margin=(0, 0, 20, 50)
+        )
         self.plot = self._create_signal_plot()
         self.plot2d = self._create_2d_scatter_plot()
+        self.feature_plots = self._create_feature_plots()
 
         # Generate Layout
         self.doc.add_root(
             column(
-                self.toggle,
+                row(self.toggle, self.control_div),
                 row(
                     column(
                         self.sliders[0],
@@ -89,10 +178,13 @@ class UI:
                         self.sliders[2],
                         self.bufferspinner,
                         self.custom_div,
+                        self.gate_stats_div,
+                        self.diagnostics_div,
                     ),
                     self.plot2d,
                 ),
                 self.plot,
+                row(*self.feature_plots),
             )
         )
 
@@ -128,6 +220,9 @@ class UI:
             "x", "y", source=self.source_PMT2, color="royalblue", legend_label="PMT2"
         )
         self._create_threshold_lines()
+        self.plot.x_range.on_change("start", self._x_range_changed)
+        self.plot.x_range.on_change("end", self._x_range_changed)
+        self._update_traces()
 
         return self.plot
 
@@ -195,7 +290,7 @@ class UI:
         self.bufferspinner = Spinner(
             title="Datapoint Count for Scatter Plot",
             low=0,
-            high=10000,
+            high=self.MAX_BUFFER_LENGTH,
             step=500,
             value=self.buffer_length,
             width=200,
@@ -205,7 +300,7 @@ class UI:
 
         return self.bufferspinner
 
-    def _create_divhtml(self):
+    def _create_divhtml(self, title="Scatter Plot Gate Selection:"):
         # Extracting float values from the dictionary
         float_values = [self.boxselect[key][0] for key in ["x0", "y0", "x1", "y1"]]
 
@@ -232,7 +327,7 @@ class UI:
         # HTML template with embedded CSS for styling
         self.html_content = f"""
         <div style="padding: 10px; background-color: white;">
-            <div style="color: black; padding: 5px; background-color: white; text-align: left;"><b>Scatter Plot Gate Selection:</b></div>
+            <div style="color: black; padding: 5px; background-color: white; text-align: left;"><b>{title}</b></div>
             <div style="display: flex; justify-content: space-around; padding: 5px;">
                 {''.join([f'<div style="width: 80px;"><div style="text-align: center; margin-bottom: 5px;">{label}</div><div style="background-color: #E8E8E8; color: black; padding: 10px; border-radius: 10px; text-align: center; margin-right: 2px; margin-left: 2px; ">{value}</div></div>' for label, value in zip(labels, formatted_values)])}
             </div>
@@ -263,7 +358,18 @@ class UI:
             x_axis_type="log",
             y_axis_type="log",
             title="Density Scatter Plot",
-            tools="box_select,reset",
+            tools="box_select,poly_select,lasso_select,reset",
+        )
+        self.plot2d.image(
+            image="image",
+            x="x",
+            y="y",
+            dw="dw",
+            dh="dh",
+            source=self.source_image,
+            color_mapper=LinearColorMapper(
+                palette="Viridis256", low=1, high=255, low_color=(0, 0, 0, 0)
+            ),  # Empty bins are 0, so they're transparent
         )
         self.glyph = self.plot2d.scatter(
             "x",
@@ -275,47 +381,110 @@ class UI:
             fill_alpha=0.6,
         )
         self.glyph.nonselection_glyph = None  # supress alpha change for nonselected indices bc refresh messes this up
+        # Gating only needs the selection geometry, so don't hit-test the image
+        for tool in (BoxSelectTool, PolySelectTool, LassoSelectTool):
+            self.plot2d.select_one(tool).renderers = [self.glyph]
         self._boxselect_changed()
+        self._update_scatter_title()
 
         return self.plot2d
 
+    def _create_feature_plots(self):
+        self.feature_plots = []
+        for title, value_range, channels in self.FEATURE_HISTOGRAMS:
+            plot = figure(
+                height=200,
+                width=300,
+                title=title,
+                x_axis_type="log",
+                x_range=value_range,
+                toolbar_location=None,
+                margin=(10, 0, 0, 10),
+            )
+            for key, label, color in channels:
+                plot.quad(
+                    left=f"left_{key}",
+                    right=f"right_{key}",
+                    top=f"top_{key}",
+                    bottom=0,
+                    source=self.source_features,
+                    fill_color=color,
+                    fill_alpha=0.4,
+                    line_color=color,
+                    legend_label=label,
+                )
+            plot.legend.label_text_font_size = "8pt"
+            self.feature_plots.append(plot)
+
+        return self.feature_plots
+
     """ Callback Methods """
 
+    # The hardware callbacks also fire when _sync_hardware_controls shows a
+    # change made by another session; only pass on values the hardware lacks.
+
     def _toggle_changed(self, state):
-        with self.dg_lock:
-            if state:
-                self.toggle.label = "Stop"
-                self.toggle.button_type = "danger"
-                self.dg.start_generating()
-            else:
-                self.toggle.label = "Start"
-                self.toggle.button_type = "success"
-                self.dg.stop_generating()
+        hardware_state = self.acquisition.hardware_state
+        if state:
+            self.toggle.label = "Stop"
+            self.toggle.button_type = "danger"
+            if not hardware_state["generating"]:
+                self.acquisition.start_generating(self.subscription)
+        else:
+            self.toggle.label = "Start"
+            self.toggle.button_type = "success"
+            if hardware_state["generating"]:
+                self.acquisition.stop_generating(self.subscription)
 
     def _gain1_changed(self, attr, old, new):
-        with self.dg_lock:
-            self.dg.set_gain(new, 1)
+        if new != self.acquisition.hardware_state["gain"][0]:
+            self.acquisition.set_gain(self.subscription, new, 1)
 
     def _gain2_changed(self, attr, old, new):
-        with self.dg_lock:
-            self.dg.set_gain(new, 2)
+        if new != self.acquisition.hardware_state["gain"][1]:
+            self.acquisition.set_gain(self.subscription, new, 2)
 
     def _thresh_changed(self, attr, old, new):
-        with self.dg_lock:
-            self.dg.set_thresh(new)
-            self.thresh_line.location = self.sliders[2].value
+        self.thresh_line.location = self.sliders[2].value
+        if new != self.acquisition.hardware_state["thresh"]:
+            self.acquisition.set_thresh(self.subscription, new)
+
+    def _x_range_changed(self, attr, old, new):
+        # Zoomed or panned: re-decimate for the new visible range
+        self._update_traces()
 
     def _spinner_changed(self, attr, old, new):
-        with self.dg_lock:
-            self.buffer_length = self.bufferspinner.value
+        self.buffer_length = self.bufferspinner.value
+        self.scatter_buffer.resize(self.buffer_length)
+        self.image_mode = self.buffer_length > self.DENSITY_IMAGE_THRESHOLD
+        self._reset_scatter_source()
+        self._reset_feature_histograms()
+        self._update_scatter_title()
+        self._count_gate()
+        self._update_gate_stats()
 
     def _boxselect_changed(self):
-        # Custom javascript callback for box select tool
+        # Custom javascript callback for the box, poly and lasso select tools
         callback = CustomJS(
-            args=dict(source_bx=self.source_bx),
+            args=dict(source_bx=self.source_bx, source_poly=self.source_poly),
             code="""
-            // Store selected geometry in variables
             var geometry = cb_obj.geometry;
+            if (!cb_obj.final) {
+                return;  // Lasso still being drawn
+            }
+
+            // Poly and lasso selections send their vertices (in data space)
+            if (geometry.type == 'poly') {
+                console.log('Sorting Gate polygon: ', geometry);
+                source_poly.data = {
+                    'x': Array.from(geometry.x),
+                    'y': Array.from(geometry.y)
+                };
+                source_poly.change.emit();
+                return;
+            }
+
+            // Store selected geometry in variables
             var x0 = geometry.x0;
             var y0 = geometry.y0;
             var x1 = geometry.x1;
@@ -342,44 +511,324 @@ class UI:
         # Attach the Javascript and python callbacks to the plot for the 'selectiongeometry' event
         self.plot2d.js_on_event(SelectionGeometry, callback)
         self.source_bx.on_change("data", self._boxselect_pass)
+        self.source_poly.on_change("data", self._polyselect_pass)
 
     def _boxselect_pass(self, attr, old, new):
-        with self.dg_lock:
-            print("Box Select Callback Triggered")
-
-            # Pass box values to the hardware class through the pipe to set gate values
-            self.dg.set_gate_values(dict(new))
+        print("Box Select Callback Triggered")
+
+        # Store box values in ui box_select and update box select text
+        self.boxselect = new
+        self._set_gate(RectangleGate.from_box(new), self._create_divhtml())
+
+    def _polyselect_pass(self, attr, old, new):
+        print("Poly Select Callback Triggered")
+        if len(new["x"]) < 3:
+            return
+        gate = PolygonGate("auc_1", "auc_2", zip(new["x"], new["y"]))
+
+        # The text shows the polygon's bounding box
+        self.boxselect = {
+            "x0": [min(new["x"])],
+            "y0": [min(new["y"])],
+            "x1": [max(new["x"])],
+            "y1": [max(new["y"])],
+        }
+        text = self._create_divhtml(
+            f"Polygon Gate ({len(gate.vertices)} vertices), Bounding Box:"
+        )
+        self._set_gate(gate, text)
+
+    def _set_gate(self, gate, text):
+        # Only the owner's gate goes to the hardware; other sessions can still
+        # select to see gate statistics for their own gate
+        if self.acquisition.is_owner(self.subscription):
+            self.acquisition.set_gate_values(self.subscription, gate)
+
+        self.gate = gate
+        self.custom_div.text = text
+        self._count_gate()
+        self._update_gate_stats()
+
+    """ Shared Hardware Methods """
+
+    def _hardware_state_changed(self):
+        """Called by the shared acquisition, maybe from another session's thread"""
+        if not self.in_server:
+            if hasattr(self, "toggle"):  # Once the UI is set up
+                self._sync_hardware_controls()
+        elif self.doc.session_context is not None:  # Unless we're shutting down
+            self.doc.add_next_tick_callback(self._sync_hardware_controls)
+
+    def _sync_hardware_controls(self):
+        """Show the shared hardware state; only the owner can change it"""
+        hardware_state = self.acquisition.hardware_state
+        is_owner = self.acquisition.is_owner(self.subscription)
+        self.toggle.active = hardware_state["generating"]
+        self.sliders[0].value = hardware_state["gain"][0]
+        self.sliders[1].value = hardware_state["gain"][1]
+        self.sliders[2].value = hardware_state["thresh"]
+        for widget in [self.toggle, *self.sliders]:
+            widget.disabled = not is_owner
+        if is_owner:
+            text = "You control the hardware"
+        else:
+            text = "View only: another session controls the hardware"
+        if self.control_div.text != text:
+            self.control_div.text = text
+
+    """ Background Update Methods """
+
+    def _start_fetching(self):
+        """Fetch data in a background thread so callbacks never wait on the pipe"""
+        self.update_interval = 0.15
+        self.fetch_time = 0
+        self.render_time = 0
+        if not self.in_server:
+            return  # Not running in a Bokeh server; call update_ui yourself
+        self._stop_fetching = threading.Event()
+        self._render_done = threading.Event()
+        self._render_done.set()
+        self.doc.on_session_destroyed(self._session_destroyed)
+        self._fetch_thread = threading.Thread(target=self._fetch_loop, daemon=True)
+        self._fetch_thread.start()
+
+    def _session_destroyed(self, session_context):
+        self._stop_fetching.set()
+        self.acquisition.unsubscribe(self.subscription)
+
+    def _fetch_loop(self, perf_counter=time.perf_counter, partial=partial):
+        # Bokeh clears this script's globals when it destroys the session, a bit
+        # before calling _session_destroyed, so don't look any up in this thread
+        next_fetch = perf_counter()
+        while not self._stop_fetching.is_set():
+            if self.doc.session_context is None:
+                return  # The session is being destroyed
+            # Drop frames rather than queue them: don't fetch again until the
+            # last snapshot is on screen. Events aren't lost, since the next
+            # snapshot includes everything since the last one we rendered.
+            if not self._render_done.wait(timeout=0.1):
+                continue
+            delay = next_fetch - perf_counter()
+            if self._stop_fetching.wait(timeout=max(delay, 0)):
+                return
+            t0 = perf_counter()
+            snapshot = self._fetch_snapshot()
+            fetch_time = perf_counter() - t0
+            self.fetch_time = self._smooth(self.fetch_time, fetch_time)
+            if snapshot["traces"] is not None or snapshot["events"] is not None:
+                self.frame_timer.add("fetch", fetch_time)  # Part of the next frame
+                self._render_done.clear()
+                try:
+                    self.doc.add_next_tick_callback(partial(self._render, snapshot))
+                except AttributeError:  # Bokeh tore down the document meanwhile
+                    return
+            next_fetch = t0 + self.update_interval
+
+    def _render(self, snapshot):
+        """Runs on the document's thread, after a background fetch"""
+        try:
+            self._render_snapshot(snapshot)
+        finally:
+            self._render_done.set()
+
+    def _adapt_update_interval(self):
+        busy = self.UPDATE_LOAD_FACTOR * (self.fetch_time + self.render_time)
+        self.update_interval = min(
+            self.MAX_UPDATE_INTERVAL, max(self.MIN_UPDATE_INTERVAL, busy)
+        )
 
-            # Store box values in ui box_select and update box select text
-            self.boxselect = new
-            self.custom_div.text = self._create_divhtml()
+    @staticmethod
+    def _smooth(average, value, weight=0.2):
+        return (1 - weight) * average + weight * value
 
     def update_ui(self):
         """Pull data from the hardware (in another process) and update the data source and plot"""
-        with self.dg_lock:
+        with self.frame_timer.span("fetch"):
+            snapshot = self._fetch_snapshot()
+        self._render_snapshot(snapshot)
+
+    def _fetch_snapshot(self):
+        # Everything the shared acquisition got since the last update
+        return self.subscription.take()
+
+    def _render_snapshot(self, snapshot):
+        t0 = time.perf_counter()
+        with self.frame_timer.span("render"):
             # Update pmt data
-            self.source_PMT1.data = self.dg.data["pmt1"]
-            self.source_PMT2.data = self.dg.data["pmt2"]
-
-            for key in self.rolling_source_2d:
-                self.rolling_source_2d[key].extend(self.dg.data2d[key])
-                if self.buffer_length == 0:
-                    self.rolling_source_2d[key] = [np.nan]
-                elif len(self.rolling_source_2d[key]) > self.buffer_length:
-                    self.rolling_source_2d[key] = self.rolling_source_2d[key][
-                        -self.buffer_length :
+            if snapshot["traces"] is not None:
+                self.traces = snapshot["traces"]
+                self._update_traces()
+
+            # Only send the new scatter points, over the oldest ones
+            if snapshot["events"] is not None:
+                self._update_scatter(self._event_columns(snapshot["events"]))
+                self._update_gate_stats()
+
+        self.frame_timer.end_frame()
+        self._show_timings()
+        self.render_time = self._smooth(self.render_time, time.perf_counter() - t0)
+        self._adapt_update_interval()
+
+    @staticmethod
+    def _event_columns(events):
+        """The scatter buffer's columns, as views of drop event records"""
+        features = event_features(events)
+        columns = {
+            key: features[key] for key in ("max_signal_1", "max_signal_2", "width")
+        }
+        columns.update(
+            x=features["auc_1"], y=features["auc_2"], density=events["density"]
+        )
+        return columns
+
+    def _reset_scatter_source(self):
+        """Send the whole scatter buffer (or its image), e.g. after it's resized"""
+        buffered = self.scatter_buffer.data
+        self.density_histogram.clear()
+        self.density_histogram.add(buffered["x"], buffered["y"])
+        if self.image_mode:
+            self.source_2d.data = {key: [] for key in self.SCATTER_COLUMNS}
+            self.source_image.data = self.density_histogram.image_data()
+        else:
+            self.source_2d.data = {
+                key: buffered[key].copy() for key in self.SCATTER_COLUMNS
+            }
+            self.source_image.data = {key: [] for key in self.source_image.data}
+
+    def _reset_feature_histograms(self):
+        """Rebin all the buffered events, e.g. after the buffer is resized"""
+        data = {}
+        for key, histogram in self.feature_histograms.items():
+            histogram.clear()
+            histogram.add(self.scatter_buffer.data[key])
+            data.update(
+                {f"{name}_{key}": v for name, v in histogram.quad_data().items()}
+            )
+        self.source_features.data = data
+
+    def _update_scatter(self, new):
+        """Add new points to the scatter buffer and patch only those slots"""
+        with self.frame_timer.span("buffer"):
+            slices = self.scatter_buffer.extend(new)
+            if len(slices) == 0:
+                return
+            buffered = self.scatter_buffer.data
+            evicted = self.scatter_buffer.evicted
+            added = {
+                key: np.concatenate([values[sl] for sl in slices])
+                for key, values in buffered.items()
+            }
+            self.density_histogram.remove(evicted["x"], evicted["y"])
+            self.density_histogram.add(added["x"], added["y"])
+            self.gate_count += self._in_gate(added) - self._in_gate(evicted)
+            if self.image_mode:
+                image = self.density_histogram.image()
+        with self.frame_timer.span("datasource"):
+            if self.image_mode:
+                self.source_image.patch({"image": [(0, image)]})
+            else:
+                self.source_2d.patch(
+                    {
+                        key: [(sl, buffered[key][sl]) for sl in slices]
+                        for key in self.SCATTER_COLUMNS
+                    }
+                )
+        self._update_feature_histograms(added, evicted)
+
+    def _update_feature_histograms(self, added, evicted):
+        """Bin the new events and unbin the evicted ones; O(new events)"""
+        with self.frame_timer.span("buffer"):
+            for key, histogram in self.feature_histograms.items():
+                histogram.remove(evicted[key])
+                histogram.add(added[key])
+        with self.frame_timer.span("datasource"):
+            self.source_features.patch(
+                {
+                    f"top_{key}": [
+                        (slice(0, histogram.bins), histogram.counts.astype(np.int32))
                     ]
+                    for key, histogram in self.feature_histograms.items()
+                }
+            )
 
-            self.source_2d.data = self.rolling_source_2d
+    def _update_scatter_title(self):
+        if self.image_mode:
+            self.plot2d.title.text = "Density Image (2D histogram of events)"
+        else:
+            self.plot2d.title.text = "Density Scatter Plot"
 
-            self.manage_timers()
+    def _in_gate(self, events):
+        """How many of 'events' (columns like the scatter buffer's) are in the gate"""
+        features = {key: events[key] for key in self.EVENT_COLUMNS}
+        features["auc_1"], features["auc_2"] = events["x"], events["y"]
+        # Empty slots are NaN, and NaNs are never in a gate
+        return int(np.count_nonzero(self.gate_evaluator(features)))
 
-    def manage_timers(self):
-        """This is just a simple way to keep track of how long the update_ui function takes to run."""
-        self.timers = np.roll(self.timers, 1)
-        self.timers[0] = time.perf_counter()
-        rate_seconds_per_update = np.mean(np.diff(self.timers)) * -1
-        self.plot.title.text = f"Update Rate: {1/rate_seconds_per_update:.01f} Hz ({rate_seconds_per_update*1000:.00f} ms)"
+    def _count_gate(self):
+        """Recount the buffered points in the gate, e.g. after it changes
 
+        In between, _update_scatter keeps the count up to date from just the
+        added and evicted points, so polygon gates stay cheap on big buffers.
+        """
+        self.gate_evaluator = self.gate.compile()
+        self.gate_count = self._in_gate(self.scatter_buffer.data)
+
+    def _update_gate_stats(self):
+        """Show how many buffered scatter points are inside the gate"""
+        in_gate = self.gate_count
+        total = len(self.scatter_buffer)
+        percent = 100 * in_gate / total if total > 0 else 0
+        text = f"<b>Events in gate:</b> {in_gate} of {total} ({percent:.1f}%)"
+        if self.gate_stats_div.text != text:  # Don't resend the same text
+            self.gate_stats_div.text = text
+
+    def _update_traces(self):
+        t, signal = self.traces["t"], self.traces["signal"]
+        self._update_trace(self.source_PMT1, {"x": t, "y": signal[0]})
+        self._update_trace(self.source_PMT2, {"x": t, "y": signal[1]})
+
+    def _update_trace(self, source, trace):
+        """Send only the min/max per pixel of the visible part of a trace.
+
+        While the visible range stays put, the decimated x values don't change,
+        so we only patch the y values.
+        """
+        x_range = self.plot.x_range
+        with self.frame_timer.span("buffer"):
+            x, y = minmax_decimate(
+                trace["x"], trace["y"], x_range.start, x_range.end, self.plot.width
+            )
+            y = y.astype(np.float32)  # Plenty of precision for the screen
+            same_x = np.array_equal(source.data["x"], x)
+        with self.frame_timer.span("datasource"):
+            if same_x:
+                source.patch({"y": [(slice(0, len(y)), y)]})
+            else:
+                source.data = {"x": x, "y": y}
+
+    def _show_timings(self):
+        """Show the update rate in the plot title, and the diagnostics panel"""
+        rate = self.frame_timer.rate()
+        title = f"Update Rate: {rate:.01f} Hz"
+        if rate > 0:
+            title += f" ({1000 / rate:.00f} ms)"
+        if self.bytes_meter is not None:
+            title += f" | {self.bytes_meter.pop() / 1e3:.01f} kB/update"
+        self.plot.title.text = title
+        if self.diagnostics and self.frame_timer.frames % self.DIAGNOSTICS_EVERY == 0:
+            self.diagnostics_div.text = (
+                f"<b>Update stages</b> (last {self.frame_timer.history} updates)"
+                + self.frame_timer.html_table()
+            )
+
+    def export_timings(self, path=None):
+        """Recent update stage timings, for offline analysis; see FrameTimer.export"""
+        return self.frame_timer.export(path)
 
-ui = UI()
+
+# Run with `bokeh serve ui_layout.py --args --measure-bytes` to show bytes sent,
+# and/or `--diagnostics` to show how long each stage of an update takes
+ui = UI(
+    measure_bytes="--measure-bytes" in sys.argv,
+    diagnostics="--diagnostics" in sys.argv,
+)
@@ -0,0 +1,394 @@
+import contextlib
+import json
+import threading
+import time
+
+import numpy as np
+from bokeh.core.json_encoder import serialize_json
+from bokeh.core.serialization import Serialized, Serializer
+from bokeh.document.events import DocumentPatchedEvent
+
+import concurrency_tools as ct
+from ring_buffer import RingBuffer  # Here too, for ui_layout
+
+
+class PatchSizeMeter:
+    """Count the bytes that document changes send to the browser.
+
+    Every change to a Bokeh model (e.g. assigning ColumnDataSource.data, or
+    calling stream/patch) becomes a PATCH-DOC message on the websocket. This
+    serializes each change the same way Bokeh does, so the totals match what
+    crosses the wire (apart from a few bytes of message header). Serializing
+    twice isn't free, so only attach a meter when you're measuring.
+    """
+
+    def __init__(self, doc):
+        self.doc = doc
+        self.bytes = 0
+        self.doc.on_change(self._on_change)
+
+    def _on_change(self, event):
+        if not isinstance(event, DocumentPatchedEvent):
+            return
+        serializer = Serializer(references=self.doc.models.synced_references)
+        content = serializer.encode([event])
+        buffers = serializer.buffers  # Sent as binary frames, not base64
+        self.bytes += len(serialize_json(Serialized(content, buffers)))
+        self.bytes += sum(len(buffer.to_bytes()) for buffer in buffers)
+
+    def pop(self):
+        """Return the bytes counted since the last pop, and reset the count"""
+        n, self.bytes = self.bytes, 0
+        return n
+
+
+def minmax_decimate(x, y, x_start, x_end, num_buckets):
+    """Shrink a trace to what a plot 'num_buckets' pixels wide can show.
+
+    Keeps the samples between x_start and x_end (plus one on each side, so
+    lines run off the edges), splits them into 'num_buckets' buckets, and
+    keeps the min and the max of each bucket, in time order. Both points go
+    at the bucket's center, so x only depends on the visible range and the
+    sample grid; while those stay the same, only y changes between updates.
+    Narrow peaks always survive, since they're the max of their bucket.
+
+    Returns x and y unchanged (but trimmed to the visible range) if there
+    aren't more than two samples per bucket.
+    """
+    x = np.asarray(x)
+    y = np.asarray(y)
+    lo = max(np.searchsorted(x, x_start, side="left") - 1, 0)
+    hi = min(np.searchsorted(x, x_end, side="right") + 1, len(x))
+    x, y = x[lo:hi], y[lo:hi]
+    n = len(x)
+    num_buckets = max(int(num_buckets), 1)
+    if n <= 2 * num_buckets:
+        return x, y
+    bucket_size = -(-n // num_buckets)  # Round up, so we get <= num_buckets
+    num_full = n // bucket_size
+    x_buckets = [x[: num_full * bucket_size].reshape(num_full, bucket_size)]
+    y_buckets = [y[: num_full * bucket_size].reshape(num_full, bucket_size)]
+    if num_full * bucket_size < n:  # A partial bucket at the end
+        x_buckets.append(x[num_full * bucket_size :][np.newaxis])
+        y_buckets.append(y[num_full * bucket_size :][np.newaxis])
+    x_out, y_out = [], []
+    for xb, yb in zip(x_buckets, y_buckets):
+        i_min, i_max = yb.argmin(axis=1), yb.argmax(axis=1)
+        order = np.stack((np.minimum(i_min, i_max), np.maximum(i_min, i_max)), 1)
+        rows = np.arange(len(yb))[:, np.newaxis]
+        center = 0.5 * (xb[:, 0] + xb[:, -1])
+        x_out.append(np.repeat(center, 2))
+        y_out.append(yb[rows, order].ravel())
+    return np.concatenate(x_out), np.concatenate(y_out)
+
+
+class DensityHistogram:
+    """A 2D histogram of points on log-log axes, kept up to date incrementally.
+
+    Bins are equally spaced in log10(x) and log10(y) over fixed ranges, so
+    they line up with the screen pixels of a log-log plot. Adding or removing
+    n points costs O(n), no matter how many points are already binned. Points
+    outside the ranges (or not positive) aren't counted.
+    """
+
+    def __init__(self, x_range, y_range, bins=150):
+        self.x_range = x_range
+        self.y_range = y_range
+        self.bins = bins
+        self._log_ranges = (np.log10(y_range), np.log10(x_range))  # Rows are y
+        self.counts = np.zeros((bins, bins), dtype=np.int64)
+
+    def _histogram(self, x, y):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            log_x = np.log10(np.asarray(x, dtype=float))
+            log_y = np.log10(np.asarray(y, dtype=float))
+        valid = np.isfinite(log_x) & np.isfinite(log_y)
+        counts, _, _ = np.histogram2d(
+            log_y[valid], log_x[valid], bins=self.bins, range=self._log_ranges
+        )
+        return counts.astype(np.int64)
+
+    def add(self, x, y):
+        self.counts += self._histogram(x, y)
+
+    def remove(self, x, y):
+        self.counts -= self._histogram(x, y)
+
+    def clear(self):
+        self.counts[:] = 0
+
+    def image(self):
+        """Counts as uint8 color levels: 0 if empty, else 1-255 on a log scale
+
+        256 levels is all a 256-color palette can show, and uint8 is a quarter
+        of the size of float32 on the wire.
+        """
+        image = np.zeros(self.counts.shape, dtype=np.uint8)
+        occupied = self.counts > 0
+        if np.any(occupied):
+            levels = np.log1p(self.counts[occupied])
+            scale = 254 / max(levels.max(), np.log1p(1))
+            image[occupied] = 1 + np.round(levels * scale).astype(np.uint8)
+        return image
+
+    def image_data(self):
+        """ColumnDataSource data for an 'image' glyph covering the ranges"""
+        return {
+            "image": [self.image()],
+            "x": [self.x_range[0]],
+            "y": [self.y_range[0]],
+            "dw": [self.x_range[1] - self.x_range[0]],
+            "dh": [self.y_range[1] - self.y_range[0]],
+        }
+
+
+class LogHistogram:
+    """A 1D histogram with log-spaced bins, kept up to date incrementally.
+
+    Like DensityHistogram, adding or removing n values costs O(n), no matter
+    how many values are already binned; values outside 'value_range' (or not
+    positive) aren't counted.
+    """
+
+    def __init__(self, value_range, bins=50):
+        self.value_range = value_range
+        self.bins = bins
+        self._log_range = tuple(np.log10(value_range))
+        self.edges = np.logspace(*self._log_range, bins + 1)
+        self.counts = np.zeros(bins, dtype=np.int64)
+
+    def _histogram(self, values):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            log_values = np.log10(np.asarray(values, dtype=float))
+        counts, _ = np.histogram(
+            log_values[np.isfinite(log_values)], bins=self.bins, range=self._log_range
+        )
+        return counts
+
+    def add(self, values):
+        self.counts += self._histogram(values)
+
+    def remove(self, values):
+        self.counts -= self._histogram(values)
+
+    def clear(self):
+        self.counts[:] = 0
+
+    def quad_data(self):
+        """ColumnDataSource data for a 'quad' glyph, one quad per bin"""
+        return {
+            "left": self.edges[:-1],
+            "right": self.edges[1:],
+            "top": self.counts.astype(np.int32),
+        }
+
+
+class FrameTimer:
+    """Rolling timing statistics for the named stages of each UI update.
+
+    Time spent in each stage ('span' or 'add') is summed over a frame (one UI
+    update); 'end_frame' records the totals, keeping the last 'history'
+    frames per stage, along with the time since the previous frame. Stages
+    can be timed from any thread, e.g. a background fetch that feeds the
+    next frame. A stage that doesn't run during a frame gets no sample.
+    """
+
+    def __init__(self, history=200):
+        self.history = history
+        self.frames = 0  # Total number of frames ever ended
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._stages = {}  # Stage name -> RingBuffer of seconds per frame
+        self._intervals = RingBuffer(["seconds"], history)
+        self._last_frame = None
+
+    @contextlib.contextmanager
+    def span(self, name):
+        """Time a block of code as part of stage 'name' of this frame"""
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - t0)
+
+    def add(self, name, seconds):
+        with self._lock:
+            self._pending[name] = self._pending.get(name, 0) + seconds
+
+    def end_frame(self):
+        now = time.perf_counter()
+        with self._lock:
+            for name, seconds in self._pending.items():
+                if name not in self._stages:
+                    self._stages[name] = RingBuffer(["seconds"], self.history)
+                self._stages[name].extend({"seconds": [seconds]})
+            self._pending = {}
+            if self._last_frame is not None:
+                self._intervals.extend({"seconds": [now - self._last_frame]})
+            self._last_frame = now
+            self.frames += 1
+
+    def rate(self):
+        """Frames per second over the recent history (0 before two frames)"""
+        with self._lock:
+            intervals = self._intervals.ordered("seconds")
+        if len(intervals) == 0:
+            return 0.0
+        return 1 / intervals.mean()
+
+    def samples(self):
+        """Recent seconds per frame of each stage, oldest first"""
+        with self._lock:
+            return {
+                name: ring.ordered("seconds") for name, ring in self._stages.items()
+            }
+
+    def stats(self):
+        """Summary of the recent frames of each stage, in ms"""
+        return {name: timing_summary(s) for name, s in self.samples().items()}
+
+    def export(self, path=None):
+        """Stats and raw recent samples (in ms) as a dict; or write it as JSON"""
+        exported = {
+            "frames": self.frames,
+            "rate_hz": self.rate(),
+            "stats_ms": self.stats(),
+            "samples_ms": {
+                name: (1000 * s).tolist() for name, s in self.samples().items()
+            },
+        }
+        if path is None:
+            return exported
+        with open(path, "w") as f:
+            json.dump(exported, f, indent=2)
+
+    def html_table(self):
+        """The stats as an HTML table, e.g. for a Div"""
+        cells = "".join(f"<th>{heading}</th>" for heading in ("ms", *_PERCENTILES))
+        rows = [f"<tr>{cells}</tr>"]
+        for name, stats in self.stats().items():
+            cells = "".join(f"<td>{stats[key]:.1f}</td>" for key in _PERCENTILES)
+            rows.append(f"<tr><td><b>{name}</b></td>{cells}</tr>")
+        return f"<table>{''.join(rows)}</table>"
+
+
+_PERCENTILES = ("p50", "p95", "p99", "max")
+
+
+def timing_summary(seconds):
+    """Count, mean, p50, p95, p99 and max of some durations, in ms"""
+    ms = 1000 * np.asarray(seconds, dtype=float)
+    if len(ms) == 0:
+        return None
+    p50, p95, p99 = np.percentile(ms, (50, 95, 99))
+    return {
+        "count": len(ms),
+        "mean": float(ms.mean()),
+        "p50": float(p50),
+        "p95": float(p95),
+        "p99": float(p99),
+        "max": float(ms.max()),
+    }
+
+
+class TestMinMaxDecimate(ct.MyTestClass):
+    """Run with: python ui_tools.py"""
+
+    def test_spikes_survive(self):
+        x = np.arange(10000) * 0.02
+        y = np.zeros(len(x))
+        y[1234], y[4321] = 5, -3  # One sample each
+        x_out, y_out = minmax_decimate(x, y, x[0], x[-1], 100)
+        assert len(x_out) == len(y_out) <= 200
+        assert 5 in y_out and -3 in y_out
+        assert np.all(np.diff(x_out) >= 0)
+        # Only the spike's bucket goes up, and only one point of it:
+        assert np.count_nonzero(y_out == 5) == 1
+
+    def test_every_bucket_keeps_its_min_and_max(self):
+        rng = np.random.default_rng(0)
+        for n in (1000, 1001, 1003, 1099, 4999):  # Mostly not divisible
+            for num_buckets in (7, 10, 100):
+                x = np.arange(n, dtype=float)
+                y = rng.normal(size=n)
+                x_out, y_out = minmax_decimate(x, y, 0, n, num_buckets)
+                size = -(-n // num_buckets)
+                starts = range(0, n, size)
+                assert len(y_out) == 2 * len(starts) <= 2 * num_buckets
+                for b, start in enumerate(starts):
+                    bucket = y[start : start + size]
+                    pair = y_out[2 * b : 2 * b + 2]
+                    assert sorted(pair) == [bucket.min(), bucket.max()], (n, b)
+                    # ...in the order they happened:
+                    assert np.argmax(bucket == pair[0]) <= np.argmax(bucket == pair[1])
+                    center = 0.5 * (x[start] + x[min(start + size, n) - 1])
+                    assert x_out[2 * b] == x_out[2 * b + 1] == center
+
+    def test_visible_range(self):
+        x = np.arange(1000, dtype=float)
+        y = np.sin(x)
+        # Trimmed to the range, plus one sample on each side:
+        x_out, y_out = minmax_decimate(x, y, 100.5, 200.5, 100)
+        assert np.array_equal(x_out, x[100:202]) and np.array_equal(y_out, y[100:202])
+        x_out, y_out = minmax_decimate(x, y, 100, 900, 10)
+        assert len(x_out) == 20 and x_out[0] > 99 and x_out[-1] < 901
+        assert y_out.max() == y[99:902].max() and y_out.min() == y[99:902].min()
+        x_out, y_out = minmax_decimate(x, y, 2000, 3000, 10)  # Off the end
+        assert np.array_equal(x_out, [999])
+
+
+class TestHistograms(ct.MyTestClass):
+    """Run with: python ui_tools.py"""
+
+    @staticmethod
+    def _values(n, seed):
+        values = 10 ** np.random.default_rng(seed).normal(3, 1.5, n)
+        values[: n // 10] = np.nan  # And some that can't be binned
+        values[n // 10 : n // 5] *= -1
+        return values
+
+    def test_log_histogram_matches_numpy(self):
+        h = LogHistogram((1, 1e6), bins=40)
+        expected_edges = np.logspace(0, 6, 41)
+        assert np.allclose(h.edges, expected_edges)
+        for n in (0, 1, 1000):  # Including no events at all
+            h.clear()
+            values = self._values(n, seed=n)
+            h.add(values)
+            positive = values[values > 0]
+            expected, _ = np.histogram(positive, bins=expected_edges)
+            assert np.array_equal(h.counts, expected), n
+        assert h.quad_data()["top"].sum() == np.count_nonzero(
+            (positive >= 1) & (positive <= 1e6)
+        )
+        h.remove(values[:500])  # Incrementally, back to the other half
+        expected, _ = np.histogram(values[500:][values[500:] > 0], expected_edges)
+        assert np.array_equal(h.counts, expected)
+        h.add(np.zeros(0))
+        assert np.array_equal(h.counts, expected)
+
+    def test_density_histogram_matches_numpy(self):
+        x_range, y_range, bins = (1, 1e4), (10, 1e6), 30
+        h = DensityHistogram(x_range, y_range, bins=bins)
+        x_edges = np.logspace(0, 4, bins + 1)
+        y_edges = np.logspace(1, 6, bins + 1)
+        for n in (0, 1, 1000):
+            h.clear()
+            x, y = self._values(n, seed=n), self._values(n, seed=n + 1)
+            h.add(x, y)
+            ok = (x > 0) & (y > 0)
+            expected, _, _ = np.histogram2d(y[ok], x[ok], bins=(y_edges, x_edges))
+            assert np.array_equal(h.counts, expected), n
+        h.remove(x[:500], y[:500])
+        x, y = x[500:], y[500:]
+        ok = (x > 0) & (y > 0)
+        expected, _, _ = np.histogram2d(y[ok], x[ok], bins=(y_edges, x_edges))
+        assert np.array_equal(h.counts, expected)
+        assert np.array_equal(h.image() > 0, expected > 0)
+        h.clear()
+        assert not h.image().any()
+
+
+if __name__ == "__main__":
+    TestMinMaxDecimate().run()
+    TestHistograms().run()